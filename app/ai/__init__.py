@@ -1 +1,4 @@
 from ai.openai_service import *
+from ai.coalescing import *
+from ai.admission import *
+from ai.streams import *
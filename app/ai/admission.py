@@ -0,0 +1,196 @@
+import asyncio
+import collections
+import math
+import os
+import re
+import time
+from typing import Any, AsyncIterator, Dict, Mapping
+
+from lib.utils import logger
+
+GENERATION_CONCURRENCY = int(os.environ.get("GENERATION_CONCURRENCY", 16))
+GENERATION_SESSION_CONCURRENCY = int(os.environ.get("GENERATION_SESSION_CONCURRENCY", 2))
+GENERATION_QUEUE_SIZE = int(os.environ.get("GENERATION_QUEUE_SIZE", 32))
+GENERATION_QUEUE_TIMEOUT = float(os.environ.get("GENERATION_QUEUE_TIMEOUT", 10))
+# Admissions are paused when the upstream API has fewer tokens than this left in its rate limit window
+UPSTREAM_TOKEN_RESERVE = int(os.environ.get("UPSTREAM_TOKEN_RESERVE", 2000))
+
+
+def parse_reset(value: str) -> float:
+    """Seconds of an OpenAI rate limit reset header, e.g. "1s", "6m0s", "120ms"."""
+    seconds = 0.0
+    for amount, unit in re.findall(r"([\d.]+)(ms|h|m|s)", value or ""):
+        seconds += float(amount) * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+    return seconds
+
+
+class AdmissionRejected(Exception):
+    """Raised when a generation is not admitted, answered with ``status_code`` and a Retry-After header."""
+
+    def __init__(self, reason: str, status_code: int, retry_after: float):
+        super().__init__(f"Generation not admitted: {reason}")
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class AdmissionTicket:
+    """An admitted generation, it holds a slot of the global limit unless it shares a generation in flight."""
+
+    def __init__(self, controller: "AdmissionController", session_id: str, shared: bool):
+        self.controller = controller
+        self.session_id = session_id
+        self.shared = shared
+        self.admitted_at = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        self.controller.release(self)
+
+
+class AdmissionController:
+    """
+    Limits the generations running at once in this worker.
+    - At most ``limit`` generations run, the next ones wait in a queue of ``queue_size`` for up to ``queue_timeout``
+      seconds, past that they are rejected with 503.
+    - A session has at most ``session_limit`` streams open or queued, the next ones are rejected with 429.
+    - Requests that join a generation in flight (see SingleFlight) add no upstream load and need no slot.
+    - When the upstream rate limit headers say the limit is (about to be) exhausted, admissions are rejected with
+      429 until it resets.
+    """
+
+    def __init__(self, limit: int = GENERATION_CONCURRENCY, session_limit: int = GENERATION_SESSION_CONCURRENCY,
+                 queue_size: int = GENERATION_QUEUE_SIZE, queue_timeout: float = GENERATION_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.session_limit = session_limit
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.sessions: Dict[str, int] = {}
+        self.waiters = collections.deque()
+        self.paused_until = 0.0
+        self.stats = {"admitted": 0, "shared": 0, "queued": 0, "released": 0, "max_queue_depth": 0,
+                      "wait_seconds": 0.0, "max_wait_seconds": 0.0, "held_seconds": 0.0,
+                      "rejected_session": 0, "rejected_queue_full": 0, "rejected_timeout": 0,
+                      "rejected_rate_limited": 0, "upstream_pauses": 0}
+
+    async def admit(self, session_id: str, shared: bool = False) -> AdmissionTicket:
+        if self.sessions.get(session_id, 0) >= self.session_limit:
+            self.reject("session", 429, 1)
+        pause = self.paused_until - time.monotonic()
+        if pause > 0 and not shared:
+            self.reject("rate_limited", 429, pause)
+        ticket = AdmissionTicket(self, session_id, shared)
+        self.sessions[session_id] = self.sessions.get(session_id, 0) + 1
+        try:
+            if not shared:
+                await self.acquire()
+        except BaseException:
+            self.leave_session(session_id)
+            raise
+        self.stats["shared" if shared else "admitted"] += 1
+        return ticket
+
+    def share(self, ticket: AdmissionTicket) -> None:
+        """The ticket joins a generation in flight after all, its slot goes to the next generation."""
+        if ticket.shared or ticket.released:
+            return
+        ticket.shared = True
+        self.stats["admitted"] -= 1
+        self.stats["shared"] += 1
+        self.release_slot()
+
+    async def acquire(self) -> None:
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        if len(self.waiters) >= self.queue_size:
+            self.reject("queue_full", 503, self.expected_wait())
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        self.stats["queued"] += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self.waiters))
+        start_time = time.monotonic()
+        try:
+            # The slot of a released ticket is handed over to the first waiter, see release
+            await asyncio.wait_for(future, self.queue_timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                self.release_slot()
+            elif future in self.waiters:
+                self.waiters.remove(future)
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            self.reject("timeout", 503, self.expected_wait())
+        finally:
+            waited = time.monotonic() - start_time
+            self.stats["wait_seconds"] = round(self.stats["wait_seconds"] + waited, 3)
+            self.stats["max_wait_seconds"] = round(max(self.stats["max_wait_seconds"], waited), 3)
+
+    def release(self, ticket: AdmissionTicket) -> None:
+        """Called when the stream of the ticket ends, calling it again does nothing."""
+        if ticket.released:
+            return
+        ticket.released = True
+        self.leave_session(ticket.session_id)
+        self.stats["released"] += 1
+        self.stats["held_seconds"] = round(self.stats["held_seconds"] + time.monotonic() - ticket.admitted_at, 3)
+        if not ticket.shared:
+            self.release_slot()
+
+    def release_slot(self) -> None:
+        while self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                future.set_result(True)
+                return
+        self.active -= 1
+
+    def leave_session(self, session_id: str) -> None:
+        self.sessions[session_id] -= 1
+        if not self.sessions[session_id]:
+            del self.sessions[session_id]
+
+    def reject(self, reason: str, status_code: int, retry_after: float) -> None:
+        self.stats[f"rejected_{reason}"] += 1
+        raise AdmissionRejected(reason, status_code, retry_after)
+
+    def expected_wait(self) -> float:
+        """Average time a generation holds its slot, what a rejected client should wait before trying again."""
+        if not self.stats["released"]:
+            return self.queue_timeout
+        return self.stats["held_seconds"] / self.stats["released"]
+
+    async def stream(self, ticket, iterator: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """
+        Stream ``iterator`` and release ``ticket`` (an AdmissionTicket or what holds one) once it ends, the client
+        disconnecting included.
+        """
+        try:
+            async for item in iterator:
+                yield item
+        finally:
+            ticket.release()
+
+    def observe_rate_limits(self, headers: Mapping[str, str], limited: bool = False) -> None:
+        """
+        Pause the admissions from the rate limit headers of an upstream response.
+        ``limited`` is set for a 429 answer, admissions then pause for its Retry-After.
+        """
+        pause = 0.0
+        if limited:
+            pause = float(headers.get("retry-after-ms", 0)) / 1000 or float(headers.get("retry-after", 1))
+        if headers.get("x-ratelimit-remaining-requests") == "0":
+            pause = max(pause, parse_reset(headers.get("x-ratelimit-reset-requests")))
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None and int(remaining_tokens) < UPSTREAM_TOKEN_RESERVE:
+            pause = max(pause, parse_reset(headers.get("x-ratelimit-reset-tokens")))
+        if pause > 0:
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            self.stats["upstream_pauses"] += 1
+            logger.warning(f"Upstream rate limit reached, pausing generations for {pause:.2f}s")
+
+    def status(self) -> Dict:
+        paused = max(0.0, self.paused_until - time.monotonic())
+        return {**self.stats, "active": self.active, "queue_depth": len(self.waiters),
+                "sessions": len(self.sessions), "paused_seconds": round(paused, 3)}
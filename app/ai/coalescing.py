@@ -0,0 +1,149 @@
+import asyncio
+import time
+from typing import Any, AsyncIterator, Callable, Dict, Hashable, List, Optional, Tuple
+
+from lib.utils import logger
+
+
+def coalescing_key(*parts: str) -> Tuple[str, ...]:
+    """Parts of a request compared case and whitespace insensitively, "Who was  Monet?" and "who was monet?" match."""
+    return tuple(" ".join((part or "").split()).casefold() for part in parts)
+
+
+class Flight:
+    """
+    One generation shared by every request that asked the same thing while it was running.
+    - The generation runs as its own task and appends what it yields to ``items``.
+    - Every subscriber reads ``items`` from the start, late joiners get what was produced so far and then follow live.
+    - ``owner`` is whatever the leader passed along (e.g. its callback handler), followers can read results from it.
+    - When the last subscriber goes away before the end (the clients disconnected) the generation is cancelled,
+      after ``grace`` seconds if set, unless someone subscribed again.
+    """
+
+    def __init__(self, key: Optional[Hashable], owner: Any = None, grace: float = 0):
+        self.key = key
+        self.owner = owner
+        self.grace = grace
+        self.items: List[Any] = []
+        self.subscribers = 0
+        self.disconnects = 0
+        self.abandoned = False
+        self.closed = False
+        self.closed_at = None
+        self.error: Optional[BaseException] = None
+        self.condition = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+    async def publish(self, item: Any) -> None:
+        async with self.condition:
+            self.items.append(item)
+            self.condition.notify_all()
+
+    async def close(self, error: BaseException = None) -> None:
+        async with self.condition:
+            self.closed = True
+            self.closed_at = time.monotonic()
+            self.error = error
+            self.condition.notify_all()
+
+    async def subscribe(self, start: int = 0) -> AsyncIterator[Any]:
+        """Items from index ``start`` on, the ones produced already first."""
+        self.subscribers += 1
+        index = start
+        try:
+            while True:
+                async with self.condition:
+                    await self.condition.wait_for(lambda: len(self.items) > index or self.closed)
+                    items, closed = self.items[index:], self.closed
+                for item in items:
+                    yield item
+                index += len(items)
+                if closed:
+                    if self.error is not None:
+                        raise self.error
+                    return
+        finally:
+            self.subscribers -= 1
+            if not self.closed:
+                self.disconnects += 1
+                if self.subscribers == 0:
+                    if self.grace:
+                        asyncio.get_running_loop().call_later(self.grace, self.abandon)
+                    else:
+                        self.abandon()
+
+    def abandon(self) -> None:
+        """Cancel the generation if nobody subscribes to it anymore."""
+        if self.subscribers == 0 and not self.closed and self.task is not None:
+            self.abandoned = True
+            self.task.cancel()
+
+
+class SingleFlight:
+    """
+    Coalesces identical requests in flight: the first one (the leader) starts the generation, the ones arriving
+    while it runs (followers) subscribe to it instead of starting their own.
+    A request with no key (``None``) is never shared. The flight is forgotten once the generation ends, the next
+    identical request starts a new one.
+    ``grace`` is how long a flight without subscribers goes on before it is cancelled.
+    ``stats`` counts the generations by outcome with the tokens (items) and seconds they took, the cancelled ones
+    are what abandoned generations cost until they were stopped.
+    """
+
+    def __init__(self, grace: float = 0):
+        self.grace = grace
+        self.flights: Dict[Hashable, Flight] = {}
+        self.stats = {"leaders": 0, "followers": 0, "disconnects": 0,
+                      "completed": 0, "failed": 0, "cancelled": 0,
+                      "tokens": 0, "seconds": 0.0, "cancelled_tokens": 0, "cancelled_seconds": 0.0}
+
+    def running(self, key: Optional[Hashable]) -> bool:
+        """Whether a request for ``key`` would join a generation in flight."""
+        flight = self.flights.get(key) if key is not None else None
+        return flight is not None and not flight.abandoned
+
+    def join(self, key: Optional[Hashable], generate: Callable[[], AsyncIterator[Any]],
+             owner: Any = None) -> Tuple[Flight, bool]:
+        """Return the flight of ``key`` and whether this request leads it, ``generate`` is only called by leaders."""
+        if self.running(key):
+            flight = self.flights[key]
+            self.stats["followers"] += 1
+            logger.info(f"Joining the generation in flight for {key} ({len(flight.items)} items so far)")
+            return flight, False
+        flight = Flight(key, owner, self.grace)
+        if key is not None:
+            self.flights[key] = flight
+        self.stats["leaders"] += 1
+        flight.task = asyncio.create_task(self.run(flight, generate))
+        return flight, True
+
+    async def run(self, flight: Flight, generate: Callable[[], AsyncIterator[Any]]) -> None:
+        start_time = time.perf_counter()
+        generator = generate()
+        outcome, error = "completed", None
+        try:
+            async for item in generator:
+                await flight.publish(item)
+        except asyncio.CancelledError:
+            outcome, error = "cancelled", RuntimeError("The generation was cancelled")
+        except Exception as e:
+            logger.error(f"Generation for {flight.key} failed: {str(e)}")
+            outcome, error = "failed", e
+        finally:
+            # Closing the generator runs its cleanup, which stops the upstream call when it was cancelled
+            await generator.aclose()
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+            await flight.close(error)
+            self.record(flight, outcome, time.perf_counter() - start_time)
+
+    def record(self, flight: Flight, outcome: str, seconds: float) -> None:
+        self.stats[outcome] += 1
+        self.stats["disconnects"] += flight.disconnects
+        self.stats["tokens"] += len(flight.items)
+        self.stats["seconds"] = round(self.stats["seconds"] + seconds, 3)
+        if outcome == "cancelled":
+            self.stats["cancelled_tokens"] += len(flight.items)
+            self.stats["cancelled_seconds"] = round(self.stats["cancelled_seconds"] + seconds, 3)
+            logger.info(f"Cancelled the generation for {flight.key} after {len(flight.items)} tokens and "
+                        f"{seconds:.2f}s, every client disconnected")
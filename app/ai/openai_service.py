@@ -1,24 +1,26 @@
 import json
 import os
 import re
+import time
 
 import openai
 import asyncio
+import threading
 from dotenv import load_dotenv
 from typing import Any
 from langchain.callbacks.streaming_aiter import AsyncIteratorCallbackHandler
 from langchain.schema import LLMResult
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from langchain.agents import AgentType, initialize_agent
-from langchain.memory import ConversationBufferWindowMemory
-from langchain_community.vectorstores import FAISS
-from google.cloud import storage
 from db import Session, logger
-from crud import insert_message
-from openai import OpenAI
+from crud import insert_message, get_question_history_id
+from openai import AsyncOpenAI
+from stores import VersionedStore, ArtifactSync, GcsBackend
+from ai.coalescing import Flight, SingleFlight, coalescing_key
+from ai.admission import AdmissionController, AdmissionTicket
 
 load_dotenv()
 openai.api_key = os.getenv("OPENAI_API_KEY")
+VECTOR_STORE_RELOAD_INTERVAL = float(os.environ.get("VECTOR_STORE_RELOAD_INTERVAL", 30))
 
 
 class AsyncCallbackHandler(AsyncIteratorCallbackHandler):
@@ -31,6 +33,7 @@ class AsyncCallbackHandler(AsyncIteratorCallbackHandler):
         self.history_id = history_id
         self.session_id = session_id
         self.ai_answer = ""
+        self.saved = False
 
     async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         self.ai_answer += token
@@ -53,17 +56,45 @@ class AsyncCallbackHandler(AsyncIteratorCallbackHandler):
             self.content = ""
 
     async def save_to_db(self):
-        logger.info("Adding AI response to DB")
-        insert_message(self.db, self.session_id, self.history_id, 'ai', self.ai_answer)
+        self.save()
+
+    def save(self, partial: bool = False):
+        """
+        Synchronous, it also runs while the request is being cancelled. An answer is only saved once, ``partial``
+        marks one that was cut off.
+        """
+        if self.saved:
+            return
+        self.saved = True
+        logger.info(f"Adding {'partial ' if partial else ''}AI response to DB")
+        insert_message(self.db, self.session_id, self.history_id, 'ai', self.ai_answer, partial=partial)
+
+
+class AdmittedGeneration:
+    """
+    A request admitted to a generation: its admission ticket and the flight it leads or follows.
+    - ``release`` gives the ticket back, streams call it when they end (see AdmissionController.stream).
+    - Released before it was streamed (the request failed on the way), a generation it leads is stopped too, unless
+      followers read it.
+    """
+
+    def __init__(self, ticket: AdmissionTicket, flight: Flight, leader: bool):
+        self.ticket = ticket
+        self.flight = flight
+        self.leader = leader
+        self.streamed = False
+
+    def release(self) -> None:
+        self.ticket.release()
+        if self.leader and not self.streamed:
+            self.flight.abandon()
 
 
 class ConversationalRAG:
 
     def __init__(self):
         self.bucket = os.environ.get("BUCKET_NAME")
-        # Google client
-        # self.storage_client = storage.Client()
-        self.openai_client = OpenAI()
+        self.openai_client = AsyncOpenAI()
         self.llm = ChatOpenAI(
             model_name="gpt-4o",
             streaming=True,  # ! important
@@ -76,38 +107,79 @@ class ConversationalRAG:
 
         self.max_session_iteration = 10
 
-        # Download and replace local vector store files
-        # os.makedirs("data/merged_vector", exist_ok=True)
-        # self.download_and_replace_file("data/merged_vector/index.faiss")
-        # self.download_and_replace_file("data/merged_vector/index.pkl")
-
         self.embeddings = OpenAIEmbeddings()
-        self.vectorstore = FAISS.load_local("data/vector_store", self.embeddings, allow_dangerous_deserialization=True)
-        self.iframe_vector_store = FAISS.load_local("data/iframe_store", self.embeddings,
-                                                    allow_dangerous_deserialization=True)
+        # Attribute -> versioned store it is loaded from, new versions published by a refresh are swapped in live
+        self.stores = {"vectorstore": VersionedStore("data/vector_store"),
+                       "iframe_vector_store": VersionedStore("data/iframe_store")}
+        # The text vector store is also published to the bucket by cloud refreshes, the warmup pulls its current
+        # version (the bucket client is created there, off the import path)
+        self.artifact_sync = None
+        self.loaded_versions = {}
+        self.reload_lock = threading.Lock()
+        # Stores and agent are loaded by the startup warmup, see load_vector_store and load_agent
+        self.vectorstore = self.iframe_vector_store = self.agent = None
+        # Identical questions asked at the same time share one generation, see generation_key
+        self.in_flight = SingleFlight()
+        # Limits the generations running at once, it also follows the rate limits of the OpenAI API
+        self.admission = AdmissionController()
+
+    def load_vector_store(self, attribute: str) -> None:
+        store = self.stores[attribute]
+        version = store.current_version()
+        vector_store = store.load(self.embeddings, mmap=True)
+        with self.reload_lock:
+            self.loaded_versions[attribute] = version
+            setattr(self, attribute, vector_store)
+
+    def load_agent(self) -> None:
         self.agent = self.create_tas_agent()
 
-    # def download_cs_file(self, file_name, destination_file_name):
-    #     try:
-    #         bucket = self.storage_client.bucket(self.bucket)
-    #         blob = bucket.blob(file_name)
-    #         blob.download_to_filename(destination_file_name)
-    #         logger.info(f"Downloaded {file_name} to {destination_file_name}")
-    #         return True
-    #     except Exception as e:
-    #         logger.error(f"Failed to download {file_name} from {self.bucket}: {str(e)}")
-    #         return False
-
-    # def download_and_replace_file(self, local_path):
-    #     try:
-    #         if os.path.exists(local_path):
-    #             os.remove(local_path)
-    #             logger.info(f"Deleting existing file: {os.path.basename(local_path)}")
-    #         else:
-    #             logger.info(f"Starting download: {os.path.basename(local_path)}")
-    #         self.download_cs_file(local_path, local_path)
-    #     except Exception as e:
-    #         logger.error(f"Error downloading and replacing file {local_path}: {str(e)}")
+    def start_reload_watcher(self) -> None:
+        if VECTOR_STORE_RELOAD_INTERVAL > 0:
+            threading.Thread(target=self.watch_vector_stores, name="vector-store-reload", daemon=True).start()
+
+    def reload_vector_stores(self) -> dict:
+        """
+        Load the stores whose current version changed and swap them in.
+        Requests already running keep the index they started with, the next ones use the new one.
+        """
+        swapped = {}
+        with self.reload_lock:
+            for attribute, store in self.stores.items():
+                version = store.current_version()
+                if version is None or version == self.loaded_versions.get(attribute):
+                    continue
+                try:
+                    vector_store = store.load(self.embeddings, mmap=True)
+                except Exception as e:
+                    logger.error(f"Could not load version {version} of {store.root}, still serving "
+                                 f"{self.loaded_versions.get(attribute)}: {str(e)}")
+                    continue
+                setattr(self, attribute, vector_store)
+                swapped[attribute] = {"from": self.loaded_versions.get(attribute), "to": version}
+                self.loaded_versions[attribute] = version
+                logger.info(f"Swapped {store.root} to version {version}")
+        return swapped
+
+    def pull_vector_store(self) -> None:
+        """Download the version the bucket points at, the local version keeps being used if that fails."""
+        if not self.bucket:
+            return
+        try:
+            if self.artifact_sync is None:
+                self.artifact_sync = ArtifactSync(GcsBackend(self.bucket), "data/vector_store")
+            self.artifact_sync.pull(self.stores["vectorstore"])
+        except Exception as e:
+            logger.error(f"Failed to pull the vector store from {self.bucket}: {str(e)}")
+
+    def watch_vector_stores(self) -> None:
+        while True:
+            time.sleep(VECTOR_STORE_RELOAD_INTERVAL)
+            try:
+                self.pull_vector_store()
+                self.reload_vector_stores()
+            except Exception as e:
+                logger.error(f"Vector store reload failed: {str(e)}")
 
     async def run_call(self, prompt: str, query: str, resLen_String: str,
                        responseLength: str,
@@ -148,18 +220,79 @@ class ConversationalRAG:
         self.agent.agent.llm_chain.llm.callbacks = [stream_it]
         await self.agent.acall(inputs={"input": prompt})
 
-    async def create_gen(self, prompt: str, query: str, resLen_string: str, responseLength: str,
-                         stream_it: AsyncCallbackHandler, chat_history: list):
-        task = asyncio.create_task(self.run_call(prompt, query, resLen_string, responseLength,
-                                                 stream_it, chat_history))
-        async for token in stream_it.aiter():
-            yield token
-        await task
+    def generation_key(self, endpoint: str, prompt: str, query: str, resLen_string: str, responseLength: str,
+                       chat_history: list):
+        """
+        Key under which a generation is shared, None when it must not be.
+        The history of the session is part of the prompt, only questions opening a conversation are shared.
+        """
+        if chat_history:
+            return None
+        return (endpoint, *coalescing_key(query, responseLength, resLen_string, prompt))
+
+    async def admit(self, key, generate, session_id: str, owner: Any = None) -> AdmittedGeneration:
+        """
+        Join the generation of ``key`` in flight or lead a new one, raises AdmissionRejected.
+        Only a leader holds a generation slot: a request waiting for one that finds the generation started in the
+        meantime follows it and gives its slot back.
+        """
+        ticket = await self.admission.admit(session_id, shared=self.in_flight.running(key))
+        # Nothing is awaited from here to the join, a flight found running can't end in between
+        flight, leader = self.in_flight.join(key, generate, owner)
+        if not leader:
+            self.admission.share(ticket)
+        return AdmittedGeneration(ticket, flight, leader)
+
+    async def admit_agent(self, prompt: str, query: str, resLen_string: str, responseLength: str,
+                          stream_it: AsyncCallbackHandler, chat_history: list, session_id: str) -> AdmittedGeneration:
+        async def generate():
+            task = asyncio.create_task(self.run_call(prompt, query, resLen_string, responseLength,
+                                                     stream_it, chat_history))
+            completed = False
+            try:
+                async for token in stream_it.aiter():
+                    yield token
+                await task
+                completed = True
+            finally:
+                # Stops the agent and its upstream stream when every client went away
+                task.cancel()
+                # A complete answer was saved by the handler, the leader keeps a stopped one as far as it got
+                if not completed and stream_it.ai_answer:
+                    stream_it.save(partial=True)
+
+        key = self.generation_key("agent", prompt, query, resLen_string, responseLength, chat_history)
+        return await self.admit(key, generate, session_id, owner=stream_it)
+
+    async def create_gen(self, generation: AdmittedGeneration, stream_it: AsyncCallbackHandler):
+        generation.streamed = True
+        flight, leader = generation.flight, generation.leader
+        try:
+            async for token in flight.subscribe():
+                yield token
+        finally:
+            # The leader's answer is saved by its own handler, see admit_agent: once complete, also when its client
+            # left and followers kept the generation going. A follower saves the answer to its session, marked
+            # partial when the follower left before the end or the generation failed.
+            if not leader and flight.owner.ai_answer:
+                stream_it.ai_answer = flight.owner.ai_answer
+                stream_it.save(partial=not flight.closed or flight.error is not None)
 
     async def get_heading_url(self, query):
         embedding_vector = self.embeddings.embed_query(query.lower())
-        image_vector_store = FAISS.load_local("data/image_vector", self.embeddings,
-                                              allow_dangerous_deserialization=True)
+        image_vector_store = VersionedStore("data/image_vector").load(self.embeddings, mmap=True)
+        return self.match_heading_url(image_vector_store, embedding_vector)
+
+    def heading_urls(self, headings: list) -> dict:
+        """get_heading_url of several headings, with one load of the image store and one embedding request."""
+        if not headings:
+            return {}
+        image_vector_store = VersionedStore("data/image_vector").load(self.embeddings, mmap=True)
+        embedding_vectors = self.embeddings.embed_documents([heading.lower() for heading in headings])
+        return {heading: self.match_heading_url(image_vector_store, embedding_vector)
+                for heading, embedding_vector in zip(headings, embedding_vectors)}
+
+    def match_heading_url(self, image_vector_store, embedding_vector):
         docs = image_vector_store.similarity_search_with_score_by_vector(embedding_vector, 3)
         for doc in docs:
             doc, score = doc
@@ -170,6 +303,10 @@ class ConversationalRAG:
         return None
 
     def create_tas_agent(self):
+        # The agent modules are slow to import and only needed here, which runs in the startup warmup
+        from langchain.agents import AgentType, initialize_agent
+        from langchain.memory import ConversationBufferWindowMemory
+
         memory = ConversationBufferWindowMemory(
             memory_key="chat_history",
             k=5,
@@ -193,8 +330,36 @@ class ConversationalRAG:
         docs = self.iframe_vector_store.similarity_search_by_vector(embedding_vector)
         return docs[0]
 
-    async def response_generator(self, prompt: str, query: str, resLen_String: str,
-                                 responseLength: str, chat_history: list):
+    async def admit_response(self, prompt: str, query: str, resLen_String: str, responseLength: str,
+                             chat_history: list, session_id: str) -> AdmittedGeneration:
+        key = self.generation_key("response", prompt, query, resLen_String, responseLength, chat_history)
+        return await self.admit(key, lambda: self.stream_completion(prompt, query, resLen_String, responseLength,
+                                                                     chat_history), session_id)
+
+    async def response_generator(self, generation: AdmittedGeneration, db: Session = None, session_id: str = None,
+                                 history_id: str = None, question: str = None):
+        """
+        Streams the frames of the generation.
+        - Complete answers are saved by the client. One that disconnected can't, its partial answer is saved here.
+        - The partial answer goes to the turn's ``history_id``, or else to the turn ``question`` was saved in.
+        """
+        generation.streamed = True
+        flight = generation.flight
+        frame = None
+        try:
+            async for frame in flight.subscribe():
+                yield frame
+        finally:
+            if (not flight.closed or flight.error is not None) and frame is not None and db is not None:
+                history_id = history_id or get_question_history_id(db, session_id, question)
+                if history_id is None:
+                    logger.warning(f"Partial AI response of session {session_id} not saved, its turn is unknown")
+                else:
+                    logger.info("Adding partial AI response to DB")
+                    insert_message(db, session_id, history_id, 'ai', json.loads(frame)["text_message"], partial=True)
+
+    async def stream_completion(self, prompt: str, query: str, resLen_String: str,
+                                responseLength: str, chat_history: list):
 
         structure_response = "When responding, please format your answer with clear headings for each " \
                              "specified chunk. Use the following structure:\n" \
@@ -234,26 +399,38 @@ class ConversationalRAG:
         data_types = []
         for doc in docs:
             all_content += f"{doc.page_content}\n"
-            doc_id = doc.metadata['id']
-            doc_type = doc.metadata['source']
-            if doc_id not in data_ids:
-                data_ids.append(doc_id)
-            if doc_type not in data_types:
-                data_types.append(doc_type)
-
-        response = self.openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": f"{prompt} {structure_response}"},
-                {"role": "user", "content": f"\n\n{resLen_String}\n\n{ai_resp}\n\n{all_content}\n\n{query}"}
-            ],
-            temperature=0,
-            stream=True
-        )
+            # Deduplicated chunks keep the metadata of the documents they were merged from
+            for metadata in [doc.metadata, *doc.metadata.get('duplicates', [])]:
+                doc_id = metadata['id']
+                doc_type = metadata['source']
+                if doc_id not in data_ids:
+                    data_ids.append(doc_id)
+                if doc_type not in data_types:
+                    data_types.append(doc_type)
+
+        try:
+            raw_response = await self.openai_client.chat.completions.with_raw_response.create(
+                model="gpt-4o",
+                messages=[
+                    {"role": "system", "content": f"{prompt} {structure_response}"},
+                    {"role": "user", "content": f"\n\n{resLen_String}\n\n{ai_resp}\n\n{all_content}\n\n{query}"}
+                ],
+                temperature=0,
+                stream=True
+            )
+        except openai.RateLimitError as e:
+            self.admission.observe_rate_limits(e.response.headers, limited=True)
+            raise
+        self.admission.observe_rate_limits(raw_response.headers)
+        response = raw_response.parse()
         result = {"chat_id": None, "text_message": "", "data_id": data_ids, "data_type": data_types}
-        for chunk in response:
-            result['chat_id'] = chunk.id
-            chunk_message = chunk.choices[0].delta.content  # Extract the message
-            if chunk_message:
-                result['text_message'] += chunk_message
-                yield json.dumps(result) + '\n\n\n\n'
+        try:
+            async for chunk in response:
+                result['chat_id'] = chunk.id
+                chunk_message = chunk.choices[0].delta.content  # Extract the message
+                if chunk_message:
+                    result['text_message'] += chunk_message
+                    yield json.dumps(result) + '\n\n\n\n'
+        finally:
+            # Closing the connection early makes the API stop generating
+            await response.close()
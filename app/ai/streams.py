@@ -0,0 +1,89 @@
+import asyncio
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from ai.coalescing import Flight, SingleFlight
+
+# How long a stream goes on without a client before it is cancelled, and how long it can be replayed once finished
+STREAM_RESUME_GRACE = float(os.environ.get("STREAM_RESUME_GRACE", 30))
+STREAM_REPLAY_TTL = float(os.environ.get("STREAM_REPLAY_TTL", 120))
+
+
+def sse_event(data: str, event_id: str = None, event: str = None) -> str:
+    """One Server-Sent Event, every line of ``data`` gets its own data field."""
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    if event is not None:
+        lines.append(f"event: {event}")
+    lines.extend(f"data: {line}" for line in data.split("\n"))
+    return "\n".join(lines) + "\n\n"
+
+
+def parse_event_id(last_event_id: str) -> Tuple[Optional[str], int]:
+    """``<stream id>:<index>`` from a Last-Event-ID header, (None, -1) when it isn't one of ours."""
+    stream_id, _, index = (last_event_id or "").strip().rpartition(":")
+    if not stream_id or not index.isdigit():
+        return None, -1
+    return stream_id, int(index)
+
+
+class ResumableStreams:
+    """
+    Token streams sent as Server-Sent Events that a client can resume after its connection dropped.
+    - Every stream gets an id, its events are numbered ``<stream id>:<index>``.
+    - The tokens are produced by a task into a replay buffer (a Flight), not by the connection. A client that
+      reconnects with the Last-Event-ID header gets the events after that one, without a new generation.
+    - A stream nobody reads for ``grace`` seconds is cancelled, a finished one can be replayed for ``ttl`` seconds.
+    - The last event is ``end`` (or ``error``), a client that got it is done and should not reconnect.
+    """
+
+    def __init__(self, grace: float = STREAM_RESUME_GRACE, ttl: float = STREAM_REPLAY_TTL):
+        self.grace = grace
+        self.ttl = ttl
+        self.pumps = SingleFlight(grace)
+        self.streams: Dict[str, Flight] = {}
+        self.resumed = 0
+
+    def open(self, tokens: AsyncIterator[str], session_id: str) -> AsyncIterator[str]:
+        """Start buffering ``tokens`` and return the events of the new stream."""
+        self.prune()
+        stream_id = uuid.uuid4().hex
+        flight, _ = self.pumps.join(stream_id, lambda: tokens, owner=session_id)
+        self.streams[stream_id] = flight
+        # Also cancelled when the response never started to read it
+        asyncio.get_running_loop().call_later(self.grace, flight.abandon)
+        return self.events(stream_id, flight)
+
+    def resume(self, last_event_id: str, session_id: str) -> Optional[AsyncIterator[str]]:
+        """The events after ``last_event_id``, None when the stream is unknown, expired or of another session."""
+        self.prune()
+        stream_id, index = parse_event_id(last_event_id)
+        flight = self.streams.get(stream_id)
+        if flight is None or flight.owner != session_id or flight.abandoned:
+            return None
+        self.resumed += 1
+        return self.events(stream_id, flight, index + 1)
+
+    async def events(self, stream_id: str, flight: Flight, start: int = 0) -> AsyncIterator[str]:
+        index = start
+        try:
+            async for token in flight.subscribe(start):
+                yield sse_event(token, f"{stream_id}:{index}")
+                index += 1
+        except Exception as e:
+            yield sse_event(str(e), f"{stream_id}:{index}", "error")
+            return
+        yield sse_event("", f"{stream_id}:{index}", "end")
+
+    def prune(self) -> None:
+        now = time.monotonic()
+        for stream_id, flight in list(self.streams.items()):
+            if flight.abandoned or (flight.closed and now - flight.closed_at > self.ttl):
+                del self.streams[stream_id]
+
+    def status(self) -> Dict[str, Any]:
+        return {**self.pumps.stats, "open": len(self.pumps.flights), "replayable": len(self.streams),
+                "resumed": self.resumed}
@@ -1 +1,2 @@
-from ats.ats_business_logic import *
\ No newline at end of file
+from ats.ats_business_logic import *
+from ats.enrichment import *
\ No newline at end of file
@@ -1,8 +1,10 @@
+import os
 import re
 import tiktoken
 import string
 import unicodedata
 import csv
+from functools import lru_cache
 
 COMMON_WORDS = {"in", "to", "a", "the", "and", "or", "of", "is", "are", "on", "at", "for"}
 
@@ -13,22 +15,20 @@ def num_tokens_from_string(string: str, encoding_name: str = "cl100k_base") -> i
 
 
 def iframe_link_generator(sentence: str):
-    type_and_id_list = extract_type_and_id_2(sentence)
-    links = set()
-    for type, id, name, sorting_score, occurrence in type_and_id_list:
-        links.add(f"https://www.theartstory.org/data/content/dynamic_content/ai-card/{type}/{re.sub('_', '-', id)}")
-    return links
+    return set(iframe_links(extract_type_and_id_2(sentence)))
 
 
-# With Single Word Search (Unique added) + Multi Word Search
-def extract_type_and_id(sentence, database_file="database.csv"):
-    # Initialize an empty list to store the results
-    results = []
+def iframe_links(type_and_id_list: list) -> list:
+    links = []
+    for type, id, name, sorting_score, occurrence in type_and_id_list:
+        link = f"https://www.theartstory.org/data/content/dynamic_content/ai-card/{type}/{re.sub('_', '-', id)}"
+        if link not in links:
+            links.append(link)
+    return links
 
-    # Remove punctuation and normalize the input sentence
-    cleaned_sentence = sentence.translate(str.maketrans('', '', string.punctuation))
-    normalized_sentence = normalize_sentence(cleaned_sentence)
 
+@lru_cache(maxsize=4)
+def read_database(database_file: str, modified: float) -> tuple:
     # Open the CSV file with utf-8 encoding
     with open(database_file, newline='', encoding='utf-8') as csvfile:
         reader = csv.DictReader(csvfile)
@@ -45,6 +45,25 @@ def extract_type_and_id(sentence, database_file="database.csv"):
                 'unique_name': normalized_unique_name,
                 'original_name': row['name']  # Store the original name
             })
+    return tuple(rows)
+
+
+def load_database(database_file="database.csv") -> tuple:
+    """The normalized rows of the database, read again only when the file changed."""
+    return read_database(database_file, os.path.getmtime(database_file))
+
+
+# With Single Word Search (Unique added) + Multi Word Search
+def extract_type_and_id(sentence, database_file="database.csv"):
+    # Initialize an empty list to store the results
+    results = []
+
+    # Remove punctuation and normalize the input sentence
+    cleaned_sentence = sentence.translate(str.maketrans('', '', string.punctuation))
+    normalized_sentence = normalize_sentence(cleaned_sentence)
+
+    # Rows of the CSV file with their 'name' and 'unique_name' fields normalized
+    rows = load_database(database_file)
 
     # Iterate through each row in the CSV file
     for row in rows:
@@ -117,22 +136,8 @@ def extract_type_and_id_2(sentence, database_file="database.csv"):
     cleaned_sentence = sentence.translate(str.maketrans('', '', string.punctuation))
     normalized_sentence = normalize_sentence(cleaned_sentence)
 
-    # Open the CSV file with utf-8 encoding
-    with open(database_file, newline='', encoding='utf-8') as csvfile:
-        reader = csv.DictReader(csvfile)
-
-        # Read all rows into memory and normalize the 'name' and 'unique_name' fields
-        rows = []
-        for row in reader:
-            normalized_name = normalize_text(row['name'])
-            normalized_unique_name = normalize_text(row['unique_name'])
-            rows.append({
-                'Type': row['Type'],
-                'ID': row['ID'],
-                'name': normalized_name,
-                'unique_name': normalized_unique_name,
-                'original_name': row['name']  # Store the original name
-            })
+    # Rows of the CSV file with their 'name' and 'unique_name' fields normalized
+    rows = load_database(database_file)
 
     # Iterate through each row in the CSV file
     for row in rows:
@@ -203,7 +208,10 @@ def normalize_text(text):
 
 
 def source_link_generator(sentence: str):
-    type_and_id_list = extract_type_and_id(sentence)
+    return source_links(extract_type_and_id(sentence))
+
+
+def source_links(type_and_id_list: list) -> str:
     links_by_type = {}
 
     # Group results by type
@@ -224,9 +232,13 @@ def source_link_generator(sentence: str):
 
 
 def artist_img_generator(sentence: str):
-    type_and_id_list = extract_type_and_id(sentence)
-    links_set = set()
+    return list(set(artist_images(extract_type_and_id(sentence))))
+
+
+def artist_images(type_and_id_list: list) -> list:
+    links = []
     for type, id, _, _, _ in type_and_id_list:
-        if type == 'artist':
-            links_set.add(f"https://www.theartstory.org/images20/ttip/{id}.jpg")
-    return list(links_set)
+        link = f"https://www.theartstory.org/images20/ttip/{id}.jpg"
+        if type == 'artist' and link not in links:
+            links.append(link)
+    return links
@@ -0,0 +1,85 @@
+import asyncio
+import os
+import re
+from functools import lru_cache
+from typing import Dict, List, Optional
+
+from ats.ats_business_logic import (extract_type_and_id, extract_type_and_id_2, iframe_links, source_links,
+                                    artist_images)
+
+# '**Heading 1**:' as asked for by the prompt of /generate_response, or a markdown '## Heading'
+HEADING_PATTERN = re.compile(r"^(?:#+\s*(.+?)|\*\*(.+?)\*\*:?)$")
+
+
+@lru_cache(maxsize=1024)
+def scan_line(line: str, database_file: str, modified: float) -> tuple:
+    return extract_type_and_id(line, database_file), extract_type_and_id_2(line, database_file)
+
+
+class AnswerEnrichment:
+    """
+    The entity lookups of an answer, run while it streams: what /get_iframe, /get_source and /get_artist_img
+    answer for each of its lines, plus its headings.
+    - feed() takes the text so far, the lines it completes are scanned in a worker thread, one after the other,
+      while the next tokens arrive.
+    - finish() takes the whole text, result() waits for the last scans and merges them: the entities in order of
+      first appearance and the links of each kind without duplicates.
+    - Lines scanned before are cached (until the database changes), the answers of coalesced requests are only
+      scanned once.
+    """
+
+    def __init__(self, database_file: str = "database.csv"):
+        self.database_file = database_file
+        self.position = 0
+        self.pending: List[str] = []
+        self.scans: List[tuple] = []
+        self.headings: List[str] = []
+        self.worker: Optional[asyncio.Task] = None
+
+    def feed(self, text: str) -> None:
+        end = text.rfind("\n", self.position)
+        if end == -1:
+            return
+        for line in text[self.position:end].split("\n"):
+            self.add(line.strip())
+        self.position = end + 1
+
+    def finish(self, text: str) -> None:
+        self.feed(text + "\n")
+
+    def add(self, line: str) -> None:
+        if not line:
+            return
+        heading = HEADING_PATTERN.match(line)
+        if heading:
+            self.headings.append((heading.group(1) or heading.group(2)).strip())
+        self.pending.append(line)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.scan_pending())
+
+    async def scan_pending(self) -> None:
+        while self.pending:
+            line = self.pending.pop(0)
+            modified = os.path.getmtime(self.database_file)
+            self.scans.append(await asyncio.to_thread(scan_line, line, self.database_file, modified))
+
+    async def result(self) -> Dict:
+        if self.worker is not None:
+            await self.worker
+        entities, iframe_entities = {}, {}
+        for line_entities, line_iframe_entities in self.scans:
+            for entity in line_entities:
+                entities.setdefault((entity[0], entity[1]), entity)
+            for entity in line_iframe_entities:
+                iframe_entities.setdefault((entity[0], entity[1]), entity)
+        return {"entities": [[type, id, name] for type, id, name, _, _ in entities.values()],
+                "iframe": iframe_links(list(iframe_entities.values())),
+                "sources": source_links(list(entities.values())),
+                "artist_images": artist_images(list(entities.values())),
+                "headings": self.headings}
+
+    def close(self) -> None:
+        """Stop scanning, when the answer was abandoned."""
+        self.pending.clear()
+        if self.worker is not None:
+            self.worker.cancel()
@@ -1,39 +1,39 @@
-import shutil
 import time
 import xml.etree.ElementTree as ET
 import re
 import os
-import textwrap
 import json
-from typing import List, Dict, Union
+from typing import Callable, Iterable, List, Dict, Set, Tuple
 import requests
-from bs4 import BeautifulSoup
 from urllib.parse import urlparse, urljoin
 from langchain_core.documents import Document
 from typing import Iterator
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import FAISS
 from langchain_openai import OpenAIEmbeddings
-from google.cloud import storage
 from dotenv import load_dotenv
+from refresh import (XmlCrawler, HttpCache, build_manifest, load_manifest, save_manifest, diff_manifest,
+                     expand_shared_chunks, CachedEmbeddings, EmbeddingCache, EmbeddingScheduler,
+                     StructuredChunker, ChunkDeduplicator, ParallelExtractor, CONTENT_SPECS, extract_document)
+from stores import VersionedStore, ArtifactSync, GcsBackend
 
 VECTOR_STORE_PATH = "data/vector_store/"
 JSON_STORE_PATH = "data/json_files/"
 IMAGE_STORE_PATH = "data/image_vector"
 IFRAME_STORE_PATH = "data/iframe_store"
+IMAGES_JSON_PATH = "data/images.json"
+IFRAME_JSON_PATH = "data/iframe.json"
+MANIFEST_PATH = "data/manifest.json"
+EMBEDDING_CACHE_PATH = "data/embedding_cache.sqlite"
+SITEMAP_URL = "https://www.theartstory.org/sitemap.htm"
+BUCKET_NAME = os.environ.get("BUCKET_NAME", "tas-website-data")
 
 
-def fetch_and_parse_xml(url: str) -> Union[ET.Element, None]:
-    with requests.get(url) as response:
-        if response.status_code == 200:
-            return ET.fromstring(response.content)
-        return None
+def get_xml_files(url: str = SITEMAP_URL, session: requests.Session = None) -> Dict:
+    from bs4 import BeautifulSoup
 
-
-def get_xml_files() -> Dict:
-    url = "https://www.theartstory.org/sitemap.htm"
     paths = set()
-    with requests.get(url) as response:
+    with (session or requests).get(url) as response:
         response.raise_for_status()
         soup = BeautifulSoup(response.content, 'html.parser')
         filter_paths = ["/artist/", "/critic/", "/definition/", "/influencer/", "/movement/"]
@@ -52,260 +52,11 @@ def get_xml_files() -> Dict:
         extracted_id = segments[2]
 
         data_dict.get(extracted_type).append(
-            f"https://www.theartstory.org/data/content/{extracted_type}/{re.sub('-', '_', extracted_id)}.xml")
+            urljoin(url, f"/data/content/{extracted_type}/{re.sub('-', '_', extracted_id)}.xml"))
 
     return data_dict
 
 
-def extract_artist_data(root: ET.Element) -> Dict:
-    artist_data = {}
-    artist_id = None
-
-    main_element = root.find('main')
-    if main_element is not None:
-        artist_id = main_element.findtext('id')
-        new_artist_id = re.sub('_', '-', artist_id)
-        artist_data['source_link'] = f"https://www.theartstory.org/artist/{new_artist_id}/"
-        artist_data[
-            'iframe_link'] = f"https://www.theartstory.org/data/content/dynamic_content/ai-card/artist/{new_artist_id}"
-        artist_data['artist_image'] = f"https://www.theartstory.org/images20/ttip/{artist_id}.jpg"
-        artist_data['name'] = main_element.findtext('name')
-        artist_data['years_worked'] = main_element.findtext('years')
-        artist_data['description'] = main_element.findtext('description')
-        artist_data['art_description'] = main_element.findtext('art_description')
-        artist_data['nationality'] = main_element.findtext('nationality')
-        artist_data['occupation'] = main_element.findtext('occupation')
-        artist_data['birthDate'] = main_element.findtext('birthDate')
-        artist_data['birthPlace'] = main_element.findtext('birthPlace')
-        artist_data['deathDate'] = main_element.findtext('deathDate')
-        artist_data['deathPlace'] = main_element.findtext('deathPlace')
-        artist_data['content_publish_date'] = main_element.findtext('pub_time')
-
-    artist_data['quotes'] = [quote.text for quote in root.findall('.//quotes/q')]
-    artist_data['synopsis'] = re.sub(r'<.*?>', '', root.findtext(path='.//article/synopsys', default=''))
-    artist_data['similar_artists'] = [artist.text for artist in root.findall('.//artist')]
-    artist_data['key_ideas'] = [re.sub(r'<.*?>', '', idea.text) for idea in root.findall('.//idea')]
-
-    artist_data['sections'] = extract_sections(root)
-    artist_data['artworks'] = extract_artworks(root, artist_id)
-    artist_data['recommended_books'] = extract_recommended_books(root, "category", "subcategory[@name='not_to_show']")
-    artist_data['extra_links'] = extract_extra_links(root, 'web resources')
-
-    return {artist_id: artist_data, "type": "artist", "id": artist_id}
-
-
-def extract_movement_data(root: ET.Element) -> Dict:
-    movement_data = {}
-    movement_id = None
-
-    main_element = root.find('main')
-    if main_element is not None:
-        movement_id = main_element.findtext('id')
-        new_movement_id = re.sub('_', '-', movement_id)
-        movement_data['source_link'] = f"https://www.theartstory.org/movement/{new_movement_id}/"
-        movement_data[
-            'iframe_link'] = f"https://www.theartstory.org/data/content/dynamic_content/ai-card/movement/{new_movement_id}"
-        movement_data['name'] = main_element.findtext('name')
-        movement_data['years_developed'] = main_element.findtext('years')
-        movement_data['description'] = main_element.findtext('description')
-        movement_data['art_title'] = main_element.findtext('art_title')
-        movement_data['art_description'] = main_element.findtext('art_description')
-        movement_data['biography_highlights'] = re.sub(r'<.*?>', '',
-                                                       main_element.findtext(path='bio_highlight', default=''))
-        movement_data['content_publish_date'] = main_element.findtext('pub_time')
-
-    movement_data['quotes'] = [quote.text for quote in root.findall('.//quotes/q')]
-    movement_data['synopsis'] = re.sub(r'<.*?>', '', root.findtext(path='.//article/synopsys', default=''))
-    movement_data['key_ideas'] = [re.sub(r'<.*?>', '', idea.text) for idea in root.findall('.//idea')]
-
-    movement_data['sections'] = extract_sections(root)
-    movement_data['artworks'] = extract_artworks(root, movement_id)
-    movement_data['recommended_pages'] = extract_recommended_pages(root, "category[@name='art story website features']",
-                                                                   "subcategory[@name='not_to_show']")
-    movement_data['amazon_links'] = extract_recommended_books(root, "category[@name='featured books']", "subcategory")
-    movement_data['extra_links'] = extract_extra_links(root, 'resources')
-
-    return {movement_id: movement_data, "type": "movement", "id": movement_id}
-
-
-def extract_definition_xml(root: ET.Element) -> Dict:
-    definition_data = {}
-    definition_id = None
-
-    main_element = root.find('main')
-    if main_element is not None:
-        definition_id = main_element.findtext('id')
-        new_definition_id = re.sub('_', '-', definition_id)
-        definition_data['source_link'] = f"https://www.theartstory.org/definition/{new_definition_id}/"
-        definition_data[
-            'iframe_link'] = f"https://www.theartstory.org/data/content/dynamic_content/ai-card/definition/{new_definition_id}"
-        definition_data['name'] = main_element.findtext('name')
-        definition_data['start_date'] = main_element.findtext('start')
-        definition_data['content_publish_date'] = main_element.findtext('pub_time')
-
-    definition_data['quotes'] = [quote.text for quote in root.findall('.//quotes/q')]
-    definition_data['synopsis'] = re.sub(r'<.*?>', '', root.findtext(path='.//article/synopsys', default=''))
-    definition_data['key_ideas'] = [re.sub(r'<.*?>', '', idea.text) for idea in root.findall('.//idea')]
-
-    definition_data['sections'] = extract_sections(root)
-    definition_data['artworks'] = extract_artworks(root, definition_id)
-    definition_data['amazon_links'] = extract_recommended_books(root, "category[@name='featured books']",
-                                                                "subcategory")
-    definition_data['extra_links'] = extract_extra_links(root, "web resources")
-
-    return {definition_id: definition_data, "type": "definition", "id": definition_id}
-
-
-def extract_critic_xml(root: ET.Element) -> Dict:
-    critic_data = {}
-    critic_id = None
-    main_element = root.find('main')
-    if main_element is not None:
-        critic_id = main_element.findtext('id')
-        new_critic_id = re.sub('_', '-', critic_id)
-        critic_data['source_link'] = f"https://www.theartstory.org/critic/{new_critic_id}/"
-        critic_data[
-            'iframe_link'] = f"https://www.theartstory.org/data/content/dynamic_content/ai-card/critic/{new_critic_id}"
-        critic_data['name'] = main_element.findtext('name')
-        critic_data['years_worked'] = main_element.findtext('years')
-        critic_data['description'] = main_element.findtext('description')
-        critic_data['art_description'] = main_element.findtext('art_description')
-        critic_data['nationality'] = main_element.findtext('nationality')
-        critic_data['occupation'] = main_element.findtext('occupation')
-        critic_data['birth_date'] = main_element.findtext('birthDate')
-        critic_data['birth_place'] = main_element.findtext('birthPlace')
-        critic_data['death_date'] = main_element.findtext('deathDate')
-        critic_data['death_place'] = main_element.findtext('deathPlace')
-        critic_data['content_publish_date'] = main_element.findtext('pub_time')
-
-    critic_data['quotes'] = [quote.text for quote in root.findall('.//quotes/q')]
-    critic_data['synopsis'] = re.sub(r'<.*?>', '', root.findtext(path='.//article/synopsys', default=''))
-    critic_data['key_ideas'] = [re.sub(r'<.*?>', '', idea.text) for idea in root.findall('.//idea')]
-
-    critic_data['sections'] = extract_sections(root)
-    critic_data['artworks'] = extract_artworks(root, critic_id)
-    critic_data['recommended_pages'] = extract_recommended_pages(root, "category[@name='art story website']",
-                                                                 "subcategory")
-    critic_data['amazon_links'] = extract_recommended_books(root, "category[@name='featured books']", "subcategory")
-    critic_data['extra_links'] = extract_extra_links(root, 'web resources')
-
-    return {critic_id: critic_data, "type": "critic", "id": critic_id}
-
-
-def extract_influencer_data(root: ET.Element) -> Dict:
-    influencer_data = {}
-    influencer_id = None
-
-    main_element = root.find('main')
-    if main_element is not None:
-        influencer_id = main_element.findtext('id')
-        new_influencer_id = re.sub('_', '-', influencer_id)
-        influencer_data['source_link'] = f"https://www.theartstory.org/influencer/{new_influencer_id}/"
-        influencer_data[
-            'iframe_link'] = f"https://www.theartstory.org/data/content/dynamic_content/ai-card/influencer/{new_influencer_id}"
-        influencer_data['name'] = main_element.findtext('name')
-        influencer_data['years_worked'] = main_element.findtext('years')
-        influencer_data['description'] = main_element.findtext('description')
-        influencer_data['art_description'] = main_element.findtext('art_description')
-        influencer_data['nationality'] = main_element.findtext('nationality')
-        influencer_data['occupation'] = main_element.findtext('occupation')
-        influencer_data['birth_date'] = main_element.findtext('birthDate')
-        influencer_data['birth_place'] = main_element.findtext('birthPlace')
-        influencer_data['death_date'] = main_element.findtext('deathDate')
-        influencer_data['death_place'] = main_element.findtext('deathPlace')
-        influencer_data['content_publish_date'] = main_element.findtext('pub_time')
-
-    influencer_data['quotes'] = [quote.text for quote in root.findall('.//quotes/q')]
-    influencer_data['synopsis'] = re.sub(r'<.*?>', '', root.findtext(path='.//article/synopsys', default=''))
-    influencer_data['key_ideas'] = [re.sub(r'<.*?>', '', idea.text) for idea in root.findall('.//idea')]
-
-    influencer_data['sections'] = extract_sections(root)
-    influencer_data['artworks'] = extract_artworks(root, influencer_id)
-    influencer_data['recommended_books'] = extract_recommended_books(root, "category[@name='featured books']",
-                                                                     "subcategory[@name='written by artist']") + \
-                                           extract_recommended_books(root, "category[@name='featured books']",
-                                                                     "subcategory[@name='biography']")
-    influencer_data['extra_links'] = extract_extra_links(root, 'web resources')
-
-    return {influencer_id: influencer_data, "type": "influencer", "id": influencer_id}
-
-
-def extract_sections(root: ET.Element) -> List[Dict]:
-    sections_list = []
-    for section in root.iter('section'):
-        section_data = {
-            'title': section.get('title'),
-            'sub_sections': [
-                {
-                    'title': subsection.get('title'),
-                    'content': ' '.join(
-                        re.sub(r'<.*?>', '', ' '.join(p.itertext())).strip() for p in subsection.iter('p') if
-                        p.get('type') == 'p'),
-                    'url': [{'alt_name': p.get('alt'),
-                             'url': re.sub(r'<.*?>', '', f'https://www.theartstory.org{p.text}')} for p
-                            in subsection.iter('p') if p.get('type') == 'img']
-                }
-                for subsection in section.iter('subsection')
-            ]
-        }
-        sections_list.append(section_data)
-    return sections_list
-
-
-def extract_artworks(root: ET.Element, artist_id: str) -> List[Dict]:
-    artworks_list = []
-    for artworks in root.iter('artworks'):
-        for i, artwork in enumerate(artworks.iter('artwork')):
-            artwork_data = {
-                'title': artwork.find('title').text,
-                'year': artwork.find('year').text,
-                'materials': artwork.find('materials').text,
-                'description': re.sub(r'<.*?>', '', textwrap.dedent(artwork.find('desc').text)),
-                'collection': artwork.find('collection').text,
-                'url': f'https://www.theartstory.org/images20/works/{artist_id}_{i + 1}.jpg' if
-                artwork.find('use_big_image') is not None and bool(artwork.find('use_big_image').text) else
-                f'https://www.theartstory.org/images20/pnt/pnt_{artist_id}_{i + 1}.jpg'
-            }
-            artworks_list.append(artwork_data)
-    return artworks_list
-
-
-def extract_recommended_books(root: ET.Element, category: str, subcategory: str) -> List[Dict]:
-    amazon_links_list = []
-    for entry in root.findall(f".//{category}/{subcategory}/entry"):
-        book_data = {
-            'title': entry.findtext('title'),
-            'info': entry.findtext('info'),
-            'amazon_link': f"https://www.amazon.com/gp/product/{entry.findtext('link')}?tag=tharst-20"
-        }
-        amazon_links_list.append(book_data)
-    return amazon_links_list
-
-
-def extract_recommended_pages(root: ET.Element, category: str, subcategory: str) -> List[Dict]:
-    recommended_pages_list = []
-    for entry in root.findall(f".//{category}/{subcategory}/entry"):
-        page_data = {
-            'title': entry.findtext('title'),
-            'info': entry.findtext('info'),
-            'tas_link': f"https://www.theartstory.org{entry.findtext('link')}"
-        }
-        recommended_pages_list.append(page_data)
-    return recommended_pages_list
-
-
-def extract_extra_links(root: ET.Element, category_name: str) -> List[Dict]:
-    extra_links_list = []
-    for entry in root.findall(f'.//category[@name="{category_name}"]/subcategory/entry'):
-        link_data = {
-            'title': entry.findtext('title'),
-            'info': entry.findtext('info'),
-            'link': entry.findtext('link')
-        }
-        extra_links_list.append(link_data)
-    return extra_links_list
-
-
 ######################################################
 
 def lazy_load(dictionaries: List) -> Iterator[Document]:
@@ -324,69 +75,134 @@ def images_loader(dictionaries: List) -> Iterator[Document]:
 
 def iframe_loader(dictionaries: List) -> Iterator[Document]:
     for doc in dictionaries:
-        for val in doc.values():
+        for doc_id, val in doc.items():
             iframe_url = val['iframe_url']
             page_content = f"{json.dumps(iframe_url, indent=2)} {json.dumps(val['description'], indent=2)}"
-            yield Document(page_content=page_content, metadata={"source": iframe_url})
+            yield Document(page_content=page_content, metadata={"source": iframe_url, "doc_id": doc_id})
 
 
-def get_all_images():
-    data = []
-    for item in os.listdir(JSON_STORE_PATH):
+def read_json_documents(file_names: Iterable[str]) -> Iterator[Tuple[str, Dict]]:
+    for item in file_names:
         doc_id = item[:-5]
         file_path = os.path.join(JSON_STORE_PATH, item).replace("\\", "/")
-        with open(os.path.join(file_path), "r") as file:
-            js_data = json.load(file)
-            json_data = js_data[doc_id]
-            json_type = js_data['type']
-            if json_type == "artist":
-                url = f"https://www.theartstory.org/images20/ttip/{doc_id}.jpg"
-                title = doc_id.replace("_", " ")
-                alternate_title = " ".join(doc_id.split("_")[::-1])
-                description = json_data.get('description')
-                data.append({"title": title, "description": description.replace("\"", "'"),
-                             "alternate_title": alternate_title, "url": url, "id": doc_id})
-            sections = json_data.get('sections')
-            if sections:
-                for section in sections:
-                    sub_sections = section.get('sub_sections')
-                    for section_id in sub_sections:
-                        section_title = section_id.get('title')
-                        urls = section_id.get('url')
-                        description = section_id.get("content")
-                        if urls:
-                            for url in urls:
-                                data.append({"title": section_title, "description": description.replace("\"", "'"),
-                                             "alternate_title": url.get('alt_name'),
-                                             "url": url.get('url'), "id": doc_id})
-            artworks = json_data.get('artworks')
-            if artworks:
-                for artwork in artworks:
-                    artwork_title = artwork.get('title')
-                    artwork_alt_title = " ".join(artwork_title.split()[::-1]) if artwork_title else artwork_title
-                    description = artwork.get('description')
-                    artwork_url = artwork.get('url')
-                    data.append({"title": artwork_title, "description": description.replace("\"", "'"),
-                                 "alternate_title": artwork_alt_title,
-                                 "url": artwork_url, "id": doc_id})
-
-    with open("data/images.json", "w+") as file:
+        with open(file_path, "r") as file:
+            yield doc_id, json.load(file)
+
+
+def image_records(doc_id: str, js_data: Dict) -> List[Dict]:
+    """Entries of data/images.json for one JSON document."""
+    data = []
+    json_data = js_data[doc_id]
+    json_type = js_data['type']
+    if json_type == "artist":
+        url = f"https://www.theartstory.org/images20/ttip/{doc_id}.jpg"
+        title = doc_id.replace("_", " ")
+        alternate_title = " ".join(doc_id.split("_")[::-1])
+        description = json_data.get('description')
+        data.append({"title": title, "description": description.replace("\"", "'"),
+                     "alternate_title": alternate_title, "url": url, "id": doc_id})
+    sections = json_data.get('sections')
+    if sections:
+        for section in sections:
+            sub_sections = section.get('sub_sections')
+            for section_id in sub_sections:
+                section_title = section_id.get('title')
+                urls = section_id.get('url')
+                description = section_id.get("content")
+                if urls:
+                    for url in urls:
+                        data.append({"title": section_title, "description": description.replace("\"", "'"),
+                                     "alternate_title": url.get('alt_name'),
+                                     "url": url.get('url'), "id": doc_id})
+    artworks = json_data.get('artworks')
+    if artworks:
+        for artwork in artworks:
+            artwork_title = artwork.get('title')
+            artwork_alt_title = " ".join(artwork_title.split()[::-1]) if artwork_title else artwork_title
+            description = artwork.get('description')
+            artwork_url = artwork.get('url')
+            data.append({"title": artwork_title, "description": description.replace("\"", "'"),
+                         "alternate_title": artwork_alt_title,
+                         "url": artwork_url, "id": doc_id})
+    return data
+
+
+def iframe_records(doc_id: str, js_data: Dict) -> List[Dict]:
+    """Entries of data/iframe.json for one JSON document."""
+    json_data = js_data[doc_id]
+    return [{doc_id: {"iframe_url": json_data['iframe_link'], "description": json_data['synopsis']}}]
+
+
+def get_all_images():
+    data = [record for doc_id, js_data in read_json_documents(os.listdir(JSON_STORE_PATH))
+            for record in image_records(doc_id, js_data)]
+    with open(IMAGES_JSON_PATH, "w+") as file:
         file.write(json.dumps(data))
 
 
 def get_iframe_images():
-    data = []
-    for item in os.listdir(JSON_STORE_PATH):
-        doc_id = item[:-5]
-        file_path = os.path.join(JSON_STORE_PATH, item).replace("\\", "/")
-        with open(os.path.join(file_path), "r") as file:
-            js_data = json.load(file)
-            json_data = js_data[doc_id]
-            data.append({doc_id: {"iframe_url": json_data['iframe_link'], "description": json_data['synopsis']}})
-    with open("data/iframe.json", "w+") as file:
+    data = [record for doc_id, js_data in read_json_documents(os.listdir(JSON_STORE_PATH))
+            for record in iframe_records(doc_id, js_data)]
+    with open(IFRAME_JSON_PATH, "w+") as file:
         file.write(json.dumps(data))
 
 
+def update_media_vector_store(store_path: str, records_path: str, make_records: Callable[[str, Dict], List[Dict]],
+                              record_doc_id: Callable[[Dict], str], build_store: Callable[[List[Dict]], FAISS],
+                              changed_ids: Set[str], deleted_ids: Set[str]) -> None:
+    """
+    Remove the vectors of changed and deleted documents from an image or iframe store and add the vectors of
+    added and changed ones, instead of rebuilding the whole store.
+    - Vectors are matched to their document by their doc_id metadata, the records file by ``record_doc_id``.
+    - Stores that don't exist yet are left to their own full refresh, stores built before vectors had a
+      doc_id are rebuilt once.
+    """
+    store = VersionedStore(store_path)
+    affected_ids = changed_ids | deleted_ids
+    if not affected_ids or not store.exists():
+        return
+
+    start_time = time.time()
+    vector_store = store.load(CachedEmbeddings(EmbeddingScheduler(), EmbeddingCache(EMBEDDING_CACHE_PATH)))
+    documents = vector_store.docstore._dict
+    if any("doc_id" not in document.metadata for document in documents.values()):
+        print(f"{store_path} has vectors without doc_id, rebuilding it.")
+        records = [record for doc_id, js_data in read_json_documents(os.listdir(JSON_STORE_PATH))
+                   for record in make_records(doc_id, js_data)]
+        vector_store = build_store(records)
+        stale_ids, new_records = list(documents), records
+    else:
+        stale_ids = [k_id for k_id, document in documents.items() if document.metadata["doc_id"] in affected_ids]
+        new_records = [record for doc_id, js_data in read_json_documents(f"{doc_id}.json" for doc_id in
+                                                                          sorted(changed_ids))
+                       for record in make_records(doc_id, js_data)]
+        if stale_ids:
+            vector_store.delete(stale_ids)
+        if new_records:
+            vector_store.merge_from(build_store(new_records))
+        records = None
+        if os.path.exists(records_path):
+            with open(records_path) as file:
+                records = [record for record in json.load(file) if record_doc_id(record) not in affected_ids]
+            records += new_records
+    store.publish(vector_store)
+    if records is not None:
+        with open(records_path, "w+") as file:
+            file.write(json.dumps(records))
+    print(f"Updated {store_path} for {len(affected_ids)} documents: {len(stale_ids)} vectors removed, "
+          f"{len(new_records)} records added in {time.time() - start_time:.2f} seconds.")
+
+
+def update_media_vector_stores(changed_files: Set[str], deleted_files: Set[str]) -> None:
+    """Bring the image and iframe stores in line with the added, changed and deleted JSON files of a refresh."""
+    changed_ids = {file_name[:-5] for file_name in changed_files}
+    deleted_ids = {file_name[:-5] for file_name in deleted_files}
+    update_media_vector_store(IMAGE_STORE_PATH, IMAGES_JSON_PATH, image_records, lambda record: record["id"],
+                              get_image_vector_store, changed_ids, deleted_ids)
+    update_media_vector_store(IFRAME_STORE_PATH, IFRAME_JSON_PATH, iframe_records, lambda record: next(iter(record)),
+                              get_iframe_vector_store, changed_ids, deleted_ids)
+
+
 def create_json_file(file_name, content):
     try:
         file_path = os.path.join(JSON_STORE_PATH, file_name).replace("\\", "/")
@@ -397,209 +213,211 @@ def create_json_file(file_name, content):
         print(f"An error occurred: {e}")
 
 
-def create_partial_local_database(vector_store):
-    deleted_ids = []
-    added_data = []
+def create_partial_local_database(vector_store, crawler: XmlCrawler = None, sitemap_url: str = SITEMAP_URL):
+    crawler = crawler or XmlCrawler(cache=HttpCache())
+    actual_data: List[Dict] = create_local_database(sitemap_url, crawler, skip_unchanged=True)
+    unchanged_file_names = {get_json_file_name(url) for url in crawler.unchanged}
+    # A page that failed to fetch (e.g. a timeout or a 5xx) may well still exist, it keeps its previous content
+    failed_file_names = {get_json_file_name(url) for url in crawler.failed}
 
-    actual_data: List[Dict] = create_local_database()
-    expected_data: List[Dict] = []
-    for file in os.listdir(JSON_STORE_PATH):
-        file_name = os.path.join(JSON_STORE_PATH, file).replace("\\", "/")
-        with open(file_name, 'w+') as f:
-            expected_data.append(json.load(f))
+    previous_manifest = load_manifest(MANIFEST_PATH, JSON_STORE_PATH)
+    current_manifest = build_manifest(actual_data)
+    added_files, changed_files, deleted_files = diff_manifest(previous_manifest, current_manifest,
+                                                              unchanged_file_names, failed_file_names)
+    print(f"Partial refresh: {len(added_files)} added, {len(changed_files)} changed, "
+          f"{len(deleted_files)} deleted files, {len(failed_file_names)} files kept as they were after a "
+          f"failed fetch.")
 
-    # Check for deleted files
-    actual_file_names = {item.get("json_file") for item in actual_data}
-    expected_file_names = {item.get("json_file") for item in expected_data}
+    # Chunks of changed and deleted files are removed, changed files are then embedded again like added ones.
+    # Files sharing a deduplicated chunk with them are rebuilt too, their vectors come from the embedding cache.
+    rebuilt_files, deleted_ids = expand_shared_chunks(vector_store, changed_files | deleted_files)
+    shared_files = rebuilt_files - changed_files - deleted_files
 
-    files_to_delete = expected_file_names - actual_file_names
-    for file_name in files_to_delete:
+    for file_name in deleted_files:
         file_path = os.path.join(JSON_STORE_PATH, file_name).replace("\\", "/")
         if os.path.exists(file_path):
             os.remove(file_path)
 
-        for k_id, values in vector_store.docstore._dict.items():
-            if file_name == values.metadata['json_file']:
-                deleted_ids.append(k_id)
-
-    # Check for added or changed files
-    for item in actual_data:
-        json_file = item.get("json_file")
-        file_path = os.path.join(JSON_STORE_PATH, json_file).replace("\\", "/")
-        if item not in expected_data:
-            with open(file_path, 'w+') as f:
-                json.dump(item, f, indent=4)
-            added_data.append(item)
-        else:
-            expected_item = next((exp_item for exp_item in expected_data if exp_item['json_file'] == json_file), None)
-            if expected_item and expected_item != item:
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                with open(file_path, 'w+') as f:
-                    json.dump(item, f, indent=4)
-                added_data.append(item)
-
-                for k_id, values in vector_store.docstore._dict.items():
-                    if json_file == values.metadata['json_file']:
-                        deleted_ids.append(k_id)
+    added_data = [item for item in actual_data if item['json_file'] in added_files | changed_files]
+    for item in added_data:
+        create_json_file(item['json_file'], item)
+    for file_name in shared_files:
+        with open(os.path.join(JSON_STORE_PATH, file_name), 'r') as f:
+            added_data.append(json.load(f))
 
     if deleted_ids:
         vector_store.delete(deleted_ids)
 
     if added_data:
-        new_vector_store = get_vector_store(added_data)
-        vector_store.merge_from(new_vector_store)
-        vector_store.save_local(VECTOR_STORE_PATH)
-
+        # New chunks are deduplicated against the ones kept in the index too
+        new_vector_store = get_vector_store(added_data, list(vector_store.docstore._dict.values()))
+        if new_vector_store is not None:
+            vector_store.merge_from(new_vector_store)
+
+    if deleted_ids or added_data:
+        VersionedStore(VECTOR_STORE_PATH).publish(vector_store)
+    update_media_vector_stores(added_files | changed_files, deleted_files)
+
+    new_manifest = {name: digest for name, digest in previous_manifest.items() if name not in deleted_files}
+    new_manifest.update(current_manifest)
+    save_manifest(new_manifest, MANIFEST_PATH)
+    if crawler.cache:
+        crawler.cache.save()
     return vector_store
 
 
-def create_local_database() -> List[Dict]:
-    data_dict = get_xml_files()
-
-    final_data = []
-    for key, values in data_dict.items():
-        for value in values:
-            root = fetch_and_parse_xml(value)
-            if root is not None:
-                inner_dict = {}
-                if key == 'artist':
-                    inner_dict = extract_artist_data(root)
-                elif key == 'critic':
-                    inner_dict = extract_critic_xml(root)
-                elif key == 'definition':
-                    inner_dict = extract_definition_xml(root)
-                elif key == 'influencer':
-                    inner_dict = extract_influencer_data(root)
-                elif key == 'movement':
-                    inner_dict = extract_movement_data(root)
-                file_name = f"{os.path.basename(value)[:-4]}.json"
-                inner_dict['json_file'] = file_name
-                inner_dict['xml_file'] = value
-                final_data.append(inner_dict)
-    return final_data
-
-
-def get_vector_store(data: List[Dict]):
-    embeddings = OpenAIEmbeddings()
+def extract_xml_data(key: str, root: ET.Element) -> Dict:
+    if key in CONTENT_SPECS:
+        return extract_document(key, root)
+    return {}
+
+
+def get_json_file_name(xml_url: str) -> str:
+    return f"{os.path.basename(xml_url)[:-4]}.json"
+
+
+def extract_page(key: str, content: bytes) -> Dict:
+    """Parse and extract one raw XML page, runs in the extraction worker processes."""
+    return extract_xml_data(key, ET.fromstring(content))
+
+
+def create_local_database(sitemap_url: str = SITEMAP_URL, crawler: XmlCrawler = None,
+                          skip_unchanged: bool = False, extractor: ParallelExtractor = None,
+                          on_extracted: Callable[[Dict], None] = None) -> List[Dict]:
+    """
+    Crawl every XML page listed in the sitemap and extract it.
+    Pages are handed to the ``extractor`` process pool as soon as they are fetched, ``on_extracted`` is called
+    with every document as it comes back (e.g. to write its JSON file).
+    With ``skip_unchanged``, pages the crawler's cache reports as unchanged upstream are neither parsed nor
+    returned (as long as their JSON file still exists), callers find them in ``crawler.unchanged``.
+    """
+    crawler = crawler or XmlCrawler(cache=HttpCache())
+    extractor = extractor or ParallelExtractor(extract_page)
+    skipped = 0
+
+    def fetched_pages(url_keys: Dict[str, str]):
+        nonlocal skipped
+        for value, content in crawler.fetch_all(url_keys):
+            if content is None:
+                continue
+            if skip_unchanged and value in crawler.unchanged and \
+                    os.path.exists(os.path.join(JSON_STORE_PATH, get_json_file_name(value))):
+                skipped += 1
+                continue
+            yield value, url_keys[value], content
+
+    with crawler:
+        data_dict = get_xml_files(sitemap_url, crawler.session)
+        url_keys = {value: key for key, values in data_dict.items() for value in values}
+
+        start_time = time.time()
+        extracted = {}
+        for value, inner_dict in extractor.map(fetched_pages(url_keys)):
+            inner_dict['json_file'] = get_json_file_name(value)
+            inner_dict['xml_file'] = value
+            extracted[value] = inner_dict
+            if on_extracted:
+                on_extracted(inner_dict)
+
+    print(f"Refresh fetched {crawler.stats['fetched']} pages, {crawler.stats['not_modified']} not modified, "
+          f"{crawler.stats['failed']} failed, {skipped} unchanged pages skipped, {len(extracted)} extracted with "
+          f"{extractor.workers} workers in {time.time() - start_time:.1f} seconds.")
+    # Pages complete out of order, return them in the order get_xml_files listed them
+    return [extracted[value] for value in url_keys if value in extracted]
+
+
+def build_vector_store(split_docs: List[Document]):
+    """Build a FAISS index, only sending chunks to the embeddings API when their text isn't cached yet."""
+    embeddings = CachedEmbeddings(EmbeddingScheduler(), EmbeddingCache(EMBEDDING_CACHE_PATH))
+    start_time = time.time()
+    vector_store = FAISS.from_documents(split_docs, embeddings)
+    report = embeddings.report()
+    print(f"Indexed {len(split_docs)} chunks in {time.time() - start_time:.1f} seconds, "
+          f"{report['hit_rate']:.1%} embedding cache hits, ~{report['estimated_seconds_saved']:.1f} seconds saved.")
+    return vector_store
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000,
-        chunk_overlap=400,
-        length_function=len
-    )
-    split_docs = text_splitter.split_documents(lazy_load(data))
-    return FAISS.from_documents(split_docs, embeddings)
 
+def get_vector_store(data: List[Dict], stored: List[Document] = ()):
+    """
+    Chunk, deduplicate and embed ``data``. Chunks duplicating one of the ``stored`` chunks are credited to it
+    instead, returns None when nothing is left to embed.
+    """
+    deduplicator = ChunkDeduplicator()
+    split_docs = deduplicator.deduplicate(list(StructuredChunker().load(data)), stored)
+    vector_store = build_vector_store(split_docs) if split_docs else None
+    stats = deduplicator.stats
+    saved_chunks = stats['chunks'] - stats['unique_chunks']
+    index_bytes = f" and ~{saved_chunks * vector_store.index.d * 4} bytes of index" if vector_store else ""
+    print(f"Deduplicated {stats['chunks']} chunks into {stats['unique_chunks']} ({stats['exact_duplicates']} exact, "
+          f"{stats['near_duplicates']} near duplicates), saving {stats['chars_saved']} characters{index_bytes}.")
+    return vector_store
 
-def get_image_vector_store(data: List[Dict]):
-    embeddings = OpenAIEmbeddings()
 
+def get_image_vector_store(data: List[Dict]):
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
         chunk_overlap=400,
         length_function=len
     )
     split_docs = text_splitter.split_documents(images_loader(data))
-    return FAISS.from_documents(split_docs, embeddings)
+    return build_vector_store(split_docs)
 
 
 def get_iframe_vector_store(data: List[Dict]):
-    embeddings = OpenAIEmbeddings()
-
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=1000,
         chunk_overlap=400,
         length_function=len
     )
     split_docs = text_splitter.split_documents(iframe_loader(data))
-    return FAISS.from_documents(split_docs, embeddings)
+    return build_vector_store(split_docs)
 
 
 def create_local_vector_store() -> None:
-    if os.path.exists(VECTOR_STORE_PATH):
-        shutil.rmtree(VECTOR_STORE_PATH)
-
     if not os.path.exists(JSON_STORE_PATH):
         os.makedirs(JSON_STORE_PATH, exist_ok=True)
 
-    final_data = create_local_database()
-
-    for inner_dict in final_data:
-        create_json_file(inner_dict['json_file'], inner_dict)
+    http_cache = HttpCache()
+    final_data = create_local_database(crawler=XmlCrawler(cache=http_cache),
+                                       on_extracted=lambda inner_dict: create_json_file(inner_dict['json_file'],
+                                                                                        inner_dict))
 
     vector_store = get_vector_store(final_data)
-    vector_store.save_local(VECTOR_STORE_PATH)
+    VersionedStore(VECTOR_STORE_PATH).publish(vector_store)
+    save_manifest(build_manifest(final_data), MANIFEST_PATH)
+    http_cache.save()
 
 
-def create_image_vector_store() -> None:
-    if os.path.exists(IMAGE_STORE_PATH):
-        shutil.rmtree(IMAGE_STORE_PATH)
+def refresh_local_vector_store() -> None:
+    """Partial refresh of the local vector store, only the pages that changed upstream are embedded again."""
+    vector_store = VersionedStore(VECTOR_STORE_PATH).load(OpenAIEmbeddings())
+    create_partial_local_database(vector_store)
 
-    if not os.path.exists(IMAGE_STORE_PATH):
-        os.makedirs(IMAGE_STORE_PATH, exist_ok=True)
 
-    with open("data/images.json") as file:
+def create_image_vector_store() -> None:
+    with open(IMAGES_JSON_PATH) as file:
         final_data = json.load(file)
 
     vector_store = get_image_vector_store(final_data)
-    vector_store.save_local(IMAGE_STORE_PATH)
+    VersionedStore(IMAGE_STORE_PATH).publish(vector_store)
 
 
 def create_iframe_vector_store() -> None:
-    if os.path.exists(IFRAME_STORE_PATH):
-        shutil.rmtree(IFRAME_STORE_PATH)
-
-    if not os.path.exists(IFRAME_STORE_PATH):
-        os.makedirs(IFRAME_STORE_PATH, exist_ok=True)
-
-    with open("data/iframe.json") as file:
+    with open(IFRAME_JSON_PATH) as file:
         final_data = json.load(file)
 
     vector_store = get_iframe_vector_store(final_data)
-    vector_store.save_local(IFRAME_STORE_PATH)
-
+    VersionedStore(IFRAME_STORE_PATH).publish(vector_store)
 
-def delete_merged_vector(bucket_name="tas-website-data"):
-    # Instantiates a client
-    client = storage.Client()
 
-    # Get the bucket
-    bucket = client.bucket(bucket_name)
-
-    # List all blobs in the folder
-    blobs = bucket.list_blobs(prefix=VECTOR_STORE_PATH)
-
-    # Delete each blob in the folder
-    for blob in blobs:
-        blob.delete()
-
-    return f"Folder '{VECTOR_STORE_PATH}' deleted successfully."
-
-
-def upload_merged_vector(bucket_name="tas-website-data"):
-    # Instantiates a client
-    client = storage.Client()
-    # Get the bucket
-    bucket = client.bucket(bucket_name)
-
-    # Creating a Folder in Bucket
-    bucket.blob(VECTOR_STORE_PATH)
-
-    # List all files in the local folder
-    local_files = os.listdir(VECTOR_STORE_PATH)
-
-    # Upload each file to the cloud folder
-    for local_file in local_files:
-        local_file_path = os.path.join(VECTOR_STORE_PATH, local_file)
-        cloud_file_path = os.path.join(VECTOR_STORE_PATH, local_file)
-
-        cloud_file_path = cloud_file_path.replace("\\", "/")
-
-        blob = bucket.blob(cloud_file_path)
-        blob.upload_from_filename(local_file_path)
-
-        print(f"File {local_file} uploaded to {cloud_file_path}.")
+def upload_merged_vector(bucket_name=BUCKET_NAME):
+    """
+    Upload the current local version of the vector store and point the bucket at it.
+    Readers keep the previous version until the upload is complete, files already in the bucket are skipped.
+    """
+    sync = ArtifactSync(GcsBackend(bucket_name), VECTOR_STORE_PATH)
+    sync.push(VersionedStore(VECTOR_STORE_PATH))
+    print(f"Vector store synced to {bucket_name}/{sync.prefix}: {sync.stats}")
 
 
 if __name__ == '__main__':
@@ -613,9 +431,7 @@ if __name__ == '__main__':
     if vector_update_status == "initial_cloud_refresh":
         # creating local vector store
         create_local_vector_store()
-        # deleting vector store from cloud
-        delete_merged_vector()
-        # uploading vector store from local to cloud
+        # uploading vector store from local to cloud, the previous cloud version stays until it is replaced
         upload_merged_vector()
     elif vector_update_status == "local_refresh":
         # It would take approximate 40 minutes to generate new vector store for whole xml files
@@ -625,13 +441,14 @@ if __name__ == '__main__':
         # check if there is any change happened in xml files
         embeddings = OpenAIEmbeddings()
         vectorstore = None
-        if os.path.exists(VECTOR_STORE_PATH):
-            vectorstore = FAISS.load_local(VECTOR_STORE_PATH, embeddings, allow_dangerous_deserialization=True)
+        if VersionedStore(VECTOR_STORE_PATH).exists():
+            vectorstore = VersionedStore(VECTOR_STORE_PATH).load(embeddings)
         else:
             raise ValueError("data/vector_store should exists")
         create_partial_local_database(vectorstore)
         # add or remove json file based on changes
         # if changes happened then please update the vector store
+        upload_merged_vector()
     elif vector_update_status == "iframe_vector_refresh":
         get_iframe_images()
         create_iframe_vector_store()
@@ -0,0 +1,133 @@
+"""
+Compare the legacy JSON-dump chunking with the structure-aware chunker.
+
+Reports chunk count, text size, FAISS index size on disk and retrieval quality (hit@k and MRR of the right
+document for queries taken from each document's key ideas and artworks).
+
+    python -m benchmarks.chunking                       # offline, hashing bag-of-words embeddings
+    python -m benchmarks.chunking --openai --json-dir data/json_files/
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import tempfile
+import xml.etree.ElementTree as ET
+from typing import Dict, List
+
+import numpy as np
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+from langchain_core.embeddings import Embeddings
+
+from ats_refresh import lazy_load, extract_xml_data, get_json_file_name
+from refresh import StructuredChunker
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_fixtures")
+
+
+class HashingEmbeddings(Embeddings):
+    """Offline bag-of-words embeddings, good enough to compare chunking strategies against each other."""
+
+    def __init__(self, size: int = 512):
+        self.size = size
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.zeros(self.size, dtype=np.float32)
+        for word in re.findall(r"[a-z0-9]+", text.lower()):
+            vector[int(hashlib.md5(word.encode()).hexdigest(), 16) % self.size] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+
+def load_documents(json_dir: str = None) -> List[Dict]:
+    documents = []
+    if json_dir:
+        for file in sorted(os.listdir(json_dir)):
+            with open(os.path.join(json_dir, file)) as f:
+                documents.append(json.load(f))
+        return documents
+
+    content_path = os.path.join(FIXTURES_PATH, "data", "content")
+    for doc_type in sorted(os.listdir(content_path)):
+        for file in sorted(os.listdir(os.path.join(content_path, doc_type))):
+            document = extract_xml_data(doc_type, ET.parse(os.path.join(content_path, doc_type, file)).getroot())
+            document['json_file'] = get_json_file_name(file)
+            document['xml_file'] = file
+            documents.append(document)
+    return documents
+
+
+def legacy_chunks(documents: List[Dict]):
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=400, length_function=len)
+    return text_splitter.split_documents(lazy_load(documents))
+
+
+def structured_chunks(documents: List[Dict]):
+    return list(StructuredChunker().load(documents))
+
+
+def build_queries(documents: List[Dict]) -> List[tuple]:
+    queries = []
+    for document in documents:
+        data = document[document['id']]
+        for idea in data.get('key_ideas') or []:
+            queries.append((idea, document['id']))
+        for artwork in data.get('artworks') or []:
+            queries.append((f"Tell me about {artwork.get('title')}", document['id']))
+    return queries
+
+
+def index_size(vector_store) -> int:
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vector_store.save_local(temp_dir)
+        return sum(os.path.getsize(os.path.join(temp_dir, file)) for file in os.listdir(temp_dir))
+
+
+def evaluate(name: str, chunks, embeddings: Embeddings, queries: List[tuple], k: int) -> Dict:
+    vector_store = FAISS.from_documents(chunks, embeddings)
+    hits, reciprocal_ranks, context_chars = 0, 0.0, 0
+    for query, expected_id in queries:
+        docs = vector_store.similarity_search_by_vector(embeddings.embed_query(query), k)
+        context_chars += sum(len(doc.page_content) for doc in docs)
+        ids = [doc.metadata['id'] for doc in docs]
+        if expected_id in ids:
+            hits += 1
+            reciprocal_ranks += 1 / (ids.index(expected_id) + 1)
+    return {
+        "strategy": name,
+        "chunks": len(chunks),
+        "chunk_chars": sum(len(chunk.page_content) for chunk in chunks),
+        "index_bytes": index_size(vector_store),
+        f"hit@{k}": hits / len(queries) if queries else 0.0,
+        "mrr": reciprocal_ranks / len(queries) if queries else 0.0,
+        "avg_context_chars": context_chars / len(queries) if queries else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--json-dir", help="directory of extracted JSON documents, defaults to the test fixtures")
+    parser.add_argument("--openai", action="store_true", help="use OpenAI embeddings instead of hashing ones")
+    parser.add_argument("-k", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.openai:
+        from langchain_openai import OpenAIEmbeddings
+        embeddings = OpenAIEmbeddings()
+    else:
+        embeddings = HashingEmbeddings()
+
+    documents = load_documents(args.json_dir)
+    queries = build_queries(documents)
+    print(f"{len(documents)} documents, {len(queries)} queries")
+    for name, chunker in (("json_dump", legacy_chunks), ("structured", structured_chunks)):
+        print(evaluate(name, chunker(documents), embeddings, queries, args.k))
+
+
+if __name__ == '__main__':
+    main()
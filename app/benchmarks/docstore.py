@@ -0,0 +1,85 @@
+"""
+Compare the pickled docstore (index.pkl) with the columnar one (index.docstore).
+
+A store of --chunks documents shaped like StructuredChunker output is saved and converted. Each format is then
+loaded in a fresh process, which reports the load time, the RSS it added (and the private part of it, the
+mapped file is shared between processes) and the time of --lookups random lookups by id.
+
+    python -m benchmarks.docstore
+    python -m benchmarks.docstore --chunks 100000
+"""
+import argparse
+import multiprocessing
+import os
+import pickle
+import random
+import tempfile
+import time
+
+import numpy as np
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from stores import convert_docstore, open_columnar_docstore
+
+WORDS = "the painter light colour canvas movement modern abstract figure landscape portrait museum".split()
+
+
+def memory_kb() -> dict:
+    with open("/proc/self/status") as f:
+        return {line.split(":")[0]: int(line.split()[1]) for line in f if line.startswith(("VmRSS", "RssAnon"))}
+
+
+def load(path: str, columnar: bool, lookups: int, results) -> None:
+    before = memory_kb()
+    start_time = time.perf_counter()
+    if columnar:
+        docstore, index_to_docstore_id = open_columnar_docstore(path)
+    else:
+        with open(os.path.join(path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    load_seconds = time.perf_counter() - start_time
+    rows = random.Random(0).choices(range(len(index_to_docstore_id)), k=lookups)
+    start_time = time.perf_counter()
+    for row in rows:
+        docstore.search(index_to_docstore_id[row])
+    after = memory_kb()
+    results.put({"format": "columnar" if columnar else "pickle", "load_ms": round(load_seconds * 1000, 1),
+                 "rss_added_mb": round((after["VmRSS"] - before["VmRSS"]) / 1024, 1),
+                 "private_added_mb": round((after["RssAnon"] - before["RssAnon"]) / 1024, 1),
+                 "lookup_us": round((time.perf_counter() - start_time) / lookups * 10 ** 6, 1)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=50000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    documents = [Document(page_content=" ".join(rng.choices(WORDS, k=120)),
+                          metadata={"source": "artist", "id": f"artist_{i // 20}",
+                                    "json_file": f"artist_{i // 20}.json", "xml_file": f"artist_{i // 20}.xml",
+                                    "field": "sections", "section": "Biography", "sub_section": "Early Years"})
+                 for i in range(args.chunks)]
+    vectors = np.random.rand(args.chunks, 8).astype("float32")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        FAISS.from_embeddings(zip([document.page_content for document in documents], vectors),
+                              DeterministicFakeEmbedding(size=8),
+                              metadatas=[document.metadata for document in documents]).save_local(temp_dir)
+        convert_docstore(temp_dir)
+        sizes = {file: round(os.path.getsize(os.path.join(temp_dir, file)) / 2 ** 20, 1)
+                 for file in ("index.pkl", "index.docstore")}
+        print({"chunks": args.chunks, "pickle_mb": sizes["index.pkl"], "columnar_mb": sizes["index.docstore"]})
+        context = multiprocessing.get_context("spawn")
+        for columnar in (False, True):
+            results = context.Queue()
+            process = context.Process(target=load, args=(temp_dir, columnar, args.lookups, results))
+            process.start()
+            print(results.get())
+            process.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""
+Measure how XML extraction scales with the number of worker processes.
+
+The fixture pages (or the XML files of --xml-dir, named <type>/<name>.xml) are repeated until there are
+--documents pages, then extracted with ParallelExtractor for every worker count.
+
+    python -m benchmarks.extraction
+    python -m benchmarks.extraction --workers 1 2 4 8 16 --documents 5000
+"""
+import argparse
+import os
+import time
+from typing import List, Tuple
+
+from ats_refresh import extract_page
+from refresh import ParallelExtractor
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_fixtures")
+
+
+def load_pages(xml_dir: str = None) -> List[Tuple[str, str, bytes]]:
+    content_path = xml_dir or os.path.join(FIXTURES_PATH, "data", "content")
+    pages = []
+    for doc_type in sorted(os.listdir(content_path)):
+        for file in sorted(os.listdir(os.path.join(content_path, doc_type))):
+            with open(os.path.join(content_path, doc_type, file), "rb") as f:
+                pages.append((file, doc_type, f.read()))
+    return pages
+
+
+def run(pages: List[Tuple[str, str, bytes]], workers: int) -> float:
+    extractor = ParallelExtractor(extract_page, workers=workers, progress_every=10 ** 9)
+    start_time = time.perf_counter()
+    count = sum(1 for _ in extractor.map((f"{i}/{url}", key, content) for i, (url, key, content) in enumerate(pages)))
+    return count / (time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--xml-dir", help="directory of <type>/<name>.xml pages, defaults to the test fixtures")
+    parser.add_argument("--documents", type=int, default=3000)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    sample = load_pages(args.xml_dir)
+    pages = (sample * (args.documents // len(sample) + 1))[:args.documents]
+    print(f"{len(pages)} pages, {os.cpu_count()} cores available")
+
+    baseline = None
+    for workers in args.workers:
+        docs_per_second = run(pages, workers)
+        baseline = baseline or docs_per_second
+        print({"workers": workers, "docs_per_sec": round(docs_per_second, 1),
+               "speedup": round(docs_per_second / baseline, 2)})
+
+
+if __name__ == "__main__":
+    main()
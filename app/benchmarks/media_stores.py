@@ -0,0 +1,90 @@
+"""
+Compare rebuilding the image and iframe stores from scratch with updating them for a one document change.
+
+The fixture pages are extracted and their JSON documents copied under new ids until there are --documents of
+them. Embeddings are deterministic fakes, so the timings leave out the embeddings API: the number of texts
+each mode sends to it is reported next to them.
+
+    python -m benchmarks.media_stores
+    python -m benchmarks.media_stores --documents 5000
+"""
+import argparse
+import copy
+import json
+import os
+import tempfile
+import time
+
+from langchain_community.embeddings import DeterministicFakeEmbedding
+
+import ats_refresh
+from ats_refresh import extract_page
+from benchmarks.extraction import load_pages
+
+
+class CountingEmbeddings(DeterministicFakeEmbedding):
+    texts: int = 0
+
+    def embed_documents(self, texts):
+        CountingEmbeddings.texts += len(texts)
+        return super().embed_documents(texts)
+
+
+def write_documents(count: int) -> None:
+    sample = [extract_page(key, content) for _, key, content in load_pages()]
+    os.makedirs(ats_refresh.JSON_STORE_PATH)
+    for i in range(count):
+        item = copy.deepcopy(sample[i % len(sample)])
+        doc_id = f"{item['id']}_{i}"
+        item[doc_id] = item.pop(item["id"])
+        item["id"], item["json_file"] = doc_id, f"{doc_id}.json"
+        with open(os.path.join(ats_refresh.JSON_STORE_PATH, item["json_file"]), "w") as f:
+            json.dump(item, f)
+
+
+def full_rebuild() -> None:
+    ats_refresh.get_all_images()
+    ats_refresh.get_iframe_images()
+    ats_refresh.create_image_vector_store()
+    ats_refresh.create_iframe_vector_store()
+
+
+def timed(function, *args) -> dict:
+    CountingEmbeddings.texts = 0
+    start_time = time.perf_counter()
+    function(*args)
+    return {"seconds": round(time.perf_counter() - start_time, 3), "embedded_texts": CountingEmbeddings.texts}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        ats_refresh.JSON_STORE_PATH = os.path.join(temp_dir, "json_files")
+        ats_refresh.IMAGE_STORE_PATH = os.path.join(temp_dir, "image_vector")
+        ats_refresh.IFRAME_STORE_PATH = os.path.join(temp_dir, "iframe_store")
+        ats_refresh.IMAGES_JSON_PATH = os.path.join(temp_dir, "images.json")
+        ats_refresh.IFRAME_JSON_PATH = os.path.join(temp_dir, "iframe.json")
+        ats_refresh.EmbeddingScheduler = lambda: CountingEmbeddings(size=1536)
+        write_documents(args.documents)
+
+        # Cold, then warm embedding cache: the warm rebuild is what a full refresh costs after the first one
+        ats_refresh.EMBEDDING_CACHE_PATH = os.path.join(temp_dir, "embeddings.sqlite")
+        print({"mode": "full_rebuild_cold_cache", **timed(full_rebuild)})
+        print({"mode": "full_rebuild_warm_cache", **timed(full_rebuild)})
+
+        changed = sorted(os.listdir(ats_refresh.JSON_STORE_PATH))[0]
+        file_path = os.path.join(ats_refresh.JSON_STORE_PATH, changed)
+        with open(file_path) as f:
+            item = json.load(f)
+        item[item["id"]]["synopsis"] += " Edited."
+        with open(file_path, "w") as f:
+            json.dump(item, f)
+        print({"mode": "one_document_update", "documents": args.documents,
+               **timed(ats_refresh.update_media_vector_stores, {changed}, set())})
+
+
+if __name__ == "__main__":
+    main()
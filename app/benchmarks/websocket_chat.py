@@ -0,0 +1,133 @@
+"""
+Compare a chat turn over HTTP with the same turn over the /ws websocket.
+
+A turn is what the frontend does for every question: stream /generate_response, then look the answer up with
+/get_iframe, /get_source, /get_artist_img and /get_heading_image. The app runs in uvicorn in this process, the
+generation (--tokens frames) and the heading image vector lookup are stubs, so what is measured is the transport
+and the entity lookups, which are real. Every flow runs --turns turns, one after the other:
+- http_new_connections: a new connection for every request, as without keep-alive.
+- http_keep_alive: one client reusing its connections, the lookups sent one after the other.
+- websocket: one connection, the lookups of a turn sent together.
+The connection overhead is the time to open a connection and get an answer to a first tiny message.
+
+    python -m benchmarks.websocket_chat
+    python -m benchmarks.websocket_chat --turns 50 --tokens 200
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import httpx
+import uvicorn
+from websockets.sync.client import connect
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUERY = {"query": "%info%You are an expert in Arts.% %query%Who was Claude Monet?% %instructions%short%",
+         "responseLength": "short", "session_id": "benchmark"}
+ANSWER = "Claude Monet founded Impressionism with Pierre-Auguste Renoir, he painted Water Lilies at Giverny. "
+LOOKUPS = {"iframe": ("/get_iframe", {"query": ANSWER}), "source": ("/get_source", {"query": ANSWER}),
+           "artist_img": ("/get_artist_img", {"query": ANSWER}),
+           "heading_image": ("/get_heading_image", {"heading_text": "Impressionism"})}
+
+
+def start_server(tokens: int) -> str:
+    import main
+    from routers import chat
+
+    async def stream_completion(*args, **kwargs):
+        text = ""
+        for word in (ANSWER.split() * tokens)[:tokens]:
+            text += word + " "
+            yield json.dumps({"chat_id": "benchmark", "text_message": text, "data_id": [], "data_type": []})
+
+    async def get_heading_url(heading_text):
+        return None
+
+    chat.ai.stream_completion = stream_completion
+    chat.ai.get_heading_url = get_heading_url
+    chat.warmup.ready = lambda: True
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(main.app, port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return f"127.0.0.1:{port}"
+
+
+def http_turn(client: httpx.Client, base: str) -> int:
+    with client.stream("POST", f"http://{base}/generate_response", json=QUERY) as response:
+        for _ in response.iter_bytes():
+            pass
+    for path, body in LOOKUPS.values():
+        if path == "/get_heading_image":
+            client.get(f"http://{base}{path}", params=body).raise_for_status()
+        else:
+            client.post(f"http://{base}{path}", json=body).raise_for_status()
+    return 1 + len(LOOKUPS)
+
+
+def websocket_turn(websocket, turn: int) -> int:
+    websocket.send(json.dumps({"type": "generate", "id": f"{turn}", **QUERY}))
+    while json.loads(websocket.recv())["type"] == "token":
+        pass
+    for kind, (_, body) in LOOKUPS.items():
+        websocket.send(json.dumps({"type": kind, "id": f"{turn}-{kind}", **body}))
+    for _ in LOOKUPS:
+        if json.loads(websocket.recv())["type"] != "result":
+            raise RuntimeError("A lookup failed")
+    return 1 + len(LOOKUPS)
+
+
+def run(name: str, turns: int, turn) -> dict:
+    start_time = time.perf_counter()
+    exchanges = sum(turn(i) for i in range(turns))
+    seconds = time.perf_counter() - start_time
+    return {"flow": name, "turns_per_second": round(turns / seconds, 1),
+            "messages_per_second": round(exchanges / seconds, 1), "ms_per_turn": round(seconds / turns * 1000, 1)}
+
+
+def connection_overhead(base: str, repeats: int = 50) -> dict:
+    start_time = time.perf_counter()
+    with httpx.Client(limits=httpx.Limits(max_keepalive_connections=0)) as client:
+        for _ in range(repeats):
+            client.get(f"http://{base}/health/live").raise_for_status()
+    http_ms = (time.perf_counter() - start_time) / repeats * 1000
+    start_time = time.perf_counter()
+    for _ in range(repeats):
+        with connect(f"ws://{base}/ws") as websocket:
+            websocket.send(json.dumps({"type": "ping", "id": "ping"}))
+            websocket.recv()
+    websocket_ms = (time.perf_counter() - start_time) / repeats * 1000
+    return {"http_connection_ms": round(http_ms, 2), "websocket_connection_ms": round(websocket_ms, 2)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--tokens", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        # The entity lookups read database.csv and the app its sqlite database from the working directory
+        shutil.copy(os.path.join(APP_DIR, "database.csv"), temp_dir)
+        os.chdir(temp_dir)
+        base = start_server(args.tokens)
+        print(connection_overhead(base))
+
+        with httpx.Client(limits=httpx.Limits(max_keepalive_connections=0)) as client:
+            print(run("http_new_connections", args.turns, lambda turn: http_turn(client, base)))
+        with httpx.Client() as client:
+            print(run("http_keep_alive", args.turns, lambda turn: http_turn(client, base)))
+        with connect(f"ws://{base}/ws") as websocket:
+            print(run("websocket", args.turns, lambda turn: websocket_turn(websocket, turn)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Measure the memory of N worker processes that each load the same vector store, with and without mmap.
+
+A synthetic store of --chunks random vectors is published to a temporary directory. Every worker loads it,
+runs a few searches (touching every vector) and reports its memory while all workers are alive:
+RSS, the anonymous (private) part of it, and PSS, which splits shared pages between the processes mapping
+them, so the sum of PSS is what the workers really cost together.
+
+    python -m benchmarks.worker_memory
+    python -m benchmarks.worker_memory --workers 1 4 8 --chunks 50000
+"""
+import argparse
+import multiprocessing
+import tempfile
+
+import numpy as np
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+
+from stores import VersionedStore
+
+
+def memory_kb() -> dict:
+    with open("/proc/self/status") as f:
+        status = {line.split(":")[0]: int(line.split()[1]) for line in f if line.startswith(("VmRSS", "RssAnon"))}
+    with open("/proc/self/smaps_rollup") as f:
+        pss = next(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+    return {"rss": status["VmRSS"], "anon": status["RssAnon"], "pss": pss}
+
+
+def worker(root: str, mmap: bool, dimensions: int, barrier, results) -> None:
+    vector_store = VersionedStore(root).load(DeterministicFakeEmbedding(size=dimensions), mmap=mmap)
+    for _ in range(3):
+        vector_store.similarity_search_by_vector(list(np.random.rand(dimensions)), 4)
+    barrier.wait()
+    results.put(memory_kb())
+    barrier.wait()
+
+
+def measure(root: str, workers: int, mmap: bool, dimensions: int) -> dict:
+    context = multiprocessing.get_context("spawn")
+    barrier, results = context.Barrier(workers), context.Queue()
+    processes = [context.Process(target=worker, args=(root, mmap, dimensions, barrier, results))
+                 for _ in range(workers)]
+    for process in processes:
+        process.start()
+    reports = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    return {"workers": workers, "mmap": mmap,
+            "rss_mb_per_worker": round(sum(report["rss"] for report in reports) / workers / 1024, 1),
+            "private_mb_per_worker": round(sum(report["anon"] for report in reports) / workers / 1024, 1),
+            "total_pss_mb": round(sum(report["pss"] for report in reports) / 1024, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--chunks", type=int, default=20000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        vectors = np.random.rand(args.chunks, args.dimensions).astype("float32")
+        texts = [f"chunk {i}" for i in range(args.chunks)]
+        vector_store = FAISS.from_embeddings(zip(texts, vectors), DeterministicFakeEmbedding(size=args.dimensions))
+        VersionedStore(temp_dir).publish(vector_store)
+        del vector_store, vectors
+        print(f"{args.chunks} chunks x {args.dimensions} dimensions, "
+              f"{args.chunks * args.dimensions * 4 / 2 ** 20:.0f} MB of vectors")
+        for workers in args.workers:
+            for mmap in (False, True):
+                print(measure(temp_dir, workers, mmap, args.dimensions))
+
+
+if __name__ == "__main__":
+    main()
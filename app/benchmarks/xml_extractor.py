@@ -0,0 +1,66 @@
+"""
+Measure the throughput of the single pass schema extractor.
+
+Reports docs/sec for extraction alone (pre-parsed trees) and for parsing + extraction. The fixture pages are
+small, --scale repeats their sections and artworks to get closer to the size of real pages. The per type
+extractors it replaced are gone, their output is kept as the expected JSON of the test fixtures, see
+TestSchemaExtractor.
+
+    python -m benchmarks.xml_extractor --scale 20
+    python -m benchmarks.xml_extractor --xml-dir data/xml/ --rounds 5
+"""
+import argparse
+import copy
+import time
+import xml.etree.ElementTree as ET
+from typing import Callable, Dict, List, Tuple
+
+from ats_refresh import extract_xml_data
+from benchmarks.extraction import load_pages
+
+
+def scale_page(content: bytes, scale: int) -> bytes:
+    root = ET.fromstring(content)
+    for parent_tag, child_tag in (("article", "section"), ("artworks", "artwork")):
+        for parent in root.iter(parent_tag):
+            children = [child for child in parent if child.tag == child_tag]
+            for _ in range(scale - 1):
+                parent.extend(copy.deepcopy(child) for child in children)
+    return ET.tostring(root)
+
+
+def docs_per_second(extract: Callable[[str, ET.Element], Dict], pages: List[Tuple[str, bytes]], rounds: int,
+                    parse: bool) -> float:
+    """Best of three runs, to keep noise from other processes out of the comparison."""
+    roots = [(key, ET.fromstring(content)) for key, content in pages]
+    best = 0.0
+    for _ in range(3):
+        start_time = time.perf_counter()
+        for _ in range(rounds):
+            if parse:
+                for key, content in pages:
+                    extract(key, ET.fromstring(content))
+            else:
+                for key, root in roots:
+                    extract(key, root)
+        best = max(best, rounds * len(pages) / (time.perf_counter() - start_time))
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--xml-dir", help="directory of <type>/<name>.xml pages, defaults to the test fixtures")
+    parser.add_argument("--scale", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=500)
+    args = parser.parse_args()
+
+    pages = [(key, scale_page(content, args.scale)) for _, key, content in load_pages(args.xml_dir)]
+    print(f"{len(pages)} pages (scale {args.scale}) x {args.rounds} rounds")
+
+    for parse in (False, True):
+        print({"stage": "parse+extract" if parse else "extract",
+               "docs_per_sec": round(docs_per_second(extract_xml_data, pages, args.rounds, parse), 1)})
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,3 @@
-from crud.operations import *
\ No newline at end of file
+from crud.operations import *
+from crud.export import *
+from crud.retention import *
\ No newline at end of file
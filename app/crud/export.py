@@ -0,0 +1,157 @@
+import csv
+import io
+import os
+from typing import Iterator, List, Optional
+
+from sqlalchemy import select
+from models import Messages, SessionHistory
+from db import Session, logger
+
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 5000))
+
+# table name -> (model, primary key column, column used for the date range filter)
+EXPORT_TABLES = {
+    "messages": (Messages, Messages.message_id, Messages.timestamp),
+    "session_history": (SessionHistory, SessionHistory.instance_id, SessionHistory.history_creation_timestamp),
+}
+
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+
+
+def get_export_columns(table: str) -> List[str]:
+    model = EXPORT_TABLES[table][0]
+    return [column.key for column in model.__table__.columns]
+
+
+def iter_table_batches(db: Session, table: str, start: Optional[str] = None, end: Optional[str] = None,
+                       batch_size: int = EXPORT_BATCH_SIZE) -> Iterator[list]:
+    """Yield rows of an export table as lists of tuples, ``batch_size`` rows at a time.
+
+    Pages are walked with keyset pagination on the primary key, so no page re-scans the rows before it, and every
+    page is fetched as a streamed result (a server-side cursor where the backend has one). The read transaction
+    is released between pages so a long export never holds the SQLite database locked against chat writers.
+    ``start`` is inclusive and ``end`` is exclusive, both compared against the table's timestamp column.
+    """
+    model, primary_key, timestamp_column = EXPORT_TABLES[table]
+    columns = [getattr(model, name) for name in get_export_columns(table)]
+
+    last_key = None
+    while True:
+        query = select(*columns).order_by(primary_key).limit(batch_size)
+        if last_key is not None:
+            query = query.where(primary_key > last_key)
+        if start:
+            query = query.where(timestamp_column >= start)
+        if end:
+            query = query.where(timestamp_column < end)
+
+        result = db.execute(query.execution_options(stream_results=True, yield_per=batch_size))
+        rows = [tuple(row) for row in result]
+        db.rollback()
+        if not rows:
+            return
+        last_key = rows[-1][0]
+        yield rows
+        if len(rows) < batch_size:
+            return
+
+
+def csv_stream(batches: Iterator[list], columns: List[str]) -> Iterator[str]:
+    """Encode batches of rows as CSV text, one chunk per batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+class _ParquetSink(io.RawIOBase):
+    """Write-only file object that hands the written bytes back to the caller instead of keeping them."""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def parquet_stream(batches: Iterator[list], columns: List[str], compression: str = "zstd") -> Iterator[bytes]:
+    """Encode batches of rows as a compressed Parquet file, one row group per batch."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    types = {"message_id": pa.int64(), "instance_id": pa.int64(), "partial": pa.bool_()}
+    schema = pa.schema([(name, types.get(name, pa.string())) for name in columns])
+    sink = _ParquetSink()
+    writer = pq.ParquetWriter(sink, schema, compression=compression)
+    try:
+        for rows in batches:
+            writer.write_table(pa.Table.from_arrays([pa.array(values, type=field.type) for values, field in
+                                                     zip(zip(*rows), schema)], schema=schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_stream(table: str, file_format: str = "csv", start: Optional[str] = None, end: Optional[str] = None,
+                  batch_size: int = EXPORT_BATCH_SIZE):
+    """Stream an export of ``table`` in ``file_format`` using its own database session.
+
+    The session is owned by the generator rather than a request dependency so that it stays open for as long as
+    the response body is being sent.
+    """
+    if table not in EXPORT_TABLES:
+        raise ValueError(f"Unknown export table '{table}'")
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{file_format}'")
+
+    columns = get_export_columns(table)
+    db = Session()
+    try:
+        batches = iter_table_batches(db, table, start, end, batch_size)
+        if file_format == "csv":
+            yield from csv_stream(batches, columns)
+        else:
+            yield from parquet_stream(batches, columns)
+    finally:
+        db.close()
+
+
+def export_to_file(table: str, file_path: str, file_format: str = "csv", start: Optional[str] = None,
+                   end: Optional[str] = None, batch_size: int = EXPORT_BATCH_SIZE) -> str:
+    if file_format == "csv":
+        with open(file_path, mode='w', newline='', encoding='utf-8') as file:
+            for chunk in export_stream(table, file_format, start, end, batch_size):
+                file.write(chunk)
+    else:
+        with open(file_path, mode='wb') as file:
+            for chunk in export_stream(table, file_format, start, end, batch_size):
+                file.write(chunk)
+    logger.info(f"Exported {table} to {file_path}")
+    return file_path
@@ -11,8 +11,9 @@ def model_to_dict(model):
     return {c: getattr(model, c) for c in columns}
 
 
-def insert_message(db: Session, session_id, history_id, sender, message_text):
-    message = Messages(session_id=session_id, history_id=history_id, sender=sender, message_text=message_text)
+def insert_message(db: Session, session_id, history_id, sender, message_text, partial=False):
+    message = Messages(session_id=session_id, history_id=history_id, sender=sender, message_text=message_text,
+                       partial=partial)
     db.add(message)
     db.commit()
     db.refresh(message)
@@ -25,6 +26,14 @@ def get_recent_messages(db: Session, session_id=None, limit=3) -> list:
     return [(msg.sender, msg.message_text) for msg in query[::-1]]
 
 
+def get_question_history_id(db: Session, session_id, question):
+    """The history_id of the latest time ``question`` was asked in the session, None when it wasn't saved."""
+    message = db.query(Messages).filter(Messages.session_id == session_id, Messages.sender == 'human',
+                                        Messages.message_text == question).order_by(Messages.timestamp.desc(),
+                                                                                    Messages.message_id.desc()).first()
+    return message.history_id if message else None
+
+
 # def get_last_ai_response(db: Session, session_id=None, limit=5) -> str:
 #     query = db.query(Messages).filter(Messages.session_id == session_id).order_by(Messages.timestamp.desc()).limit(
 #         limit).all()
@@ -0,0 +1,153 @@
+import os
+import time
+from datetime import datetime, timedelta
+
+from db import db_engine, logger
+
+RETENTION_DAYS = int(os.environ.get("RETENTION_DAYS", 180))
+ARCHIVE_DB_NAME = os.environ.get("ARCHIVE_DATABASE", "chatbot_archive.db")
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", 500))
+# Pause between batches so that chat writers waiting on the database lock get a turn
+RETENTION_BATCH_PAUSE = float(os.environ.get("RETENTION_BATCH_PAUSE", 0.05))
+VACUUM_STEP_PAGES = 1000
+
+# Messages.message_id is a plain rowid, SQLite hands ids out again once the newest messages are gone, so the
+# archive can hold several messages with the same id and keys its rows with its own archive_id
+ARCHIVE_TABLE_DDL = """
+CREATE TABLE IF NOT EXISTS archive.Messages (
+    archive_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id INTEGER NOT NULL,
+    session_id VARCHAR NOT NULL,
+    history_id VARCHAR NOT NULL,
+    sender VARCHAR NOT NULL,
+    message_text TEXT NOT NULL,
+    timestamp VARCHAR,
+    partial BOOLEAN NOT NULL DEFAULT 0
+)
+"""
+
+MESSAGE_COLUMNS = "message_id, session_id, history_id, sender, message_text, timestamp, partial"
+
+
+class RetentionError(Exception):
+    """Raised when a batch would delete other messages than it archived, the batch is rolled back."""
+
+
+def get_database_size(connection) -> dict:
+    page_size = connection.exec_driver_sql("PRAGMA page_size").scalar()
+    page_count = connection.exec_driver_sql("PRAGMA page_count").scalar()
+    freelist_count = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    return {"page_size": page_size, "page_count": page_count, "freelist_count": freelist_count,
+            "size_bytes": page_size * page_count}
+
+
+def incremental_vacuum(connection, step_pages: int = VACUUM_STEP_PAGES) -> int:
+    """Return free pages to the file system a few at a time. Returns the number of pages released."""
+    if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+        logger.warning("auto_vacuum is not INCREMENTAL on this database, run enable_incremental_vacuum() once "
+                       "during a maintenance window to reclaim space")
+        return 0
+
+    initial_free_pages = free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+    while free_pages:
+        # The pragma releases one page per step, so the driver cursor has to be drained
+        cursor = connection.connection.cursor()
+        cursor.execute(f"PRAGMA incremental_vacuum({step_pages})")
+        cursor.fetchall()
+        cursor.close()
+        connection.commit()
+        remaining_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+        if remaining_pages >= free_pages:
+            break
+        free_pages = remaining_pages
+        time.sleep(RETENTION_BATCH_PAUSE)
+    return initial_free_pages - free_pages
+
+
+def enable_incremental_vacuum() -> None:
+    """Switch an existing database to auto_vacuum=INCREMENTAL. This runs a full VACUUM and locks the database."""
+    with db_engine.connect() as connection:
+        connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        connection.commit()
+        connection.exec_driver_sql("VACUUM")
+        logger.info("Database switched to incremental auto vacuum")
+
+
+def archive_old_messages(max_age_days: int = RETENTION_DAYS, archive_path: str = ARCHIVE_DB_NAME,
+                         batch_size: int = RETENTION_BATCH_SIZE, dry_run: bool = False) -> dict:
+    """
+    Move messages older than ``max_age_days`` from the Messages table into the archive database.
+    - Each batch is copied and deleted in one short transaction, so a crash never loses or duplicates a message
+      and writers are only blocked for the duration of a single batch.
+    - A batch is only committed when it deleted as many messages as it copied, RetentionError is raised otherwise.
+    - After archiving, free pages are released with an incremental vacuum.
+    - With ``dry_run`` nothing is written, only the number of messages and bytes that would move is reported.
+    """
+    cutoff = (datetime.utcnow() - timedelta(days=max_age_days)).strftime("%Y-%m-%d %H:%M:%S")
+    start_time = time.time()
+
+    with db_engine.connect() as connection:
+        size_before = get_database_size(connection)
+        boundary, candidates, candidate_bytes = connection.exec_driver_sql(
+            "SELECT MAX(message_id), COUNT(*), COALESCE(SUM(LENGTH(message_text)), 0) "
+            "FROM Messages WHERE timestamp < ?", (cutoff,)).one()
+        connection.commit()
+
+        metrics = {"cutoff": cutoff, "dry_run": dry_run, "candidate_messages": candidates,
+                   "candidate_text_bytes": candidate_bytes, "archived_messages": 0, "batches": 0,
+                   "released_pages": 0, "size_before_bytes": size_before["size_bytes"]}
+
+        if dry_run or not candidates:
+            metrics.update({"size_after_bytes": size_before["size_bytes"], "reclaimed_bytes": 0,
+                            "execution_time": time.time() - start_time})
+            logger.info(f"Message retention: {metrics}")
+            return metrics
+
+        connection.exec_driver_sql("ATTACH DATABASE ? AS archive", (archive_path,))
+        try:
+            connection.exec_driver_sql(ARCHIVE_TABLE_DDL)
+            connection.commit()
+
+            last_id = 0
+            while True:
+                upper_id = connection.exec_driver_sql(
+                    "SELECT MAX(message_id) FROM (SELECT message_id FROM Messages WHERE message_id > ? "
+                    "AND message_id <= ? AND timestamp < ? ORDER BY message_id LIMIT ?)",
+                    (last_id, boundary, cutoff, batch_size)).scalar()
+                if upper_id is None:
+                    connection.commit()
+                    break
+
+                batch_filter = "WHERE message_id > ? AND message_id <= ? AND timestamp < ?"
+                params = (last_id, upper_id, cutoff)
+                archived = connection.exec_driver_sql(
+                    f"INSERT INTO archive.Messages ({MESSAGE_COLUMNS}) "
+                    f"SELECT {MESSAGE_COLUMNS} FROM main.Messages {batch_filter}", params).rowcount
+                deleted = connection.exec_driver_sql(f"DELETE FROM main.Messages {batch_filter}", params).rowcount
+                if archived != deleted:
+                    raise RetentionError(f"Batch of messages {last_id + 1}-{upper_id} archived {archived} messages "
+                                         f"but deleted {deleted}")
+                connection.commit()
+
+                metrics["archived_messages"] += deleted
+                metrics["batches"] += 1
+                last_id = upper_id
+                time.sleep(RETENTION_BATCH_PAUSE)
+        finally:
+            connection.rollback()
+            connection.exec_driver_sql("DETACH DATABASE archive")
+
+        metrics["released_pages"] = incremental_vacuum(connection)
+        size_after = get_database_size(connection)
+
+    metrics.update({"size_after_bytes": size_after["size_bytes"],
+                    "reclaimed_bytes": size_before["size_bytes"] - size_after["size_bytes"],
+                    "execution_time": time.time() - start_time})
+    logger.info(f"Message retention: {metrics}")
+    return metrics
+
+
+if __name__ == '__main__':
+    import sys
+
+    print(archive_old_messages(dry_run="--dry-run" in sys.argv))
@@ -1,6 +1,6 @@
 import os
 from lib import logger
-from sqlalchemy import create_engine, MetaData
+from sqlalchemy import create_engine, event, inspect, MetaData
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
@@ -11,6 +11,16 @@ DATABASE_CONNECTION_TIMEOUT = 2
 DB_NAME = os.environ.get("DATABASE", "chatbot.db")
 db_engine = create_engine(f"sqlite:///{DB_NAME}", echo=True)
 
+
+@event.listens_for(db_engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    # Only takes effect on a database created by this connection, existing ones keep their mode until VACUUM.
+    # Incremental mode lets message retention give pages back without a full locking VACUUM.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    cursor.close()
+
+
 Session = sessionmaker(
     autocommit=False,
     autoflush=False,
@@ -20,6 +30,15 @@ Session = sessionmaker(
 Base = declarative_base()
 
 
+def migrate_messages() -> None:
+    """Add the columns Messages gained after its creation to an existing table, create_all leaves it as it is."""
+    columns = [column["name"] for column in inspect(db_engine).get_columns("Messages")]
+    if "partial" not in columns:
+        with db_engine.begin() as connection:
+            connection.exec_driver_sql("ALTER TABLE Messages ADD COLUMN partial BOOLEAN NOT NULL DEFAULT 0")
+        logger.info("Added the partial column to Messages")
+
+
 async def initialize_db() -> None:
     """Connect with the database for the first time. This is with the startup of the server."""
     database_alive = False
@@ -30,6 +49,7 @@ async def initialize_db() -> None:
             try:
                 logger.info("Initializing tables creation")
                 Base.metadata.create_all(bind=db_engine)
+                migrate_messages()
                 logger.info("Tables created successfully")
             except (IntegrityError, ProgrammingError):
                 pass
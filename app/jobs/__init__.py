@@ -0,0 +1 @@
+from jobs.runner import *
\ No newline at end of file
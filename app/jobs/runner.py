@@ -0,0 +1,284 @@
+import importlib
+import json
+import multiprocessing
+import os
+import signal
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+
+from db import db_engine, logger
+from models import RefreshJob
+
+ACTIVE_STATUSES = ("queued", "running", "cancelling")
+JOB_HISTORY_LIMIT = 50
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get("JOB_HEARTBEAT_INTERVAL", 5))
+# An active job whose worker wrote no heartbeat for that long is failed, it covers the start of the worker too
+JOB_HEARTBEAT_TIMEOUT = float(os.environ.get("JOB_HEARTBEAT_TIMEOUT", 60))
+
+# Stages of every job kind as (stage name, "module:function"), run in order by the worker process
+JOB_STAGES = {
+    "initial_cloud_refresh": [("build_vector_store", "ats_refresh:create_local_vector_store"),
+                              ("upload_cloud_vector", "ats_refresh:upload_merged_vector")],
+    "local_refresh": [("build_vector_store", "ats_refresh:create_local_vector_store")],
+    "partial_cloud_refresh": [("partial_refresh", "ats_refresh:refresh_local_vector_store"),
+                              ("upload_cloud_vector", "ats_refresh:upload_merged_vector")],
+    "iframe_vector_refresh": [("collect_iframes", "ats_refresh:get_iframe_images"),
+                              ("build_iframe_store", "ats_refresh:create_iframe_vector_store")],
+    "image_vector_refresh": [("collect_images", "ats_refresh:get_all_images"),
+                             ("build_image_store", "ats_refresh:create_image_vector_store")],
+    "message_retention": [("archive_messages", "crud.retention:archive_old_messages")],
+}
+
+
+class JobConflict(Exception):
+    """Raised when a job is started while another one is still queued or running."""
+
+    def __init__(self, job: Optional[Dict]):
+        super().__init__(f"Job {job['job_id'] if job else ''} is still active")
+        self.job = job
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def now(offset: float = 0) -> str:
+    return (datetime.utcnow() + timedelta(seconds=offset)).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def job_to_dict(job: RefreshJob) -> Dict:
+    stages = json.loads(job.stages)
+    for stage in stages:
+        # Running stages report how long they have been running so far
+        if stage["status"] == "running" and stage.get("started"):
+            stage["seconds"] = round(time.time() - stage["started"], 3)
+        stage.pop("started", None)
+    done = sum(1 for stage in stages if stage["status"] == "done")
+    current = next((stage["name"] for stage in stages if stage["status"] == "running"), None)
+    return {"job_id": job.job_id, "kind": job.kind, "status": job.status, "current_stage": current,
+            "progress": f"{done}/{len(stages)}", "stages": stages, "arguments": json.loads(job.arguments or "{}"),
+            "error": job.error, "pid": job.pid,
+            "heartbeat_at": job.heartbeat_at, "created_at": job.created_at, "started_at": job.started_at,
+            "finished_at": job.finished_at}
+
+
+def update_job(session_factory, job_id: str, **fields) -> None:
+    with session_factory() as db:
+        db.query(RefreshJob).filter(RefreshJob.job_id == job_id).update(fields)
+        db.commit()
+
+
+def run_job(job_id: str, kind: str, targets: List[Tuple[str, str]], database_url: str,
+            arguments: Dict = None) -> None:
+    """
+    Entry point of the worker process, runs the (stage name, "module:function") targets of one job in order, with
+    the keyword ``arguments`` of the job. What a stage returns is kept as its result.
+    """
+    session_factory = sessionmaker(bind=create_engine(database_url))
+
+    def cancel(signum, frame):
+        cancelled.set()
+        raise JobCancelled()
+
+    def record(**fields):
+        # JobCancelled can be swallowed by the code it is raised in (e.g. an import guarded by "except Exception"),
+        # the flag still stops the job at the next step
+        if cancelled.is_set():
+            raise JobCancelled()
+        update_job(session_factory, job_id, **fields)
+
+    def beat():
+        while not stopped.wait(JOB_HEARTBEAT_INTERVAL):
+            update_job(session_factory, job_id, heartbeat_at=now())
+
+    def start_running() -> bool:
+        # A job cancelled while it was queued is "cancelling" already, it doesn't start
+        with session_factory() as db:
+            started = db.query(RefreshJob).filter(RefreshJob.job_id == job_id, RefreshJob.status == "queued").update(
+                {"status": "running", "started_at": now(), "heartbeat_at": now(), "stages": json.dumps(stages)})
+            db.commit()
+        return bool(started)
+
+    cancelled, stopped = threading.Event(), threading.Event()
+    signal.signal(signal.SIGTERM, cancel)
+    threading.Thread(target=beat, name="job-heartbeat", daemon=True).start()
+    stages = [{"name": name, "status": "pending", "seconds": None} for name, _ in targets]
+    status, error = "succeeded", None
+    try:
+        if not start_running():
+            raise JobCancelled()
+        for stage, (_, target) in zip(stages, targets):
+            module_name, function_name = target.split(":")
+            stage.update(status="running", started=time.time())
+            function = getattr(importlib.import_module(module_name), function_name)
+            record(stages=json.dumps(stages))
+            result = function(**(arguments or {}))
+            if cancelled.is_set():
+                raise JobCancelled()
+            stage.update(status="done", seconds=round(time.time() - stage.pop("started"), 3))
+            if result is not None:
+                stage["result"] = result
+            record(stages=json.dumps(stages))
+    except JobCancelled:
+        status = "cancelled"
+    except Exception as e:
+        logger.exception(f"Job {job_id} ({kind}) failed")
+        status, error = "failed", f"{type(e).__name__}: {e}"
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        stopped.set()
+        for stage in stages:
+            if stage["status"] == "running":
+                stage.update(status=status, seconds=round(time.time() - stage.pop("started"), 3))
+        update_job(session_factory, job_id, status=status, error=error, finished_at=now(), active=None,
+                   stages=json.dumps(stages))
+
+
+class JobRunner:
+    """
+    Runs refresh jobs in a separate worker process and keeps their history in the RefreshJobs table.
+    - ``start`` returns as soon as the worker is started, only one job can be active at a time across the
+      processes of the service.
+    - The worker records every stage with its status and duration, ``get`` reports them.
+    - ``cancel`` sends SIGTERM to the worker, whichever process of the service started it, the running stage is
+      interrupted and the job marked cancelled. The pid stored by another process is only signalled while the
+      job's heartbeat is fresh, a job whose worker is gone is just marked cancelled.
+    - The worker writes a heartbeat, active jobs without a recent one (their worker was killed, e.g. by a restart
+      of the service) are marked failed by ``setup`` and when they block a new job.
+    """
+
+    def __init__(self, database_url: str = None):
+        self.engine = create_engine(database_url) if database_url else db_engine
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: Dict[str, multiprocessing.Process] = {}
+        self.watchers: List[threading.Thread] = []
+        self.lock = threading.Lock()
+
+    def setup(self) -> None:
+        """Create the jobs table and fail the jobs left behind, run on start up of the service."""
+        RefreshJob.__table__.create(self.engine, checkfirst=True)
+        self.fail_stale_jobs()
+
+    def fail_stale_jobs(self) -> int:
+        """Fail the active jobs whose worker stopped writing heartbeats. Returns how many there were."""
+        with self.session_factory() as db:
+            last_heartbeat = now(-JOB_HEARTBEAT_TIMEOUT)
+            stale = db.query(RefreshJob).filter(
+                RefreshJob.status.in_(ACTIVE_STATUSES),
+                RefreshJob.heartbeat_at.is_(None) | (RefreshJob.heartbeat_at < last_heartbeat)).update(
+                {"status": "failed", "error": "The worker process stopped (no heartbeat)", "active": None,
+                 "finished_at": now()}, synchronize_session=False)
+            db.commit()
+        if stale:
+            logger.warning(f"Marked {stale} refresh jobs without a worker as failed")
+        return stale
+
+    def start(self, kind: str, **arguments) -> Dict:
+        if kind not in JOB_STAGES:
+            raise ValueError(f"Unknown job kind {kind}")
+        job_id = uuid.uuid4().hex
+        stages = [{"name": name, "status": "pending", "seconds": None} for name, _ in JOB_STAGES[kind]]
+        with self.lock, self.session_factory() as db:
+            for attempt in range(2):
+                db.add(RefreshJob(job_id=job_id, kind=kind, status="queued", active=1, heartbeat_at=now(),
+                                  arguments=json.dumps(arguments), stages=json.dumps(stages)))
+                try:
+                    db.commit()
+                    break
+                except IntegrityError:
+                    db.rollback()
+                    # The active job may have lost its worker, it no longer blocks new jobs then
+                    if attempt or not self.fail_stale_jobs():
+                        raise JobConflict(self.active_job())
+
+            process = self.context.Process(target=run_job, name=f"job-{kind}",
+                                           args=(job_id, kind, JOB_STAGES[kind],
+                                                 self.engine.url.render_as_string(False), arguments))
+            try:
+                process.start()
+            except Exception as e:
+                update_job(self.session_factory, job_id, status="failed", error=f"{type(e).__name__}: {e}",
+                           active=None, finished_at=now())
+                raise
+            self.processes[job_id] = process
+            update_job(self.session_factory, job_id, pid=process.pid)
+
+        watcher = threading.Thread(target=self.watch, args=(job_id, process), daemon=True)
+        watcher.start()
+        self.watchers = [thread for thread in self.watchers if thread.is_alive()] + [watcher]
+        logger.info(f"Started job {job_id} ({kind}) in process {process.pid}")
+        return self.get(job_id)
+
+    def watch(self, job_id: str, process: multiprocessing.Process) -> None:
+        """Wait for the worker and close the job if the worker died without doing so (e.g. it was killed)."""
+        process.join()
+        self.processes.pop(job_id, None)
+        with self.session_factory() as db:
+            job = db.get(RefreshJob, job_id)
+            if job is not None and job.status in ACTIVE_STATUSES:
+                job.status = "cancelled" if job.status == "cancelling" else "failed"
+                job.error = job.error or f"Worker process exited with code {process.exitcode}"
+                job.active = None
+                job.finished_at = now()
+                db.commit()
+        logger.info(f"Job {job_id} worker exited with code {process.exitcode}")
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self.session_factory() as db:
+            job = db.get(RefreshJob, job_id)
+            return job_to_dict(job) if job is not None else None
+
+    def active_job(self) -> Optional[Dict]:
+        with self.session_factory() as db:
+            job = db.query(RefreshJob).filter(RefreshJob.active.isnot(None)).first()
+            return job_to_dict(job) if job is not None else None
+
+    def history(self, limit: int = JOB_HISTORY_LIMIT) -> List[Dict]:
+        with self.session_factory() as db:
+            jobs = db.query(RefreshJob).order_by(RefreshJob.created_at.desc(), RefreshJob.job_id).limit(limit).all()
+            return [job_to_dict(job) for job in jobs]
+
+    def cancel(self, job_id: str) -> Optional[Dict]:
+        while True:
+            with self.session_factory() as db:
+                job = db.get(RefreshJob, job_id)
+                if job is None or job.status not in ACTIVE_STATUSES:
+                    return job_to_dict(job) if job is not None else None
+                status, pid = job.status, job.pid
+                alive = job.heartbeat_at is not None and job.heartbeat_at >= now(-JOB_HEARTBEAT_TIMEOUT)
+                # Only if the worker didn't start running in the meantime, the job is looked at again otherwise
+                updated = db.query(RefreshJob).filter(RefreshJob.job_id == job_id, RefreshJob.status == status).update(
+                    {"status": "cancelling"})
+                db.commit()
+            if updated:
+                break
+        process = self.processes.get(job_id)
+        if process is not None:
+            process.terminate()
+        elif not alive:
+            # Its worker is gone, the stored pid may belong to an unrelated process by now
+            update_job(self.session_factory, job_id, status="cancelled", active=None, finished_at=now())
+        elif status != "queued" and pid is not None:
+            # Started by another process of the service, its watcher closes the job once the worker exited.
+            # A queued job has no worker running yet, it stops before its first stage (see run_job)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                update_job(self.session_factory, job_id, status="cancelled", active=None, finished_at=now())
+        return self.get(job_id)
+
+    def shutdown(self, timeout: float = 10.0) -> None:
+        """Cancel running jobs so that the service doesn't wait for them on exit."""
+        for job_id, process in list(self.processes.items()):
+            self.cancel(job_id)
+            process.join(timeout)
+        for watcher in self.watchers:
+            watcher.join(timeout)
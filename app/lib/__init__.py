@@ -1 +1,2 @@
-from lib.utils import *
\ No newline at end of file
+from lib.utils import *
+from lib.warmup import *
\ No newline at end of file
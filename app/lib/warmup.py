@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable
+
+from lib.utils import logger
+
+WARMUP_RETRIES = int(os.environ.get("WARMUP_RETRIES", 4))
+# Seconds before the first retry of a failed component, doubled for every next one
+WARMUP_RETRY_DELAY = float(os.environ.get("WARMUP_RETRY_DELAY", 2))
+
+
+class Warmup:
+    """
+    Runs the slow start-up work of the service in the background and tracks when the service is ready.
+    - Every component runs on its own thread, ``after`` makes a component wait for others to succeed first.
+    - A component that raises is retried up to ``retries`` times with exponential backoff (e.g. the bucket was not
+      reachable yet). It fails when it still raises then or when a component it waits for fails, the service is
+      then not ready and ``failed`` tells that it never will be.
+    - ``status`` reports every component with its state, when it started, how long it took and its attempts.
+    """
+
+    def __init__(self, retries: int = WARMUP_RETRIES, retry_delay: float = WARMUP_RETRY_DELAY):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.components: Dict[str, Dict] = {}
+        self.functions: Dict[str, Callable[[], None]] = {}
+        self.finished: Dict[str, threading.Event] = {}
+        self.done = threading.Event()
+        self.started_at = None
+        self.seconds = None
+
+    def add(self, name: str, function: Callable[[], None], after: Iterable[str] = ()) -> None:
+        self.components[name] = {"status": "pending", "after": list(after), "started": None, "seconds": None,
+                                 "attempts": 0, "error": None}
+        self.functions[name] = function
+        self.finished[name] = threading.Event()
+
+    def record(self, name: str, seconds: float) -> None:
+        """Report a component that already ran before the warmup, e.g. the imports."""
+        self.components[name] = {"status": "ready", "after": [], "started": None, "seconds": round(seconds, 3),
+                                 "attempts": 1, "error": None}
+
+    def start(self) -> None:
+        self.started_at = time.perf_counter()
+        threads = [threading.Thread(target=self.run, args=(name,), name=f"warmup-{name}", daemon=True)
+                   for name in self.functions]
+        for thread in threads:
+            thread.start()
+        threading.Thread(target=self.finish, args=(threads,), name="warmup", daemon=True).start()
+
+    def run(self, name: str) -> None:
+        component = self.components[name]
+        start_time = time.perf_counter()
+        try:
+            for dependency in component["after"]:
+                self.finished[dependency].wait()
+                if self.components[dependency]["status"] != "ready":
+                    raise RuntimeError(f"{dependency} failed")
+            start_time = time.perf_counter()
+            component.update(status="running", started=round(start_time - self.started_at, 3))
+            while True:
+                component["attempts"] += 1
+                try:
+                    self.functions[name]()
+                    break
+                except Exception as e:
+                    if component["attempts"] > self.retries:
+                        raise
+                    delay = self.retry_delay * 2 ** (component["attempts"] - 1)
+                    component["error"] = f"{type(e).__name__}: {e}"
+                    logger.warning(f"Warmup of {name} failed ({component['error']}), retrying in {delay}s")
+                    time.sleep(delay)
+            component.update(status="ready", error=None, seconds=round(time.perf_counter() - start_time, 3))
+        except Exception as e:
+            logger.exception(f"Warmup of {name} failed")
+            component.update(status="failed", error=f"{type(e).__name__}: {e}",
+                             seconds=round(time.perf_counter() - start_time, 3))
+        finally:
+            self.finished[name].set()
+
+    def finish(self, threads) -> None:
+        for thread in threads:
+            thread.join()
+        self.seconds = round(time.perf_counter() - self.started_at, 3)
+        self.done.set()
+        parts = []
+        for name, component in self.components.items():
+            part = f"{name} {component['seconds']}s"
+            if component["started"] is not None:
+                part += f" (at +{component['started']}s)"
+            if component["status"] != "ready":
+                part += f" {component['status']}"
+            parts.append(part)
+        logger.info(f"Startup {'ready' if self.ready() else 'failed'} after {self.seconds}s of warmup: "
+                    f"{', '.join(parts)}")
+
+    def ready(self) -> bool:
+        return self.done.is_set() and all(component["status"] == "ready" for component in self.components.values())
+
+    def failed(self) -> bool:
+        """Whether the warmup is over without the service being ready, it won't be without a restart."""
+        return self.done.is_set() and not self.ready()
+
+    def wait(self, timeout: float = None) -> bool:
+        self.done.wait(timeout)
+        return self.ready()
+
+    def status(self) -> Dict:
+        seconds = self.seconds if self.seconds is not None else \
+            round(time.perf_counter() - self.started_at, 3) if self.started_at is not None else None
+        return {"ready": self.ready(), "warmup_seconds": seconds,
+                "components": {name: {key: value for key, value in component.items() if key != "after"}
+                               for name, component in self.components.items()}}
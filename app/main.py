@@ -1,9 +1,14 @@
+import time
+import_start_time = time.perf_counter()
+
 from fastapi import FastAPI
 from routers import chat
 from fastapi.middleware.cors import CORSMiddleware
 from db import Session, initialize_db, logger
 import os
 
+chat.warmup.record("imports", time.perf_counter() - import_start_time)
+
 app = FastAPI()
 
 app.add_middleware(CORSMiddleware,
@@ -20,11 +25,17 @@ DB_NAME = os.environ.get("DATABASE", "chatbot.db")
 @app.on_event("startup")
 async def startup() -> None:
     logger.info("Starting up the application")
+    start_time = time.perf_counter()
     await initialize_db()
+    chat.job_runner.setup()
+    chat.warmup.record("database", time.perf_counter() - start_time)
+    # Vector stores, agent and lookups load in the background, /health/ready reports when they are done
+    chat.warmup.start()
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
     logger.info("Shutting down the application")
+    chat.job_runner.shutdown()
     session = Session()
     session.close()
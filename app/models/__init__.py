@@ -1,2 +1,3 @@
 from models.message import *
-from models.session import *
\ No newline at end of file
+from models.session import *
+from models.job import *
\ No newline at end of file
@@ -0,0 +1,21 @@
+from db import Base
+from sqlalchemy import Column, Integer, String, Text, func
+
+
+class RefreshJob(Base):
+    __tablename__ = 'RefreshJobs'
+    job_id = Column(String, primary_key=True)
+    kind = Column(String, nullable=False)
+    status = Column(String, nullable=False, default='queued')
+    # 1 while the job is queued or running, NULL afterwards: the unique constraint allows one active job at a time
+    active = Column(Integer, unique=True, nullable=True)
+    pid = Column(Integer, nullable=True)
+    # Written by the worker process every few seconds, an active job without a recent one has no worker left
+    heartbeat_at = Column(String, nullable=True)
+    # Keyword arguments of the stage functions, as JSON
+    arguments = Column(Text, nullable=True)
+    stages = Column(Text, nullable=False, default='[]')
+    error = Column(Text, nullable=True)
+    created_at = Column(String, server_default=func.now())
+    started_at = Column(String, nullable=True)
+    finished_at = Column(String, nullable=True)
@@ -1,5 +1,5 @@
 from db import Base
-from sqlalchemy import Column, Integer, String, Text, CheckConstraint, func
+from sqlalchemy import Boolean, Column, Integer, String, Text, CheckConstraint, func
 
 
 class Messages(Base):
@@ -10,3 +10,5 @@ class Messages(Base):
     sender = Column(String, CheckConstraint("sender IN ('ai', 'human')"), nullable=False)
     message_text = Column(Text, nullable=False)
     timestamp = Column(String, server_default=func.now())
+    # An answer cut off before its end, e.g. its client disconnected (added by migrate_messages on older databases)
+    partial = Column(Boolean, nullable=False, default=False, server_default="0")
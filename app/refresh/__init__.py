@@ -0,0 +1,9 @@
+from refresh.http_cache import *
+from refresh.crawler import *
+from refresh.manifest import *
+from refresh.embedding_scheduler import *
+from refresh.embedding_cache import *
+from refresh.chunker import *
+from refresh.dedup import *
+from refresh.extraction import *
+from refresh.extractor import *
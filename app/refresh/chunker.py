@@ -0,0 +1,122 @@
+import re
+from typing import Dict, Iterator, List
+
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+
+CHUNK_SIZE = 700
+CHUNK_OVERLAP = 100
+# Fields whose pieces are only packed with pieces of the same field, the other fields of a document share chunks
+SEPARATE_FIELDS = ("artworks",)
+SPACE_BEFORE_PUNCTUATION = re.compile(r"\s+([.,;:!?])")
+
+# Scalar fields of the extracted documents that describe the subject, in the order they are written out
+PROFILE_FIELDS = {
+    "years_worked": "Years worked",
+    "years_developed": "Years developed",
+    "start_date": "Started",
+    "description": "Description",
+    "occupation": "Occupation",
+    "nationality": "Nationality",
+    "birthDate": "Born",
+    "birth_date": "Born",
+    "birthPlace": "Birthplace",
+    "birth_place": "Birthplace",
+    "deathDate": "Died",
+    "death_date": "Died",
+    "deathPlace": "Place of death",
+    "death_place": "Place of death",
+    "art_title": "Important art",
+    "art_description": "Important art",
+    "biography_highlights": "Highlights",
+}
+
+
+def clean_text(text) -> str:
+    """Collapse the whitespace left behind by tag stripping and indentation."""
+    return SPACE_BEFORE_PUNCTUATION.sub(r"\1", " ".join(str(text).split())) if text else ""
+
+
+class StructuredChunker:
+    """
+    Turns an extracted document into clean text chunks, one per field, instead of splitting its JSON dump.
+    - Every chunk starts with the document name and the field it comes from, so it reads on its own.
+    - Only fields that are long enough are split, with a small overlap, and short neighbouring fields of a
+      document are packed together, artworks apart from the rest.
+    - Links, image URLs and book recommendations are left out, they are served from the JSON files.
+    """
+
+    def __init__(self, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+        self.chunk_size = chunk_size
+        self.text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                                            length_function=len)
+
+    def split(self, heading: str, text: str) -> List[str]:
+        if not text:
+            return []
+        return [f"{heading}\n{part}" for part in self.text_splitter.split_text(text)]
+
+    def field_chunks(self, name: str, doc_type: str, data: Dict) -> Iterator[tuple]:
+        """Yield ``(chunk text, field metadata)`` pairs for one document, one or more per field."""
+        profile = [f"{label}: {clean_text(data[key])}" for key, label in PROFILE_FIELDS.items() if data.get(key)]
+        if data.get("similar_artists"):
+            profile.append("Similar artists: " + ", ".join(clean_text(artist).replace("_", " ")
+                                                           for artist in data["similar_artists"] if artist))
+        for text in self.split(f"{name} ({doc_type})", "\n".join(profile)):
+            yield text, {"field": "profile"}
+
+        for text in self.split(f"{name}: Synopsis", clean_text(data.get("synopsis"))):
+            yield text, {"field": "synopsis"}
+
+        key_ideas = "\n".join(f"- {clean_text(idea)}" for idea in data.get("key_ideas") or [] if idea)
+        for text in self.split(f"{name}: Key ideas", key_ideas):
+            yield text, {"field": "key_ideas"}
+
+        quotes = "\n".join(f'"{clean_text(quote)}"' for quote in data.get("quotes") or [] if quote)
+        for text in self.split(f"{name}: Quotes", quotes):
+            yield text, {"field": "quotes"}
+
+        for section in data.get("sections") or []:
+            section_title = clean_text(section.get("title"))
+            for sub_section in section.get("sub_sections") or []:
+                sub_section_title = clean_text(sub_section.get("title"))
+                heading = f"{name}: {' - '.join(title for title in (section_title, sub_section_title) if title)}"
+                for text in self.split(heading, clean_text(sub_section.get("content"))):
+                    yield text, {"field": "sections", "section": section_title, "sub_section": sub_section_title}
+
+        for artwork in data.get("artworks") or []:
+            title = clean_text(artwork.get("title"))
+            details = [clean_text(artwork.get(key)) for key in ("year", "materials", "collection")]
+            body = "\n".join(part for part in (", ".join(detail for detail in details if detail),
+                                               clean_text(artwork.get("description"))) if part)
+            for text in self.split(f"{name}: Artwork - {title}", body):
+                yield text, {"field": "artworks", "artwork": title}
+
+    def pack(self, pieces: Iterator[tuple]) -> Iterator[tuple]:
+        """
+        Merge consecutive short pieces of a document into chunks of up to ``chunk_size``, a field of
+        ``SEPARATE_FIELDS`` only with itself. The metadata values of the merged pieces are joined with "; ".
+        """
+        texts, values, group = [], None, None
+        for text, field_metadata in pieces:
+            field_group = field_metadata["field"] if field_metadata["field"] in SEPARATE_FIELDS else None
+            if texts and field_group == group and sum(map(len, texts)) + len(texts) + len(text) <= self.chunk_size:
+                texts.append(text)
+                for key, value in field_metadata.items():
+                    if value not in values.setdefault(key, []):
+                        values[key].append(value)
+                continue
+            if texts:
+                yield "\n\n".join(texts), {key: "; ".join(value) for key, value in values.items()}
+            texts, values, group = [text], {key: [value] for key, value in field_metadata.items()}, field_group
+        if texts:
+            yield "\n\n".join(texts), {key: "; ".join(value) for key, value in values.items()}
+
+    def load(self, dictionaries: List[Dict]) -> Iterator[Document]:
+        for i, doc in enumerate(dictionaries):
+            data = doc[doc['id']]
+            name = clean_text(data.get("name")) or doc['id'].replace("_", " ")
+            for text, field_metadata in self.pack(self.field_chunks(name, doc['type'], data)):
+                yield Document(page_content=text, metadata={"source": doc['type'], "id": doc['id'], "doc_index": i,
+                                                            "json_file": doc["json_file"],
+                                                            "xml_file": doc["xml_file"], **field_metadata})
@@ -0,0 +1,172 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Iterable, Iterator, Optional, Tuple
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from lib import logger
+from refresh.http_cache import HttpCache
+
+CRAWLER_MAX_WORKERS = 16
+CRAWLER_REQUESTS_PER_SECOND = 8.0
+CRAWLER_RETRIES = 3
+CRAWLER_BACKOFF = 0.5
+CRAWLER_TIMEOUT = 30
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class HostRateLimiter:
+    """Spaces out requests to the same host so that no host sees more than ``requests_per_second``."""
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0.0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url: str) -> None:
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class XmlCrawler:
+    """
+    Fetches many pages concurrently over one pooled HTTP session.
+    - At most ``max_workers`` requests are in flight, and every host is rate limited.
+    - Connection errors, timeouts, 429 and 5xx responses are retried with exponential backoff,
+      honouring Retry-After when the server sends it.
+    - Progress is logged every ``progress_every`` pages.
+    - With a ``cache``, requests are conditional and pages whose body did not change upstream are
+      collected in ``unchanged`` (their body is served from the cache).
+    - Pages still failing after the retries (connection errors, timeouts, 429 and 5xx) are collected in
+      ``failed``, unlike a 404 they may well still exist.
+    """
+
+    def __init__(self, max_workers: int = CRAWLER_MAX_WORKERS,
+                 requests_per_second: float = CRAWLER_REQUESTS_PER_SECOND,
+                 retries: int = CRAWLER_RETRIES, backoff: float = CRAWLER_BACKOFF,
+                 timeout: float = CRAWLER_TIMEOUT, progress_every: int = 100, cache: HttpCache = None):
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.progress_every = progress_every
+        self.cache = cache
+        self.unchanged = set()
+        self.failed = set()
+        self.rate_limiter = HostRateLimiter(requests_per_second)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.stats = {"fetched": 0, "not_modified": 0, "failed": 0, "retried": 0}
+        self.stats_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def count(self, key: str) -> None:
+        with self.stats_lock:
+            self.stats[key] += 1
+
+    def retry_delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        if response is not None and response.headers.get("Retry-After", "").isdigit():
+            return float(response.headers["Retry-After"])
+        return self.backoff * (2 ** attempt)
+
+    def get(self, url: str, **kwargs) -> Optional[requests.Response]:
+        """GET ``url`` with rate limiting and retries. Returns None when the page could not be fetched."""
+        for attempt in range(self.retries + 1):
+            self.rate_limiter.wait(url)
+            response = None
+            try:
+                response = self.session.get(url, timeout=self.timeout, **kwargs)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    return response
+                logger.warning(f"Got {response.status_code} for {url} (attempt {attempt + 1})")
+            except requests.RequestException as e:
+                logger.warning(f"Request to {url} failed (attempt {attempt + 1}): {e}")
+            if attempt < self.retries:
+                self.count("retried")
+                time.sleep(self.retry_delay(attempt, response))
+        return None
+
+    def mark_unchanged(self, url: str) -> None:
+        with self.stats_lock:
+            self.unchanged.add(url)
+
+    def fetch(self, url: str) -> Optional[bytes]:
+        headers = self.cache.conditional_headers(url) if self.cache else {}
+        response = self.get(url, headers=headers)
+        if response is not None and response.status_code == 304:
+            content = self.cache.read_body(url) if self.cache else None
+            if content is not None:
+                self.count("not_modified")
+                self.mark_unchanged(url)
+                return content
+            response = self.get(url)
+
+        if response is not None and response.status_code == 200:
+            self.count("fetched")
+            if self.cache:
+                changed = self.cache.store(url, response.content, response.headers.get("ETag"),
+                                           response.headers.get("Last-Modified"))
+                if not changed:
+                    # The server ignored the validators but sent the same body again
+                    self.mark_unchanged(url)
+            return response.content
+        with self.stats_lock:
+            self.stats["failed"] += 1
+            if response is None:
+                self.failed.add(url)
+        return None
+
+    def fetch_all(self, urls: Iterable[str]) -> Iterator[Tuple[str, Optional[bytes]]]:
+        """Yield ``(url, body)`` pairs in completion order, body is None for pages that could not be fetched."""
+        urls = list(urls)
+        start_time = time.time()
+        done_count = 0
+        pending = set()
+        url_iter = iter(urls)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {}
+            # Only keep a bounded number of submitted pages so that bodies are consumed as fast as they arrive
+            for url in url_iter:
+                future = executor.submit(self.fetch, url)
+                futures[future] = url
+                pending.add(future)
+                if len(pending) >= self.max_workers * 2:
+                    break
+
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    yield futures.pop(future), future.result()
+                    done_count += 1
+                    if done_count % self.progress_every == 0 or done_count == len(urls):
+                        elapsed = time.time() - start_time
+                        logger.info(f"Fetched {done_count}/{len(urls)} pages in {elapsed:.1f}s "
+                                    f"({done_count / max(elapsed, 1e-6):.1f} pages/s, {self.stats})")
+                    next_url = next(url_iter, None)
+                    if next_url is not None:
+                        next_future = executor.submit(self.fetch, next_url)
+                        futures[next_future] = next_url
+                        pending.add(next_future)
@@ -0,0 +1,154 @@
+import hashlib
+import re
+from collections import defaultdict
+from typing import Dict, List, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+DEDUP_THRESHOLD = 0.8
+DEDUP_MIN_WORDS = 8
+MINHASH_PERMUTATIONS = 128
+MINHASH_BANDS = 32
+SHINGLE_SIZE = 3
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+WORD = re.compile(r"\w+")
+
+
+def dedup_text(document: Document) -> str:
+    """
+    The part of a chunk that is compared, lower cased words only.
+    Structured chunks start with a "<name>: <field>" heading line that differs between documents, it is left out,
+    unless the body is shorter than ``DEDUP_MIN_WORDS``: a short body ("Born in Paris.") says too little on its
+    own, the same words in two documents are two different facts.
+    """
+    text = document.page_content
+    if "field" in document.metadata:
+        body = text.split("\n", 1)[-1]
+        if len(WORD.findall(body)) >= DEDUP_MIN_WORDS:
+            text = body
+    return " ".join(WORD.findall(text.lower()))
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> set:
+    words = text.split()
+    if len(words) <= size:
+        return {text}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+class MinHasher:
+    """MinHash signatures of shingle sets, bucketed for locality sensitive hashing over ``bands`` bands."""
+
+    def __init__(self, permutations: int = MINHASH_PERMUTATIONS, bands: int = MINHASH_BANDS, seed: int = 1):
+        if permutations % bands:
+            raise ValueError("permutations must be a multiple of bands")
+        generator = np.random.RandomState(seed)
+        self.a = generator.randint(1, MAX_HASH, size=permutations, dtype=np.uint64)
+        self.b = generator.randint(0, MAX_HASH, size=permutations, dtype=np.uint64)
+        self.bands = bands
+        self.rows = permutations // bands
+
+    def signature(self, shingle_set: set) -> np.ndarray:
+        hashes = np.array([int.from_bytes(hashlib.blake2b(shingle.encode(), digest_size=4).digest(), "little")
+                           for shingle in shingle_set], dtype=np.uint64)
+        # (a * x + b) stays under 2^64 because a, b and x are all 32 bit values
+        permuted = (np.outer(hashes, self.a) + self.b) % np.uint64(MERSENNE_PRIME)
+        return permuted.min(axis=0)
+
+    def band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [bytes([band]) + signature[band * self.rows:(band + 1) * self.rows].tobytes()
+                for band in range(self.bands)]
+
+
+def jaccard(first: set, second: set) -> float:
+    return len(first & second) / len(first | second)
+
+
+class ChunkDeduplicator:
+    """
+    Collapses duplicate chunks before they are embedded.
+    - Exact duplicates are found by hashing the normalized text, near duplicates with MinHash + LSH, a candidate
+      pair is only merged when the Jaccard similarity of its word shingles reaches ``threshold``.
+    - Every group keeps its first chunk, the metadata of the others is added to it under ``duplicates`` so
+      retrieval can still credit every source document.
+    - A partial refresh passes the chunks already in the index as ``stored``: a new chunk duplicating one of them
+      is added to its ``duplicates`` (in place) instead of being embedded again. Stored chunks are never merged
+      with each other.
+    - ``stats`` reports how many chunks and characters were saved.
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, hasher: MinHasher = None):
+        self.threshold = threshold
+        self.hasher = hasher or MinHasher()
+        self.stats = {}
+
+    def find_duplicates(self, texts: List[str], stored: int = 0) -> Tuple[List[int], int]:
+        """
+        Return the index of the chunk every chunk collapses into, and the number of exact duplicates.
+        The first ``stored`` texts are already indexed, they are only merged with the texts after them.
+        """
+        parent = list(range(len(texts)))
+
+        def find(i: int) -> int:
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        def union(i: int, j: int) -> None:
+            first, second = find(i), find(j)
+            if first != second and (first >= stored or second >= stored):
+                parent[max(first, second)] = min(first, second)
+
+        exact_duplicates = 0
+        first_by_hash = {}
+        unique = []
+        for i, text in enumerate(texts):
+            digest = hashlib.sha256(text.encode()).digest()
+            if digest in first_by_hash and i >= stored:
+                union(first_by_hash[digest], i)
+                exact_duplicates += 1
+            else:
+                first_by_hash.setdefault(digest, i)
+                unique.append(i)
+
+        shingle_sets = {i: shingles(texts[i]) for i in unique if texts[i]}
+        buckets = defaultdict(list)
+        for i, shingle_set in shingle_sets.items():
+            for key in self.hasher.band_keys(self.hasher.signature(shingle_set)):
+                buckets[key].append(i)
+        # LSH only proposes candidates, they are checked against the exact similarity of their shingles
+        for candidates in buckets.values():
+            for position, i in enumerate(candidates):
+                for j in candidates[position + 1:]:
+                    if j >= stored and find(i) != find(j) and \
+                            jaccard(shingle_sets[i], shingle_sets[j]) >= self.threshold:
+                        union(i, j)
+        return [find(i) for i in range(len(texts))], exact_duplicates
+
+    def deduplicate(self, documents: List[Document], stored: List[Document] = ()) -> List[Document]:
+        stored = list(stored)
+        groups, exact_duplicates = self.find_duplicates([dedup_text(document) for document in stored + documents],
+                                                        len(stored))
+
+        kept: Dict[int, Document] = dict(enumerate(stored))
+        for i, (document, group) in enumerate(zip(documents, groups[len(stored):]), len(stored)):
+            if group == i:
+                kept[i] = Document(page_content=document.page_content, metadata=dict(document.metadata))
+            else:
+                kept[group].metadata.setdefault("duplicates", []).append(document.metadata)
+        new = [document for i, document in kept.items() if i >= len(stored)]
+
+        removed = len(documents) - len(new)
+        self.stats = {"chunks": len(documents), "unique_chunks": len(new), "exact_duplicates": exact_duplicates,
+                      "near_duplicates": removed - exact_duplicates,
+                      "chars_saved": sum(len(document.page_content) for document in documents) -
+                      sum(len(document.page_content) for document in new)}
+        return new
+
+
+def document_sources(document: Document) -> List[Dict]:
+    """The metadata of every chunk a (possibly deduplicated) chunk stands for."""
+    return [document.metadata, *document.metadata.get("duplicates", [])]
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from lib import logger
+from refresh.embedding_scheduler import EmbeddingScheduler
+
+EMBEDDING_CACHE_PATH = "data/embedding_cache.sqlite"
+LOOKUP_BATCH_SIZE = 500
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def embedding_model_name(embeddings: Embeddings) -> str:
+    return getattr(embeddings, "model", None) or type(embeddings).__name__
+
+
+class EmbeddingCache:
+    """Persistent store of chunk vectors keyed by (embedding model, sha256 of the chunk text)."""
+
+    def __init__(self, path: str = EMBEDDING_CACHE_PATH):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (model TEXT NOT NULL, text_hash TEXT NOT NULL, "
+                                "vector BLOB NOT NULL, PRIMARY KEY (model, text_hash))")
+        self.connection.commit()
+
+    def get_many(self, model: str, hashes: List[str]) -> Dict[str, List[float]]:
+        found = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        with self.lock:
+            for i in range(0, len(unique_hashes), LOOKUP_BATCH_SIZE):
+                batch = unique_hashes[i:i + LOOKUP_BATCH_SIZE]
+                rows = self.connection.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN "
+                    f"({', '.join('?' * len(batch))})", [model, *batch]).fetchall()
+                for digest, vector in rows:
+                    found[digest] = np.frombuffer(vector, dtype=np.float32).tolist()
+        return found
+
+    def put_many(self, model: str, items: Dict[str, List[float]]) -> None:
+        with self.lock:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, vector) VALUES (?, ?, ?)",
+                [(model, digest, np.asarray(vector, dtype=np.float32).tobytes()) for digest, vector in items.items()])
+            self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embeddings model so that document chunks are only sent to it when their text isn't cached yet.
+    Queries are never cached. ``stats`` keeps the hit rate and an estimate of the embedding time saved.
+    """
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = embedding_model_name(embeddings)
+        self.stats = {"hits": 0, "misses": 0, "embed_seconds": 0.0}
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(text) for text in texts]
+        vectors = self.cache.get_many(self.model, hashes)
+
+        missing = {digest: text for digest, text in zip(hashes, texts) if digest not in vectors}
+        if missing:
+            start_time = time.time()
+            if isinstance(self.embeddings, EmbeddingScheduler):
+                # Checkpoint every finished batch so an interrupted build resumes from the cache
+                new_vectors = self.embeddings.embed_documents(list(missing.values()), on_batch=self.store_batch)
+            else:
+                new_vectors = self.embeddings.embed_documents(list(missing.values()))
+                self.store_batch(list(missing.values()), new_vectors)
+            self.stats["embed_seconds"] += time.time() - start_time
+            vectors.update(zip(missing.keys(), new_vectors))
+
+        self.stats["misses"] += len(missing)
+        self.stats["hits"] += len(texts) - len(missing)
+        return [vectors[digest] for digest in hashes]
+
+    def store_batch(self, texts: List[str], vectors: List[List[float]]) -> None:
+        self.cache.put_many(self.model, {text_hash(text): vector for text, vector in zip(texts, vectors)})
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embeddings.embed_query(text)
+
+    def report(self) -> Dict:
+        total = self.stats["hits"] + self.stats["misses"]
+        seconds_per_text = self.stats["embed_seconds"] / self.stats["misses"] if self.stats["misses"] else 0.0
+        report = {**self.stats,
+                  "hit_rate": self.stats["hits"] / total if total else 0.0,
+                  "estimated_seconds_saved": self.stats["hits"] * seconds_per_text}
+        logger.info(f"Embedding cache ({self.model}): {report['hits']}/{total} chunks cached "
+                    f"({report['hit_rate']:.1%}), ~{report['estimated_seconds_saved']:.1f}s saved")
+        return report
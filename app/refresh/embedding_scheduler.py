@@ -0,0 +1,160 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+import openai
+import tiktoken
+from langchain_core.embeddings import Embeddings
+from openai import OpenAI
+
+from lib import logger
+
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "text-embedding-ada-002")
+EMBEDDING_REQUESTS_PER_MINUTE = int(os.environ.get("EMBEDDING_RPM", 3000))
+EMBEDDING_TOKENS_PER_MINUTE = int(os.environ.get("EMBEDDING_TPM", 1000000))
+EMBEDDING_MAX_IN_FLIGHT = int(os.environ.get("EMBEDDING_MAX_IN_FLIGHT", 4))
+EMBEDDING_BATCH_TOKENS = 8000
+EMBEDDING_BATCH_SIZE = 2048
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError,
+                    openai.InternalServerError)
+
+
+@lru_cache(maxsize=1)
+def cl100k_encoding() -> tiktoken.Encoding:
+    # tiktoken downloads the encoding the first time it is used, it is then read from its cache directory
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def count_cl100k_tokens(text: str) -> int:
+    """Tokens of ``text`` for the OpenAI embedding models."""
+    return len(cl100k_encoding().encode(text))
+
+
+class RateBudget:
+    """Sliding window budget of requests and tokens per ``window`` seconds, shared by all worker threads."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int, window: float = 60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self.events = deque()
+        self.used_tokens = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                while self.events and self.events[0][0] <= now - self.window:
+                    self.used_tokens -= self.events.popleft()[1]
+                # A single batch bigger than the whole token budget is let through once the window is empty
+                if len(self.events) < self.requests_per_minute and \
+                        (self.used_tokens + tokens <= self.tokens_per_minute or not self.events):
+                    self.events.append((now, tokens))
+                    self.used_tokens += tokens
+                    return
+                wait = self.events[0][0] + self.window - now
+            time.sleep(max(wait, 0.01))
+
+
+class EmbeddingScheduler(Embeddings):
+    """
+    Embeds large sets of chunks within the account's rate limits.
+    - Chunks are packed into batches of at most ``max_batch_tokens`` tokens.
+    - Up to ``max_in_flight`` batches are sent at once, each one waiting for room in the RPM/TPM budget.
+    - Rate limit, connection and server errors are retried with exponential backoff, honouring Retry-After.
+    - ``on_batch`` is called with every finished batch so the caller can checkpoint it, a crashed build then
+      only has to embed the batches that never finished.
+    - ``count_tokens`` counts the tokens of a text, the cl100k tokenizer of the OpenAI models by default.
+    """
+
+    def __init__(self, model: str = EMBEDDING_MODEL, client: OpenAI = None,
+                 requests_per_minute: int = EMBEDDING_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: int = EMBEDDING_TOKENS_PER_MINUTE,
+                 max_in_flight: int = EMBEDDING_MAX_IN_FLIGHT, max_batch_tokens: int = EMBEDDING_BATCH_TOKENS,
+                 max_batch_size: int = EMBEDDING_BATCH_SIZE, retries: int = 6, backoff: float = 1.0,
+                 budget: RateBudget = None, count_tokens: Callable[[str], int] = count_cl100k_tokens):
+        self.model = model
+        self.client = client or OpenAI(max_retries=0)
+        self.max_in_flight = max_in_flight
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.budget = budget or RateBudget(requests_per_minute, tokens_per_minute)
+        self.count_tokens = count_tokens
+        self.stats = {"requests": 0, "retries": 0, "tokens": 0}
+        self.stats_lock = threading.Lock()
+
+    def pack_batches(self, texts: List[str]) -> List[Tuple[List[int], int]]:
+        """Group text indexes into (indexes, token count) batches that stay under the token and size limits."""
+        batches, batch, batch_tokens = [], [], 0
+        for i, text in enumerate(texts):
+            tokens = self.count_tokens(text)
+            if batch and (batch_tokens + tokens > self.max_batch_tokens or len(batch) >= self.max_batch_size):
+                batches.append((batch, batch_tokens))
+                batch, batch_tokens = [], 0
+            batch.append(i)
+            batch_tokens += tokens
+        if batch:
+            batches.append((batch, batch_tokens))
+        return batches
+
+    def retry_delay(self, attempt: int, error: Exception) -> float:
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        try:
+            return float(retry_after)
+        except (TypeError, ValueError):
+            return self.backoff * (2 ** attempt)
+
+    def embed_batch(self, texts: List[str], tokens: int) -> List[List[float]]:
+        for attempt in range(self.retries + 1):
+            self.budget.acquire(tokens)
+            try:
+                response = self.client.embeddings.create(model=self.model, input=texts, encoding_format="float")
+                with self.stats_lock:
+                    self.stats["requests"] += 1
+                    self.stats["tokens"] += tokens
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.retry_delay(attempt, e)
+                with self.stats_lock:
+                    self.stats["retries"] += 1
+                logger.warning(f"Embedding batch of {len(texts)} texts failed ({type(e).__name__}), "
+                               f"retrying in {delay:.1f}s")
+                time.sleep(delay)
+
+    def embed_documents(self, texts: List[str],
+                        on_batch: Optional[Callable[[List[str], List[List[float]]], None]] = None) -> List[List[float]]:
+        vectors: List[Optional[List[float]]] = [None] * len(texts)
+        batches = self.pack_batches(texts)
+        start_time = time.time()
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            futures = {executor.submit(self.embed_batch, [texts[i] for i in batch], tokens): batch
+                       for batch, tokens in batches}
+            try:
+                for done, future in enumerate(as_completed(futures), start=1):
+                    batch = futures[future]
+                    batch_vectors = future.result()
+                    for i, vector in zip(batch, batch_vectors):
+                        vectors[i] = vector
+                    if on_batch:
+                        on_batch([texts[i] for i in batch], batch_vectors)
+                    logger.info(f"Embedded batch {done}/{len(batches)} ({time.time() - start_time:.1f}s, "
+                                f"{self.stats})")
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_batch([text], self.count_tokens(text))[0]
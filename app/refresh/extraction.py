@@ -0,0 +1,83 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Tuple
+
+from lib import logger
+
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", os.cpu_count() or 1))
+EXTRACT_BATCH_SIZE = 16
+
+
+def extract_batch(extract: Callable[[str, bytes], Dict],
+                  batch: List[Tuple[str, str, bytes]]) -> List[Tuple[str, Dict]]:
+    return [(url, extract(key, content)) for url, key, content in batch]
+
+
+class ParallelExtractor:
+    """
+    Parses and extracts raw XML bodies on a pool of worker processes while the crawler is still fetching.
+    - ``extract(key, content)`` must be a module level function so that it can be sent to the workers.
+    - Pages are sent in batches of up to ``batch_size`` to amortize the inter-process overhead, at most
+      ``2 * workers`` batches are queued and results are yielded as soon as a batch is ready.
+    - With a single worker, pages are extracted inline without starting a pool.
+    - Workers are spawned like the job workers (jobs/runner.py), not forked from a process that may be running
+      the crawler's threads and holding their locks.
+    """
+
+    def __init__(self, extract: Callable[[str, bytes], Dict], workers: int = EXTRACT_WORKERS,
+                 batch_size: int = EXTRACT_BATCH_SIZE, progress_every: int = 100):
+        self.extract = extract
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.progress_every = progress_every
+
+    def map(self, pages: Iterable[Tuple[str, str, bytes]]) -> Iterator[Tuple[str, Dict]]:
+        """Extract ``(url, key, content)`` pages and yield ``(url, document)`` pairs in completion order."""
+        start_time = time.time()
+        done_count = 0
+
+        if self.workers == 1:
+            for url, key, content in pages:
+                yield url, self.extract(key, content)
+                done_count += 1
+                self.log_progress(done_count, start_time)
+            return
+
+        with ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+            pending: Set[Future] = set()
+
+            def drain(limit: int) -> Iterator[Tuple[str, Dict]]:
+                nonlocal pending, done_count
+                while len(pending) > limit:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        for url, document in future.result():
+                            yield url, document
+                            done_count += 1
+                            self.log_progress(done_count, start_time)
+
+            try:
+                batch = []
+                for page in pages:
+                    batch.append(page)
+                    if len(batch) < self.batch_size:
+                        continue
+                    pending.add(executor.submit(extract_batch, self.extract, batch))
+                    batch = []
+                    # Keep the queue short so that bodies don't pile up in memory when extraction is the bottleneck
+                    yield from drain(self.workers * 2 - 1)
+                if batch:
+                    pending.add(executor.submit(extract_batch, self.extract, batch))
+                yield from drain(0)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    def log_progress(self, done_count: int, start_time: float) -> None:
+        if done_count % self.progress_every == 0:
+            elapsed = time.time() - start_time
+            logger.info(f"Extracted {done_count} pages in {elapsed:.1f}s ({done_count / max(elapsed, 1e-6):.1f} "
+                        f"pages/s, {self.workers} workers)")
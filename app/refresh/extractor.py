@@ -0,0 +1,219 @@
+import re
+import textwrap
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional
+
+TAG = re.compile(r'<.*?>')
+SITE_URL = "https://www.theartstory.org"
+SOURCE_LINK = SITE_URL + "/{type}/{slug}/"
+IFRAME_LINK = SITE_URL + "/data/content/dynamic_content/ai-card/{type}/{slug}"
+ARTIST_IMAGE = SITE_URL + "/images20/ttip/{id}.jpg"
+
+# How the link of a resource entry is written out: (output key, template), a None template keeps the raw link
+ENTRY_LINKS = {
+    "book": ("amazon_link", "https://www.amazon.com/gp/product/{}?tag=tharst-20"),
+    "page": ("tas_link", SITE_URL + "{}"),
+    "link": ("link", None),
+}
+
+PERSON_MAIN = [("name", "name"), ("years_worked", "years"), ("description", "description"),
+               ("art_description", "art_description"), ("nationality", "nationality"), ("occupation", "occupation")]
+PERSON_DATES = [("birthDate", "birthDate"), ("birthPlace", "birthPlace"), ("deathDate", "deathDate"),
+                ("deathPlace", "deathPlace")]
+PERSON_SNAKE_DATES = [("birth_date", "birthDate"), ("birth_place", "birthPlace"), ("death_date", "deathDate"),
+                      ("death_place", "deathPlace")]
+PUBLISH_DATE = [("content_publish_date", "pub_time")]
+
+# Field spec of every content type, in the order the fields are written to the JSON files.
+# - links: built from the id of <main>
+# - main: (key, tag) read from the children of <main>, or (key, tag, True) to strip tags (default "")
+# - body: fields collected from the rest of the document
+# - entries: (key, kind, [(category name, subcategory name), ...]) resource lists, None matches any name
+CONTENT_SPECS = {
+    "artist": {
+        "links": [("source_link", SOURCE_LINK), ("iframe_link", IFRAME_LINK), ("artist_image", ARTIST_IMAGE)],
+        "main": PERSON_MAIN + PERSON_DATES + PUBLISH_DATE,
+        "body": ["quotes", "synopsis", "similar_artists", "key_ideas", "sections", "artworks"],
+        "entries": [("recommended_books", "book", [(None, "not_to_show")]),
+                    ("extra_links", "link", [("web resources", None)])],
+    },
+    "movement": {
+        "links": [("source_link", SOURCE_LINK), ("iframe_link", IFRAME_LINK)],
+        "main": [("name", "name"), ("years_developed", "years"), ("description", "description"),
+                 ("art_title", "art_title"), ("art_description", "art_description"),
+                 ("biography_highlights", "bio_highlight", True)] + PUBLISH_DATE,
+        "body": ["quotes", "synopsis", "key_ideas", "sections", "artworks"],
+        "entries": [("recommended_pages", "page", [("art story website features", "not_to_show")]),
+                    ("amazon_links", "book", [("featured books", None)]),
+                    ("extra_links", "link", [("resources", None)])],
+    },
+    "definition": {
+        "links": [("source_link", SOURCE_LINK), ("iframe_link", IFRAME_LINK)],
+        "main": [("name", "name"), ("start_date", "start")] + PUBLISH_DATE,
+        "body": ["quotes", "synopsis", "key_ideas", "sections", "artworks"],
+        "entries": [("amazon_links", "book", [("featured books", None)]),
+                    ("extra_links", "link", [("web resources", None)])],
+    },
+    "critic": {
+        "links": [("source_link", SOURCE_LINK), ("iframe_link", IFRAME_LINK)],
+        "main": PERSON_MAIN + PERSON_SNAKE_DATES + PUBLISH_DATE,
+        "body": ["quotes", "synopsis", "key_ideas", "sections", "artworks"],
+        "entries": [("recommended_pages", "page", [("art story website", None)]),
+                    ("amazon_links", "book", [("featured books", None)]),
+                    ("extra_links", "link", [("web resources", None)])],
+    },
+    "influencer": {
+        "links": [("source_link", SOURCE_LINK), ("iframe_link", IFRAME_LINK)],
+        "main": PERSON_MAIN + PERSON_SNAKE_DATES + PUBLISH_DATE,
+        "body": ["quotes", "synopsis", "key_ideas", "sections", "artworks"],
+        "entries": [("recommended_books", "book", [("featured books", "written by artist"),
+                                                   ("featured books", "biography")]),
+                    ("extra_links", "link", [("web resources", None)])],
+    },
+}
+
+
+WALKED_TAGS = {'main', 'q', 'idea', 'artist', 'synopsys', 'entry', 'section', 'subsection', 'p', 'artworks',
+               'artwork'}
+
+
+def strip_tags(text: Optional[str]) -> str:
+    if not text:
+        return ''
+    return TAG.sub('', text) if '<' in text else text
+
+
+class DocumentWalker:
+    """
+    Collects every field of one document in a single depth-first walk of its tree.
+    Matching follows the ElementTree paths the field lists were defined with (``.//quotes/q``,
+    ``.//article/synopsys``, ``section.iter('subsection')``...), so the output is the same.
+    """
+
+    def __init__(self, doc_type: str):
+        self.doc_type = doc_type
+        self.spec = CONTENT_SPECS[doc_type]
+        self.main = None
+        self.main_values = {}
+        self.quotes, self.similar_artists, self.key_ideas = [], [], []
+        self.synopsis = None
+        self.sections, self.open_sections = [], []
+        self.open_sub_sections = []
+        self.artwork_groups, self.open_artwork_groups = [], []
+        self.entries = {key: [[] for _ in patterns] for key, _, patterns in self.spec["entries"]}
+
+    def visit(self, element: ET.Element, parent: ET.Element = None, grandparent: ET.Element = None,
+              depth: int = 0) -> None:
+        tag = element.tag
+        pushed = None
+        if parent is not None:
+            if tag == 'main' and depth == 1 and self.main is None:
+                self.main = element
+            elif tag == 'q' and parent.tag == 'quotes' and depth >= 2:
+                self.quotes.append(element.text)
+            elif tag == 'idea':
+                self.key_ideas.append(strip_tags(element.text))
+            elif tag == 'artist':
+                self.similar_artists.append(element.text)
+            elif tag == 'synopsys' and parent.tag == 'article' and depth >= 2 and self.synopsis is None:
+                self.synopsis = strip_tags(element.text)
+            elif tag == 'entry' and parent.tag == 'subcategory' and grandparent is not None and \
+                    grandparent.tag == 'category' and depth >= 3:
+                self.add_entry(element, grandparent.get('name'), parent.get('name'))
+        if tag == 'section':
+            section = {'title': element.get('title'), 'sub_sections': []}
+            self.sections.append(section)
+            self.open_sections.append(section)
+            pushed = self.open_sections
+        elif tag == 'subsection':
+            sub_section = {'title': element.get('title'), 'content': [], 'url': []}
+            for section in self.open_sections:
+                section['sub_sections'].append(sub_section)
+            self.open_sub_sections.append(sub_section)
+            pushed = self.open_sub_sections
+        elif tag == 'p':
+            self.add_paragraph(element)
+        elif tag == 'artworks':
+            group = []
+            self.artwork_groups.append(group)
+            self.open_artwork_groups.append(group)
+            pushed = self.open_artwork_groups
+        elif tag == 'artwork':
+            for group in self.open_artwork_groups:
+                group.append(element)
+
+        if element is self.main:
+            for child in element:
+                self.main_values.setdefault(child.tag, child.text or '')
+        for child in element:
+            # Leaves that no field is read from are not worth a call
+            if len(child) or child.tag in WALKED_TAGS:
+                self.visit(child, element, parent, depth + 1)
+
+        if pushed is not None:
+            finished = pushed.pop()
+            if pushed is self.open_sub_sections:
+                finished['content'] = ' '.join(finished['content'])
+
+    def add_paragraph(self, element: ET.Element) -> None:
+        paragraph_type = element.get('type')
+        if paragraph_type == 'p':
+            content = strip_tags(' '.join(element.itertext()) if len(element) else element.text).strip()
+            for sub_section in self.open_sub_sections:
+                sub_section['content'].append(content)
+        elif paragraph_type == 'img':
+            url = {'alt_name': element.get('alt'), 'url': strip_tags(f'{SITE_URL}{element.text}')}
+            for sub_section in self.open_sub_sections:
+                sub_section['url'].append(url)
+
+    def add_entry(self, element: ET.Element, category: str, subcategory: str) -> None:
+        for key, kind, patterns in self.spec["entries"]:
+            for i, (category_name, subcategory_name) in enumerate(patterns):
+                if category_name in (None, category) and subcategory_name in (None, subcategory):
+                    link_key, template = ENTRY_LINKS[kind]
+                    link = element.findtext('link')
+                    self.entries[key][i].append({'title': element.findtext('title'), 'info': element.findtext('info'),
+                                                 link_key: link if template is None else template.format(link)})
+
+    def artworks(self, doc_id: str) -> List[Dict]:
+        artworks_list = []
+        for group in self.artwork_groups:
+            for i, artwork in enumerate(group):
+                use_big_image = artwork.find('use_big_image')
+                artworks_list.append({
+                    'title': artwork.find('title').text,
+                    'year': artwork.find('year').text,
+                    'materials': artwork.find('materials').text,
+                    'description': strip_tags(textwrap.dedent(artwork.find('desc').text)),
+                    'collection': artwork.find('collection').text,
+                    'url': f'{SITE_URL}/images20/works/{doc_id}_{i + 1}.jpg'
+                    if use_big_image is not None and bool(use_big_image.text) else
+                    f'{SITE_URL}/images20/pnt/pnt_{doc_id}_{i + 1}.jpg'
+                })
+        return artworks_list
+
+    def document(self) -> Dict:
+        data = {}
+        doc_id = None
+        if self.main is not None:
+            doc_id = self.main_values.get('id')
+            slug = doc_id.replace('_', '-')
+            for key, template in self.spec["links"]:
+                data[key] = template.format(type=self.doc_type, slug=slug, id=doc_id)
+            for key, tag, *stripped in self.spec["main"]:
+                data[key] = strip_tags(self.main_values.get(tag, '')) if stripped else self.main_values.get(tag)
+
+        body = {"quotes": self.quotes, "synopsis": self.synopsis or '', "similar_artists": self.similar_artists,
+                "key_ideas": self.key_ideas, "sections": self.sections}
+        for key in self.spec["body"]:
+            data[key] = self.artworks(doc_id) if key == "artworks" else body[key]
+        for key, _, _ in self.spec["entries"]:
+            data[key] = [entry for entries in self.entries[key] for entry in entries]
+        return {doc_id: data, "type": self.doc_type, "id": doc_id}
+
+
+def extract_document(doc_type: str, root: ET.Element) -> Dict:
+    """Extract a parsed content page of any type in one pass, following its CONTENT_SPECS entry."""
+    walker = DocumentWalker(doc_type)
+    walker.visit(root)
+    return walker.document()
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import os
+import threading
+from typing import Dict, Optional
+
+HTTP_CACHE_PATH = "data/http_cache/"
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class HttpCache:
+    """
+    Remembers what every refresh URL looked like the last time it was fetched.
+    - The index maps URL -> ETag, Last-Modified and content hash, the raw body is kept next to it on disk.
+    - Updates are held in memory until ``save`` so a refresh that fails half way doesn't mark pages as processed.
+    """
+
+    def __init__(self, path: str = HTTP_CACHE_PATH):
+        self.path = path
+        self.index_file = os.path.join(path, "index.json")
+        self.lock = threading.Lock()
+        self.entries: Dict[str, Dict] = {}
+        if os.path.exists(self.index_file):
+            with open(self.index_file, "r") as f:
+                self.entries = json.load(f)
+
+    def body_path(self, url: str) -> str:
+        return os.path.join(self.path, f"{hashlib.sha1(url.encode()).hexdigest()}.body")
+
+    def get(self, url: str) -> Optional[Dict]:
+        with self.lock:
+            return self.entries.get(url)
+
+    def conditional_headers(self, url: str) -> Dict:
+        entry = self.get(url)
+        if not entry or not os.path.exists(self.body_path(url)):
+            return {}
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def read_body(self, url: str) -> Optional[bytes]:
+        try:
+            with open(self.body_path(url), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, url: str, content: bytes, etag: str = None, last_modified: str = None) -> bool:
+        """Cache a fresh response. Returns True when the body differs from the cached one."""
+        digest = content_hash(content)
+        previous = self.get(url)
+        changed = previous is None or previous.get("hash") != digest
+        if changed or not os.path.exists(self.body_path(url)):
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.body_path(url), "wb") as f:
+                f.write(content)
+        with self.lock:
+            self.entries[url] = {"etag": etag, "last_modified": last_modified, "hash": digest}
+        return changed
+
+    def save(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        with self.lock:
+            data = json.dumps(self.entries)
+        tmp_file = f"{self.index_file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(data)
+        os.replace(tmp_file, self.index_file)
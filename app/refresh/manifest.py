@@ -0,0 +1,82 @@
+import hashlib
+import json
+import os
+from collections import defaultdict
+from typing import Dict, Iterable, List, Set, Tuple
+
+from refresh.dedup import document_sources
+
+
+def document_hash(document: Dict) -> str:
+    """Hash of a document's content that doesn't depend on key order or indentation."""
+    return hashlib.sha256(json.dumps(document, sort_keys=True).encode()).hexdigest()
+
+
+def build_manifest(documents: Iterable[Dict]) -> Dict[str, str]:
+    return {document["json_file"]: document_hash(document) for document in documents}
+
+
+def build_manifest_from_json_files(json_store_path: str) -> Dict[str, str]:
+    """Rebuild the manifest from the JSON files of a previous refresh, reading each file once."""
+    manifest = {}
+    if not os.path.exists(json_store_path):
+        return manifest
+    for file in os.listdir(json_store_path):
+        with open(os.path.join(json_store_path, file), 'r') as f:
+            document = json.load(f)
+        manifest[document.get("json_file", file)] = document_hash(document)
+    return manifest
+
+
+def load_manifest(path: str, json_store_path: str) -> Dict[str, str]:
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            return json.load(f)
+    return build_manifest_from_json_files(json_store_path)
+
+
+def save_manifest(manifest: Dict[str, str], path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def diff_manifest(previous: Dict[str, str], current: Dict[str, str], unchanged: Set[str] = frozenset(),
+                  failed: Set[str] = frozenset()) -> Tuple[Set[str], Set[str], Set[str]]:
+    """
+    Compare two manifests in linear time and return the (added, changed, deleted) json file names.
+    ``unchanged`` lists files that were not re-extracted in this run but still exist upstream, ``failed`` the
+    files whose page could not be fetched: neither is deleted, they keep their previous content.
+    """
+    added = {name for name in current if name not in previous}
+    changed = {name for name, digest in current.items() if name in previous and previous[name] != digest}
+    deleted = {name for name in previous if name not in current and name not in unchanged and name not in failed}
+    return added, changed, deleted
+
+
+def index_docstore_by_json_file(vector_store) -> Dict[str, List[str]]:
+    """Map every json file to the ids of its chunks in the vector store docstore, deduplicated chunks included."""
+    file_ids = defaultdict(list)
+    for k_id, document in vector_store.docstore._dict.items():
+        for metadata in document_sources(document):
+            file_ids[metadata.get('json_file')].append(k_id)
+    return file_ids
+
+
+def expand_shared_chunks(vector_store, file_names: Set[str]) -> Tuple[Set[str], List[str]]:
+    """
+    Return the json files whose chunks have to be rebuilt together with ``file_names`` and the chunk ids to delete.
+    A deduplicated chunk stands for several files, when one of them changes, the others are rebuilt with it.
+    """
+    chunk_files = {k_id: {metadata.get('json_file') for metadata in document_sources(document)}
+                   for k_id, document in vector_store.docstore._dict.items()}
+    file_ids = index_docstore_by_json_file(vector_store)
+    files, pending = set(file_names), list(file_names)
+    while pending:
+        for k_id in file_ids.get(pending.pop(), []):
+            for file_name in chunk_files[k_id] - files:
+                files.add(file_name)
+                pending.append(file_name)
+    return files, list(dict.fromkeys(k_id for file_name in files for k_id in file_ids.get(file_name, [])))
@@ -0,0 +1,788 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import xml.etree.ElementTree as ET
+from functools import partial
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+import openai
+from langchain_community.embeddings import DeterministicFakeEmbedding
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+import ats_refresh
+from ai import ConversationalRAG
+from ats_refresh import (create_local_database, create_partial_local_database, extract_page, get_xml_files,
+                         get_vector_store, extract_xml_data)
+from jobs import JobConflict, JobRunner, JOB_STAGES
+from models import RefreshJob
+from refresh import (HostRateLimiter, HttpCache, XmlCrawler, build_manifest, diff_manifest, save_manifest,
+                     CachedEmbeddings, EmbeddingCache, EmbeddingScheduler, RateBudget, StructuredChunker,
+                     ChunkDeduplicator, expand_shared_chunks, ParallelExtractor)
+from stores import (VersionedStore, ArtifactSync, LocalBackend, MappedFlatIndex, ColumnarDocstore, convert_docstore,
+                    pull_lock, MAPPED_VECTORS_FILE)
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_fixtures")
+
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    """Serves the fixture sitemap and XML files, failing the first request of every path in ``flaky_paths``."""
+    flaky_paths = set()
+    failed_paths = set()
+    in_flight = 0
+    max_in_flight = 0
+    request_count = 0
+    lock = threading.Lock()
+    delay = 0.0
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.request_count += 1
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            fail = self.path in cls.flaky_paths and self.path not in cls.failed_paths
+            if fail:
+                cls.failed_paths.add(self.path)
+        try:
+            time.sleep(cls.delay)
+            if fail:
+                self.send_error(503)
+            else:
+                super().do_GET()
+        finally:
+            with cls.lock:
+                cls.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LocalSiteTestCase(unittest.TestCase):
+    site_path = FIXTURES_PATH
+
+    def setUp(self):
+        FixtureHandler.flaky_paths = set()
+        FixtureHandler.failed_paths = set()
+        FixtureHandler.max_in_flight = FixtureHandler.request_count = 0
+        FixtureHandler.delay = 0.0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), partial(FixtureHandler, directory=self.site_path))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.sitemap_url = f"{self.base_url}/sitemap.htm"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestXmlCrawler(LocalSiteTestCase):
+
+    def test_get_xml_files(self):
+        data_dict = get_xml_files(self.sitemap_url)
+        self.assertEqual(len(data_dict["artist"]), 3)
+        self.assertIn(f"{self.base_url}/data/content/movement/impressionism.xml", data_dict["movement"])
+        self.assertEqual(len(data_dict["critic"]), 1)
+
+    def test_create_local_database(self):
+        FixtureHandler.flaky_paths = {"/data/content/artist/kahlo_frida.xml"}
+        crawler = XmlCrawler(max_workers=4, requests_per_second=0, backoff=0.01)
+        final_data = create_local_database(self.sitemap_url, crawler)
+
+        self.assertEqual(sorted(item["json_file"] for item in final_data),
+                         ["freud_sigmund.json", "greenberg_clement.json", "impressionism.json",
+                          "kahlo_frida.json", "monet_claude.json", "sfumato.json"])
+        monet = next(item for item in final_data if item["id"] == "monet_claude")
+        self.assertEqual(monet["type"], "artist")
+        self.assertEqual(monet["monet_claude"]["name"], "Claude Monet")
+        self.assertEqual(crawler.stats, {"fetched": 6, "not_modified": 0, "failed": 1, "retried": 1})
+
+    def test_parallel_extraction_matches_serial(self):
+        serial = create_local_database(self.sitemap_url, XmlCrawler(requests_per_second=0),
+                                       extractor=ParallelExtractor(extract_page, workers=1))
+        streamed = []
+        parallel = create_local_database(self.sitemap_url, XmlCrawler(requests_per_second=0),
+                                         extractor=ParallelExtractor(extract_page, workers=2),
+                                         on_extracted=streamed.append)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(len(streamed), 6)
+
+    def test_bounded_concurrency(self):
+        FixtureHandler.delay = 0.05
+        urls = [f"{self.base_url}/data/content/artist/monet_claude.xml"] * 20
+        with XmlCrawler(max_workers=3, requests_per_second=0) as crawler:
+            results = list(crawler.fetch_all(urls))
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(content for _, content in results))
+        self.assertLessEqual(FixtureHandler.max_in_flight, 3)
+
+    def test_gives_up_after_retries(self):
+        FixtureHandler.flaky_paths = {"/data/content/definition/sfumato.xml"}
+        with XmlCrawler(retries=0, requests_per_second=0) as crawler:
+            self.assertIsNone(crawler.fetch(f"{self.base_url}/data/content/definition/sfumato.xml"))
+        self.assertEqual(crawler.stats["failed"], 1)
+
+
+class TestConditionalFetch(LocalSiteTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.cache_path = os.path.join(self.temp_dir.name, "http_cache")
+
+    def tearDown(self):
+        super().tearDown()
+        self.temp_dir.cleanup()
+
+    def test_second_crawl_is_not_modified(self):
+        urls = [f"{self.base_url}/data/content/artist/monet_claude.xml",
+                f"{self.base_url}/data/content/movement/impressionism.xml"]
+        cache = HttpCache(self.cache_path)
+        with XmlCrawler(requests_per_second=0, cache=cache) as crawler:
+            first = dict(crawler.fetch_all(urls))
+        self.assertEqual(crawler.unchanged, set())
+        cache.save()
+
+        with XmlCrawler(requests_per_second=0, cache=HttpCache(self.cache_path)) as crawler:
+            second = dict(crawler.fetch_all(urls))
+        self.assertEqual(second, first)
+        self.assertEqual(crawler.unchanged, set(urls))
+        self.assertEqual(crawler.stats["not_modified"], 2)
+        self.assertEqual(crawler.stats["fetched"], 0)
+
+    def test_unchanged_pages_are_skipped(self):
+        json_path = os.path.join(self.temp_dir.name, "json_files")
+        os.makedirs(json_path)
+        with mock.patch("ats_refresh.JSON_STORE_PATH", json_path):
+            cache = HttpCache(self.cache_path)
+            for item in create_local_database(self.sitemap_url, XmlCrawler(requests_per_second=0, cache=cache)):
+                open(os.path.join(json_path, item["json_file"]), "w").close()
+            cache.save()
+            os.remove(os.path.join(json_path, "sfumato.json"))
+
+            crawler = XmlCrawler(requests_per_second=0, cache=HttpCache(self.cache_path))
+            final_data = create_local_database(self.sitemap_url, crawler, skip_unchanged=True)
+        self.assertEqual([item["json_file"] for item in final_data], ["sfumato.json"])
+        self.assertEqual(len(crawler.unchanged), 6)
+
+
+class TestPartialRefresh(LocalSiteTestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.site_path = os.path.join(self.temp_dir.name, "site")
+        shutil.copytree(FIXTURES_PATH, self.site_path)
+        super().setUp()
+        self.json_path = os.path.join(self.temp_dir.name, "json_files/")
+        os.makedirs(self.json_path)
+        self.patches = [
+            mock.patch("ats_refresh.JSON_STORE_PATH", self.json_path),
+            mock.patch("ats_refresh.VECTOR_STORE_PATH", os.path.join(self.temp_dir.name, "vector_store/")),
+            mock.patch("ats_refresh.MANIFEST_PATH", os.path.join(self.temp_dir.name, "manifest.json")),
+            mock.patch("ats_refresh.EMBEDDING_CACHE_PATH", os.path.join(self.temp_dir.name, "embeddings.sqlite")),
+            mock.patch("ats_refresh.EmbeddingScheduler", lambda: DeterministicFakeEmbedding(size=16)),
+            mock.patch("ats_refresh.IMAGE_STORE_PATH", os.path.join(self.temp_dir.name, "image_vector")),
+            mock.patch("ats_refresh.IFRAME_STORE_PATH", os.path.join(self.temp_dir.name, "iframe_store")),
+            mock.patch("ats_refresh.IMAGES_JSON_PATH", os.path.join(self.temp_dir.name, "images.json")),
+            mock.patch("ats_refresh.IFRAME_JSON_PATH", os.path.join(self.temp_dir.name, "iframe.json")),
+        ]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        super().tearDown()
+        self.temp_dir.cleanup()
+
+    def crawler(self):
+        return XmlCrawler(requests_per_second=0, cache=HttpCache(os.path.join(self.temp_dir.name, "http_cache")))
+
+    def chunk_files(self, vector_store):
+        return {document.metadata["json_file"] for document in vector_store.docstore._dict.values()}
+
+    def test_diff_manifest(self):
+        previous = {"a.json": "1", "b.json": "2", "c.json": "3", "d.json": "4"}
+        current = {"a.json": "1", "b.json": "changed", "e.json": "5"}
+        self.assertEqual(diff_manifest(previous, current, {"d.json"}), ({"e.json"}, {"b.json"}, {"c.json"}))
+        self.assertEqual(diff_manifest(previous, current, {"d.json"}, {"c.json"}), ({"e.json"}, {"b.json"}, set()))
+
+    def initial_refresh(self):
+        crawler = self.crawler()
+        final_data = create_local_database(self.sitemap_url, crawler)
+        for item in final_data:
+            ats_refresh.create_json_file(item["json_file"], item)
+        vector_store = get_vector_store(final_data)
+        save_manifest(build_manifest(final_data), ats_refresh.MANIFEST_PATH)
+        crawler.cache.save()
+        return vector_store
+
+    def edit_site(self):
+        """Change the Monet page and delete the Sfumato one."""
+        monet_xml = os.path.join(self.site_path, "data/content/artist/monet_claude.xml")
+        with open(monet_xml) as f:
+            content = f.read().replace("Le Havre", "Le Havre, Normandy")
+        with open(monet_xml, "w") as f:
+            f.write(content)
+        # Make sure the edit is seen as newer than the cached Last-Modified
+        os.utime(monet_xml, (time.time() + 5, time.time() + 5))
+        os.remove(os.path.join(self.site_path, "data/content/definition/sfumato.xml"))
+
+    def test_only_changed_files_are_reembedded(self):
+        vector_store = self.initial_refresh()
+        kahlo_ids = {k_id for k_id, document in vector_store.docstore._dict.items()
+                     if document.metadata["json_file"] == "kahlo_frida.json"}
+
+        self.edit_site()
+
+        with mock.patch("ats_refresh.get_vector_store", wraps=get_vector_store) as embed:
+            vector_store = create_partial_local_database(vector_store, self.crawler(), self.sitemap_url)
+        self.assertEqual([item["json_file"] for item in embed.call_args.args[0]], ["monet_claude.json"])
+
+        self.assertNotIn("sfumato.json", self.chunk_files(vector_store))
+        self.assertFalse(os.path.exists(os.path.join(self.json_path, "sfumato.json")))
+        self.assertTrue(kahlo_ids <= set(vector_store.docstore._dict))
+        self.assertTrue(any("Normandy" in document.page_content for document in vector_store.docstore._dict.values()))
+        with open(os.path.join(self.json_path, "monet_claude.json")) as f:
+            self.assertIn("Normandy", json.dumps(json.load(f)))
+        with open(ats_refresh.MANIFEST_PATH) as f:
+            self.assertNotIn("sfumato.json", json.load(f))
+
+    def test_failed_fetches_keep_their_content(self):
+        vector_store = self.initial_refresh()
+        self.edit_site()
+        # Kahlo's page fails (a 503 and no retry) during the partial refresh
+        FixtureHandler.flaky_paths = {"/data/content/artist/kahlo_frida.xml"}
+        crawler = XmlCrawler(requests_per_second=0, retries=0,
+                             cache=HttpCache(os.path.join(self.temp_dir.name, "http_cache")))
+        vector_store = create_partial_local_database(vector_store, crawler, self.sitemap_url)
+
+        self.assertEqual(crawler.failed, {f"{self.base_url}/data/content/artist/kahlo_frida.xml"})
+        self.assertIn("kahlo_frida.json", self.chunk_files(vector_store))
+        self.assertNotIn("sfumato.json", self.chunk_files(vector_store))
+        self.assertTrue(os.path.exists(os.path.join(self.json_path, "kahlo_frida.json")))
+        with open(ats_refresh.MANIFEST_PATH) as f:
+            self.assertIn("kahlo_frida.json", json.load(f))
+
+    def test_media_stores_follow_changed_documents(self):
+        vector_store = self.initial_refresh()
+        ats_refresh.get_all_images()
+        ats_refresh.get_iframe_images()
+        ats_refresh.create_image_vector_store()
+        ats_refresh.create_iframe_vector_store()
+        image_store = VersionedStore(ats_refresh.IMAGE_STORE_PATH)
+        kahlo_ids = {k_id for k_id, document in image_store.load(None).docstore._dict.items()
+                     if document.metadata["doc_id"] == "kahlo_frida"}
+
+        self.edit_site()
+        with mock.patch("ats_refresh.get_image_vector_store", wraps=ats_refresh.get_image_vector_store) as embed:
+            create_partial_local_database(vector_store, self.crawler(), self.sitemap_url)
+        self.assertEqual({record["id"] for record in embed.call_args.args[0]}, {"monet_claude"})
+
+        images = image_store.load(None).docstore._dict
+        self.assertTrue(kahlo_ids <= set(images))
+        self.assertNotIn("sfumato", {document.metadata["doc_id"] for document in images.values()})
+        self.assertTrue(any("Normandy" in document.page_content for document in images.values()))
+        iframes = VersionedStore(ats_refresh.IFRAME_STORE_PATH).load(None).docstore._dict
+        self.assertEqual(sorted(document.metadata["doc_id"] for document in iframes.values()),
+                         ["freud_sigmund", "greenberg_clement", "impressionism", "kahlo_frida", "monet_claude"])
+        with open(ats_refresh.IMAGES_JSON_PATH) as f:
+            self.assertNotIn("sfumato", {record["id"] for record in json.load(f)})
+
+
+class TestSchemaExtractor(unittest.TestCase):
+    """
+    The JSON of every fixture page, expected/<type>/<page>.json, and of edge_case.xml read as every type,
+    expected/edge_case/<type>.json, was written by the per type extractors extract_document replaced.
+    """
+
+    def assertExpectedJson(self, doc_type, root, expected_path):
+        with open(os.path.join(FIXTURES_PATH, "expected", expected_path)) as f:
+            self.assertEqual(json.dumps(extract_xml_data(doc_type, root), indent=4) + "\n", f.read())
+
+    def test_fixtures_match_expected_json(self):
+        content_path = os.path.join(FIXTURES_PATH, "data", "content")
+        for doc_type in os.listdir(content_path):
+            for file in os.listdir(os.path.join(content_path, doc_type)):
+                with self.subTest(file=file):
+                    self.assertExpectedJson(doc_type, ET.parse(os.path.join(content_path, doc_type, file)).getroot(),
+                                            os.path.join(doc_type, file.replace(".xml", ".json")))
+
+    def test_edge_cases_match_expected_json(self):
+        # Nested paragraphs and artworks, repeated <main> children, empty elements, every resource category
+        root = ET.parse(os.path.join(FIXTURES_PATH, "edge_case.xml")).getroot()
+        for doc_type in ["artist", "movement", "definition", "critic", "influencer"]:
+            with self.subTest(doc_type=doc_type):
+                self.assertExpectedJson(doc_type, root, os.path.join("edge_case", f"{doc_type}.json"))
+
+
+def slow_stage():
+    time.sleep(30)
+
+
+def failing_stage():
+    raise RuntimeError("no data")
+
+
+def echo_stage(**arguments):
+    return arguments
+
+
+class TestJobRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database_url = f"sqlite:///{os.path.join(self.temp_dir.name, 'jobs.db')}"
+        self.runner = JobRunner(self.database_url)
+        self.runner.setup()
+        patch = mock.patch.dict(JOB_STAGES, {"test_slow": [("prepare", "time:time"), ("wait", "refresh_tests:slow_stage")],
+                                             "test_fail": [("prepare", "time:time"),
+                                                           ("fail", "refresh_tests:failing_stage")],
+                                             "test_echo": [("echo", "refresh_tests:echo_stage")]})
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.runner.shutdown()
+        self.runner.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def wait_for(self, job_id, statuses, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            job = self.runner.get(job_id)
+            if job["status"] in statuses:
+                return job
+            time.sleep(0.1)
+        self.fail(f"job stayed {job['status']}")
+
+    def test_run_overlap_and_cancel(self):
+        job = self.runner.start("test_slow")
+        self.assertEqual(job["status"], "queued")
+        with self.assertRaises(JobConflict) as conflict:
+            self.runner.start("test_fail")
+        self.assertEqual(conflict.exception.job["job_id"], job["job_id"])
+
+        deadline = time.time() + 60
+        while self.runner.get(job["job_id"])["current_stage"] != "wait" and time.time() < deadline:
+            time.sleep(0.1)
+        self.runner.cancel(job["job_id"])
+        job = self.wait_for(job["job_id"], {"cancelled"})
+        self.assertEqual([stage["status"] for stage in job["stages"]], ["done", "cancelled"])
+        self.assertIsNone(self.runner.active_job())
+
+        failed = self.wait_for(self.runner.start("test_fail")["job_id"], {"failed"})
+        self.assertEqual(failed["error"], "RuntimeError: no data")
+        self.assertEqual(failed["progress"], "1/2")
+        self.assertEqual([job["kind"] for job in self.runner.history()], ["test_fail", "test_slow"])
+
+    def test_other_workers_keep_and_cancel_the_job(self):
+        job = self.runner.start("test_slow")
+        self.wait_for(job["job_id"], {"running"})
+        # Another worker process of the service starting up and cancelling the job
+        other = JobRunner(self.database_url)
+        other.setup()
+        self.assertEqual(other.active_job()["job_id"], job["job_id"])
+        with self.assertRaises(JobConflict):
+            other.start("test_fail")
+        other.cancel(job["job_id"])
+        self.assertEqual(self.wait_for(job["job_id"], {"cancelled"})["status"], "cancelled")
+        other.engine.dispose()
+
+    def test_stale_jobs_are_cancelled_without_a_signal(self):
+        # The worker is gone and its pid was reused
+        unrelated = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+        self.addCleanup(unrelated.kill)
+        with self.runner.session_factory() as db:
+            db.add(RefreshJob(job_id="lost", kind="test_slow", status="running", active=1, pid=unrelated.pid,
+                              heartbeat_at="2020-01-01 10:00:00"))
+            db.commit()
+        self.assertEqual(self.runner.cancel("lost")["status"], "cancelled")
+        self.assertIsNone(self.runner.active_job())
+        time.sleep(0.2)
+        self.assertIsNone(unrelated.poll())
+
+    def test_stages_get_the_job_arguments(self):
+        job = self.runner.start("test_echo", max_age_days=30)
+        self.assertEqual(job["arguments"], {"max_age_days": 30})
+        job = self.wait_for(job["job_id"], {"succeeded", "failed"})
+        self.assertEqual(job["stages"][0]["result"], {"max_age_days": 30})
+
+    def test_jobs_without_heartbeat_are_failed(self):
+        with self.runner.session_factory() as db:
+            db.add(RefreshJob(job_id="lost", kind="test_slow", status="running", active=1,
+                              heartbeat_at="2020-01-01 10:00:00"))
+            db.commit()
+        job = self.runner.start("test_fail")
+        self.assertEqual(self.runner.get("lost")["status"], "failed")
+        self.assertEqual(self.wait_for(job["job_id"], {"failed"})["error"], "RuntimeError: no data")
+
+
+class TestStructuredChunker(LocalSiteTestCase):
+
+    def test_chunks_carry_field_metadata(self):
+        final_data = create_local_database(self.sitemap_url, XmlCrawler(requests_per_second=0))
+        chunks = list(StructuredChunker().load(final_data))
+        monet = [chunk for chunk in chunks if chunk.metadata["id"] == "monet_claude"]
+
+        self.assertTrue(all("{" not in chunk.page_content for chunk in chunks))
+        self.assertTrue(all(chunk.page_content.startswith("Claude Monet") for chunk in monet))
+        # Short fields share chunks, artworks are packed apart from the rest
+        self.assertTrue(monet[0].metadata["field"].startswith("profile; synopsis"))
+        artworks = next(chunk for chunk in monet if chunk.metadata["field"] == "artworks")
+        self.assertEqual(artworks.metadata["artwork"], "Impression, Sunrise; Water Lilies")
+        self.assertEqual(artworks.metadata["json_file"], "monet_claude.json")
+
+
+class TestVersionedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.embeddings = DeterministicFakeEmbedding(size=8)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def build(self, text):
+        return FAISS.from_texts([text], self.embeddings)
+
+    def test_publish_switches_readers_and_keeps_recent_versions(self):
+        root = os.path.join(self.temp_dir.name, "vector_store")
+        # A store written before versioning is still read until the first publish
+        self.build("legacy").save_local(root)
+        store = VersionedStore(root, keep=2)
+        self.assertEqual(store.current_path(), root)
+
+        published = [store.publish(self.build(f"build {i}")) for i in range(3)]
+        self.assertEqual(store.current_version(), published[-1])
+        self.assertEqual(store.versions(), published[1:])
+        self.assertFalse(os.path.exists(os.path.join(root, "index.faiss")))
+        documents = store.load(self.embeddings).docstore._dict.values()
+        self.assertEqual([document.page_content for document in documents], ["build 2"])
+
+    def test_columnar_docstore_converts_pickled_stores(self):
+        path = os.path.join(self.temp_dir.name, "legacy")
+        documents = [Document(page_content="Sfumato blurs the outlines. \u2014 Leonardo",
+                              metadata={"id": "sfumato", "duplicates": [{"id": "leonardo", "section": None}]}),
+                     Document(page_content="", metadata={})]
+        FAISS.from_documents(documents, self.embeddings).save_local(path)
+        self.assertTrue(convert_docstore(path))
+        self.assertFalse(convert_docstore(path))
+
+        store = VersionedStore(path)
+        loaded, mapped = store.load(self.embeddings), store.load(self.embeddings, mmap=True)
+        self.assertEqual(list(mapped.index_to_docstore_id.values()), list(loaded.index_to_docstore_id.values()))
+        for doc_id in loaded.index_to_docstore_id.values():
+            self.assertEqual(mapped.docstore.search(doc_id), loaded.docstore.search(doc_id))
+        self.assertEqual(mapped.docstore.search("missing"), "ID missing not found.")
+
+    def test_mapped_load_searches_like_the_faiss_index(self):
+        store = VersionedStore(os.path.join(self.temp_dir.name, "vector_store"))
+        store.publish(FAISS.from_texts(["monet", "kahlo", "sfumato", "cubism"], self.embeddings))
+        loaded, mapped = store.load(self.embeddings), store.load(self.embeddings, mmap=True)
+        self.assertIsInstance(mapped.index, MappedFlatIndex)
+        self.assertIsInstance(mapped.docstore, ColumnarDocstore)
+        for query in ("kahlo", "impressionism"):
+            self.assertEqual(mapped.similarity_search_with_score(query, k=10),
+                             loaded.similarity_search_with_score(query, k=10))
+
+    def test_publish_writes_the_pickled_files_only_for_older_readers(self):
+        store = VersionedStore(os.path.join(self.temp_dir.name, "vector_store"))
+        version = store.publish(self.build("monet"))
+        self.assertEqual(sorted(os.listdir(store.version_path(version))),
+                         ["index.docstore", "index.vectors.json", "index.vectors.npy"])
+        # A store loaded to be modified is published again from memory
+        vector_store = store.load(self.embeddings)
+        vector_store.add_texts(["kahlo"])
+        version = store.publish(vector_store)
+        self.assertEqual(len(store.load(self.embeddings, mmap=True).index_to_docstore_id), 2)
+
+        with mock.patch("stores.versions.VECTOR_STORE_LEGACY_FILES", True):
+            version = store.publish(vector_store)
+        self.assertTrue({"index.faiss", "index.pkl"} <= set(os.listdir(store.version_path(version))))
+
+
+class TestArtifactSync(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.embeddings = DeterministicFakeEmbedding(size=8)
+        self.backend = LocalBackend(os.path.join(self.temp_dir.name, "bucket"))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def store(self, name):
+        return VersionedStore(os.path.join(self.temp_dir.name, name), keep=2)
+
+    def test_push_skips_unchanged_files_and_pull_resumes(self):
+        local = self.store("builder")
+        sync = ArtifactSync(self.backend, "data/vector_store/", workers=4, keep=2)
+        first = local.publish(FAISS.from_texts(["monet"], self.embeddings))
+        files = len(os.listdir(local.version_path(first)))
+        sync.push(local)
+        self.assertEqual((sync.stats["uploaded"], sync.stats["skipped"]), (files, 0))
+        sync.push(local)
+        self.assertEqual((sync.stats["uploaded"], sync.stats["skipped"]), (0, files))
+
+        vector_store = local.load(self.embeddings)
+        vector_store.add_texts(["kahlo"])
+        second = local.publish(vector_store)
+        with mock.patch.object(self.backend, "upload", wraps=self.backend.upload) as upload:
+            sync.push(local)
+        self.assertEqual(sync.remote_version(), second)
+        self.assertEqual(upload.call_count, sync.stats["uploaded"])
+
+        # A reader that already downloaded part of the version only fetches the rest
+        reader = self.store("reader")
+        os.makedirs(reader.staging_path(second))
+        shutil.copyfile(os.path.join(local.version_path(second), MAPPED_VECTORS_FILE),
+                        os.path.join(reader.staging_path(second), MAPPED_VECTORS_FILE))
+        self.assertEqual(sync.pull(reader), second)
+        self.assertEqual((sync.stats["downloaded"], sync.stats["skipped"]), (files - 1, 1))
+        documents = reader.load(self.embeddings).docstore._dict.values()
+        self.assertEqual(sorted(document.page_content for document in documents), ["kahlo", "monet"])
+
+        local.publish(vector_store)
+        sync.push(local)
+        self.assertEqual(sync.stats["removed_versions"], [first])
+        self.assertNotIn(first, sync.remote_versions())
+
+    def test_watcher_keeps_a_newer_local_version(self):
+        local = self.store("api")
+        sync = ArtifactSync(self.backend, "data/vector_store", workers=4, keep=2)
+        local.publish(FAISS.from_texts(["monet"], self.embeddings))
+        sync.push(local)
+        # A refresh in this process publishes a new version, the watcher runs before it is pushed
+        second = local.publish(FAISS.from_texts(["monet", "kahlo"], self.embeddings))
+        rag = SimpleNamespace(bucket="bucket", artifact_sync=sync, stores={"vectorstore": local})
+        ConversationalRAG.pull_vector_store(rag)
+        self.assertEqual((local.current_version(), sync.stats["downloaded"]), (second, 0))
+        sync.push(local)
+        self.assertEqual(sync.remote_version(), second)
+
+        # A build being staged is not replaced by an older remote version either
+        other = self.store("other")
+        building = "99991231T000000000000-building"
+        os.makedirs(other.staging_path(building))
+        self.assertIsNone(sync.pull(other))
+        shutil.rmtree(other.staging_path(building))
+        self.assertEqual(sync.pull(other), second)
+
+    def test_one_process_pulls_at_a_time(self):
+        local, reader = self.store("builder"), self.store("reader")
+        sync = ArtifactSync(self.backend, "data/vector_store", workers=4, keep=2)
+        local.publish(FAISS.from_texts(["monet"], self.embeddings))
+        version = sync.push(local)
+        with pull_lock(reader) as locked:
+            self.assertTrue(locked)
+            self.assertIsNone(sync.pull(reader))
+            self.assertFalse(os.path.exists(reader.staging_path(version)))
+        self.assertEqual(sync.pull(reader), version)
+
+
+class TestChunkDeduplicator(unittest.TestCase):
+    quote = "I am following Nature without being able to grasp her. I perhaps owe having become a painter to flowers."
+
+    def chunk(self, doc_id, text, field="quotes"):
+        return Document(page_content=f"{doc_id}: {field}\n{text}",
+                        metadata={"id": doc_id, "json_file": f"{doc_id}.json", "field": field})
+
+    def test_duplicates_are_merged_into_one_chunk(self):
+        chunks = [self.chunk("a", self.quote), self.chunk("b", self.quote),
+                  self.chunk("c", self.quote.replace("flowers", "the flowers") + " Really."),
+                  self.chunk("d", "Cubism was developed by Picasso and Braque in Paris.", "synopsis")]
+        deduplicator = ChunkDeduplicator()
+        unique = deduplicator.deduplicate(chunks)
+
+        self.assertEqual([chunk.metadata["id"] for chunk in unique], ["a", "d"])
+        self.assertEqual([duplicate["id"] for duplicate in unique[0].metadata["duplicates"]], ["b", "c"])
+        self.assertEqual((deduplicator.stats["exact_duplicates"], deduplicator.stats["near_duplicates"]), (1, 1))
+        self.assertNotIn("duplicates", chunks[0].metadata)
+
+    def test_short_bodies_keep_their_heading(self):
+        chunks = [self.chunk("a", "Born in Paris.", "profile"), self.chunk("b", "Born in Paris.", "profile"),
+                  self.chunk("a", "Born in Paris.", "profile")]
+        unique = ChunkDeduplicator().deduplicate(chunks)
+        self.assertEqual([chunk.metadata["id"] for chunk in unique], ["a", "b"])
+        self.assertEqual([duplicate["id"] for duplicate in unique[0].metadata["duplicates"]], ["a"])
+
+    def test_new_chunks_are_credited_to_stored_ones(self):
+        stored = [self.chunk("a", self.quote), self.chunk("b", self.quote),
+                  self.chunk("d", "Cubism was developed by Picasso and Braque in Paris.", "synopsis")]
+        deduplicator = ChunkDeduplicator()
+        unique = deduplicator.deduplicate([self.chunk("e", self.quote + " Really."),
+                                           self.chunk("f", "Frida Kahlo painted herself because she was so often "
+                                                           "alone.", "synopsis")], stored)
+
+        self.assertEqual([chunk.metadata["id"] for chunk in unique], ["f"])
+        self.assertEqual([duplicate["id"] for duplicate in stored[0].metadata["duplicates"]], ["e"])
+        # Stored chunks aren't merged with each other
+        self.assertNotIn("duplicates", stored[1].metadata)
+        self.assertEqual((deduplicator.stats["chunks"], deduplicator.stats["unique_chunks"]), (2, 1))
+
+    def test_shared_chunks_are_rebuilt_with_their_files(self):
+        unique = ChunkDeduplicator().deduplicate([self.chunk("a", self.quote), self.chunk("b", self.quote),
+                                                  self.chunk("b", "Frida painted herself.", "synopsis"),
+                                                  self.chunk("c", "Sfumato blurs the outlines.", "synopsis")])
+        vector_store = SimpleNamespace(docstore=SimpleNamespace(_dict=dict(enumerate(unique))))
+        files, ids = expand_shared_chunks(vector_store, {"a.json"})
+        self.assertEqual(files, {"a.json", "b.json"})
+        self.assertEqual(sorted(ids), [0, 1])
+
+
+class RecordingEmbeddings(DeterministicFakeEmbedding):
+    calls: list = []
+
+    def embed_documents(self, texts):
+        self.calls.append(texts)
+        return super().embed_documents(texts)
+
+
+class TestEmbeddingCache(unittest.TestCase):
+
+    def test_only_misses_are_embedded(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = EmbeddingCache(os.path.join(temp_dir, "embeddings.sqlite"))
+            vectors = CachedEmbeddings(RecordingEmbeddings(size=8), cache).embed_documents(["monet", "kahlo"])
+
+            embeddings = RecordingEmbeddings(size=8)
+            cached_embeddings = CachedEmbeddings(embeddings, cache)
+            new_vectors = cached_embeddings.embed_documents(["kahlo", "monet", "pollock"])
+            cache.close()
+
+        self.assertEqual(embeddings.calls, [["pollock"]])
+        # Vectors are stored as float32
+        self.assertTrue(np.allclose(new_vectors[:2], [vectors[1], vectors[0]], atol=1e-6))
+        self.assertEqual(cached_embeddings.report()["hit_rate"], 2 / 3)
+
+
+def fake_vector(text):
+    return [float(len(text)), float(sum(map(ord, text)) % 97), 1.0]
+
+
+class FakeEmbeddingsHandler(BaseHTTPRequestHandler):
+    """Local stand-in for the OpenAI embeddings endpoint, with injectable 429 and 500 responses."""
+    rate_limited = 0
+    fail_after = None
+    inputs = []
+    lock = threading.Lock()
+
+    def do_POST(self):
+        cls = type(self)
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with cls.lock:
+            if cls.rate_limited:
+                cls.rate_limited -= 1
+                return self.reply(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                                  {"Retry-After": "0"})
+            if cls.fail_after is not None and len(cls.inputs) >= cls.fail_after:
+                return self.reply(500, {"error": {"message": "Server error", "type": "server_error"}})
+            cls.inputs.append(body["input"])
+        self.reply(200, {"object": "list", "model": body["model"],
+                         "data": [{"object": "embedding", "index": i, "embedding": fake_vector(text)}
+                                  for i, text in enumerate(body["input"])],
+                         "usage": {"prompt_tokens": 1, "total_tokens": 1}})
+
+    def reply(self, status, content, headers=None):
+        data = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def count_words(text):
+    """Stands in for the tokenizer, tiktoken downloads its encodings."""
+    return len(text.split())
+
+
+class TestEmbeddingScheduler(unittest.TestCase):
+
+    def setUp(self):
+        FakeEmbeddingsHandler.rate_limited = 0
+        FakeEmbeddingsHandler.fail_after = None
+        FakeEmbeddingsHandler.inputs = []
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FakeEmbeddingsHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = openai.OpenAI(api_key="test", base_url=f"http://127.0.0.1:{self.server.server_port}/v1",
+                                    max_retries=0)
+        self.texts = [f"chunk number {i} about {'impressionism ' * (i % 3)}" for i in range(12)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_batches_by_tokens_and_retries_rate_limits(self):
+        FakeEmbeddingsHandler.rate_limited = 2
+        scheduler = EmbeddingScheduler(client=self.client, max_batch_tokens=20, max_in_flight=3, backoff=0.01,
+                                       count_tokens=count_words)
+        vectors = scheduler.embed_documents(self.texts)
+
+        self.assertEqual(vectors, [fake_vector(text) for text in self.texts])
+        self.assertEqual(scheduler.stats["retries"], 2)
+        self.assertGreater(len(FakeEmbeddingsHandler.inputs), 1)
+        for batch in FakeEmbeddingsHandler.inputs:
+            self.assertLessEqual(sum(count_words(text) for text in batch), 20)
+
+    def test_resumes_from_checkpointed_batches(self):
+        FakeEmbeddingsHandler.fail_after = 2
+        with tempfile.TemporaryDirectory() as temp_dir:
+            cache = EmbeddingCache(os.path.join(temp_dir, "embeddings.sqlite"))
+            scheduler = EmbeddingScheduler(client=self.client, max_batch_tokens=20, max_in_flight=1, retries=0,
+                                           count_tokens=count_words)
+            with self.assertRaises(openai.InternalServerError):
+                CachedEmbeddings(scheduler, cache).embed_documents(self.texts)
+            embedded_first = [text for batch in FakeEmbeddingsHandler.inputs for text in batch]
+
+            FakeEmbeddingsHandler.fail_after = None
+            FakeEmbeddingsHandler.inputs = []
+            scheduler = EmbeddingScheduler(client=self.client, max_batch_tokens=20, max_in_flight=1, retries=0,
+                                           count_tokens=count_words)
+            cached_embeddings = CachedEmbeddings(scheduler, cache)
+            vectors = cached_embeddings.embed_documents(self.texts)
+            cache.close()
+
+        embedded_second = [text for batch in FakeEmbeddingsHandler.inputs for text in batch]
+        self.assertTrue(embedded_first)
+        self.assertEqual(sorted(embedded_first + embedded_second), sorted(self.texts))
+        self.assertEqual(cached_embeddings.stats["hits"], len(embedded_first))
+        self.assertEqual(vectors, [fake_vector(text) for text in self.texts])
+
+    def test_request_budget(self):
+        budget = RateBudget(requests_per_minute=2, tokens_per_minute=1000, window=0.2)
+        start_time = time.monotonic()
+        for _ in range(5):
+            budget.acquire(10)
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.4)
+
+
+class TestHostRateLimiter(unittest.TestCase):
+
+    def test_spaces_requests_per_host(self):
+        limiter = HostRateLimiter(requests_per_second=50)
+        start_time = time.monotonic()
+        for _ in range(6):
+            limiter.wait("http://example.org/a.xml")
+        limiter.wait("http://example.com/b.xml")
+        self.assertGreaterEqual(time.monotonic() - start_time, 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
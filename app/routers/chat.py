@@ -1,23 +1,25 @@
+import asyncio
 import json
 import os
 import re
-import time
+from contextlib import aclosing
 
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Header, WebSocket, WebSocketDisconnect
 from fastapi.responses import JSONResponse, StreamingResponse
-from langchain_community.embeddings import OpenAIEmbeddings
-from langchain_community.vectorstores import FAISS
+from starlette.background import BackgroundTask
+from starlette.websockets import WebSocketState
 from schema import (QueryRequest, TokenCounter, TypeAndID, TypeAndID2, TypeAndID3,
                     QueryUrls, MetadataQuery, ChatHistoryRequest, FetchDataId, IframeQuery)
-from ai import AsyncCallbackHandler, ConversationalRAG
-from crud import model_to_dict, insert_message, get_recent_messages
+from ai import AsyncCallbackHandler, ConversationalRAG, AdmissionRejected, ResumableStreams
+from crud import (model_to_dict, insert_message, get_recent_messages, export_stream, EXPORT_TABLES,
+                  EXPORT_FORMATS, archive_old_messages, RETENTION_DAYS)
 from db import Session, db_connection, logger
-from ats import num_tokens_from_string, iframe_link_generator, source_link_generator, artist_img_generator
+from ats import (num_tokens_from_string, iframe_link_generator, source_link_generator, artist_img_generator,
+                 AnswerEnrichment)
 import uuid
-from lib import extract_highest_ratio_dict, get_metadata_id, get_best_metadata_id, get_all_artists_ids
-from ats_refresh import (get_all_images, create_image_vector_store, get_iframe_images,
-                         create_iframe_vector_store, create_partial_local_database, create_local_vector_store,
-                         delete_merged_vector, upload_merged_vector)
+from lib import extract_highest_ratio_dict, get_metadata_id, get_best_metadata_id, get_all_artists_ids, Warmup
+from jobs import JobRunner, JobConflict, JOB_HISTORY_LIMIT
+from stores import VersionedStore
 
 router = APIRouter()
 
@@ -26,39 +28,144 @@ os.environ['USER_AGENT'] = 'MyApp/1.0.0'
 
 ai = ConversationalRAG()
 JSON_STORE_PATH = "data/json_files/"
-artists_ids = get_all_artists_ids(JSON_STORE_PATH)
+artists_ids = []
 VECTOR_STORE_PATH = "data/vector_store/"
 
 
-# Common function for executing the logic and calculating execution time
-def execute_vector_update(update_function):
-    start_time = time.time()
+job_runner = JobRunner()
+# Answers of /get_response_from_ai streamed as Server-Sent Events, a client can resume them after a dropped connection
+streams = ResumableStreams()
+socket_stats = {"connections": 0, "open": 0, "messages": 0}
+
+# Heavy initialization runs in the background once the app is started, see main.startup
+warmup = Warmup()
+warmup.add("pull_vector_store", lambda: ai.pull_vector_store())
+warmup.add("vector_store", lambda: ai.load_vector_store("vectorstore"), after=["pull_vector_store"])
+warmup.add("iframe_vector_store", lambda: ai.load_vector_store("iframe_vector_store"))
+warmup.add("agent", lambda: ai.load_agent())
+warmup.add("artists_ids", lambda: artists_ids.extend(get_all_artists_ids(JSON_STORE_PATH)))
+warmup.add("reload_watcher", lambda: ai.start_reload_watcher(), after=["vector_store", "iframe_vector_store"])
+
+
+def require_ready():
+    """Dependency of the endpoints that need the warmed up components, answers 503 until they are loaded."""
+    if not warmup.ready():
+        raise HTTPException(status_code=503, detail={"message": "The service is starting", **warmup.status()},
+                            headers={"Retry-After": "5"})
+
+
+def parse_query(query: str):
+    """
+    Split a '%info%...% %query%...% %instructions%...%' query into the prompt prefix, the question and the length
+    instructions, they are empty strings when it doesn't match.
+    """
+    # Regex pattern to match the sections
+    pattern = r'%info%(.*?)%\s*%query%(.*?)%\s*%instructions%(.*?)%'
+    # Extracting the parts using regex
+    matches = re.search(pattern, query)
+
+    prompt = question = resLen_string = ""
+    if matches:
+        prompt = matches.group(1).strip()
+        question = matches.group(2).strip()
+        resLen_string = matches.group(3).strip()
+    return prompt, question, resLen_string
+
+
+def lookup_urls(data_id: str, chunk: str):
+    file = f"{data_id}.json"
+    file_name = os.path.join(JSON_STORE_PATH, file).replace("\\", "/")
+    with open(file_name, 'r') as f:
+        extracted_dict = json.load(f)[data_id]
+    dict_output = extract_highest_ratio_dict(extracted_dict, chunk)
+    logger.info(dict_output)
+    return dict_output.get('url', None)
+
+
+def answer_urls(data_ids: list, text: str):
+    """/get_urls of the answer for every document it was generated from that has a json file."""
+    urls = {}
+    for data_id in data_ids:
+        try:
+            urls[data_id] = lookup_urls(data_id, text)
+        except Exception as e:
+            logger.info(f"No urls for {data_id}: {str(e)}")
+    return urls
+
+
+async def enriched_frames(frames):
+    """
+    The frames of /generate_response followed by the last one again, with an ``enrichment`` of the answer:
+    - entities, iframe, sources, artist_images: /get_iframe, /get_source and /get_artist_img of its lines, scanned
+      while it streams, see AnswerEnrichment.
+    - heading_images: /get_heading_image of its headings. urls: /get_urls of the documents it was generated from.
+    A part that fails is replaced by its error, the answer itself is never held back.
+    """
+    enrichment = AnswerEnrichment()
+    result = None
+    try:
+        async for frame in frames:
+            result = json.loads(frame)
+            enrichment.feed(result["text_message"])
+            yield frame
+        if result is None:
+            return
+        enrichment.finish(result["text_message"])
+        parts = {"entities": enrichment.result(),
+                 "heading_images": asyncio.to_thread(ai.heading_urls, enrichment.headings),
+                 "urls": asyncio.to_thread(answer_urls, result["data_id"], result["text_message"])}
+        values = await asyncio.gather(*parts.values(), return_exceptions=True)
+        result["enrichment"] = {}
+        for name, value in zip(parts, values):
+            if isinstance(value, Exception):
+                logger.error(f"Enrichment of the answer with {name} failed: {str(value)}")
+                result["enrichment"][f"{name}_error"] = f"{type(value).__name__}: {value}"
+            elif name == "entities":
+                result["enrichment"].update(value)
+            else:
+                result["enrichment"][name] = value
+        yield json.dumps(result) + '\n\n\n\n'
+    finally:
+        enrichment.close()
+
+
+def admission_rejected(e: AdmissionRejected):
+    return JSONResponse(content={"error": str(e), "reason": e.reason}, status_code=e.status_code,
+                        headers={"Retry-After": str(e.retry_after)})
+
+
+def start_refresh_job(kind: str, **arguments):
+    """Start a refresh (or maintenance) job in the background and answer with its id right away."""
     try:
-        update_function()
-        execution_time = time.time() - start_time
-        return {"message": f"Execution took {execution_time} seconds"}
+        return JSONResponse(content=job_runner.start(kind, **arguments), status_code=202)
+    except JobConflict as e:
+        raise HTTPException(status_code=409, detail={"message": "A refresh job is already running", "job": e.job})
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"An unexpected error occurred: {str(e)}")
 
 
-@router.post("/get_response_from_ai")
-async def stream_response(request_body: QueryRequest, db: Session = Depends(db_connection)):
+@router.post("/get_response_from_ai", dependencies=[Depends(require_ready)])
+async def stream_response(request_body: QueryRequest, db: Session = Depends(db_connection),
+                          accept: str = Header(""), last_event_id: str = Header(None)):
+    """
+    Streams the answer as raw tokens, or as Server-Sent Events when the client accepts text/event-stream.
+    An SSE client that lost its connection sends the request again with the Last-Event-ID header and gets the rest
+    of the same answer.
+    """
     try:
         if not request_body.query or not request_body.session_id:
             error_message = "Both 'query' and 'session_id' must be provided"
             return JSONResponse(content={"error": error_message}, status_code=400)
 
+        if last_event_id:
+            events = streams.resume(last_event_id, request_body.session_id)
+            if events is None:
+                return JSONResponse(content={"error": "The stream expired, send the question again"},
+                                    status_code=410)
+            return StreamingResponse(events, media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
         history_id = str(uuid.uuid4())
-        # Regex pattern to match the sections
-        pattern = r'%info%(.*?)%\s*%query%(.*?)%\s*%instructions%(.*?)%'
-        # Extracting the parts using regex
-        matches = re.search(pattern, request_body.query)
-
-        prompt = question = resLen_string = ""
-        if matches:
-            prompt = matches.group(1).strip()
-            question = matches.group(2).strip()
-            resLen_string = matches.group(3).strip()
+        prompt, question, resLen_string = parse_query(request_body.query)
         # Collecting the message objects from db
         chat_history = get_recent_messages(db, session_id=request_body.session_id)
 
@@ -66,13 +173,28 @@ async def stream_response(request_body: QueryRequest, db: Session = Depends(db_c
         logger.info(f"Question: {question}")
         logger.info(f"Response Length Chosen: {resLen_string}")
 
-        insert_message(db, request_body.session_id, history_id, 'human', question)
-
         stream_it = AsyncCallbackHandler(db, request_body.session_id, history_id)
-
-        gen = ai.create_gen(prompt, question, resLen_string, request_body.responseLength, stream_it, chat_history)
-
-        return StreamingResponse(gen, media_type="text/event-stream")
+        generation = await ai.admit_agent(prompt, question, resLen_string, request_body.responseLength, stream_it,
+                                          chat_history, request_body.session_id)
+        try:
+            insert_message(db, request_body.session_id, history_id, 'human', question)
+
+            gen = ai.create_gen(generation, stream_it)
+
+            if "text/event-stream" in accept:
+                # The generation outlives the connection for a while, so does its ticket
+                events = streams.open(ai.admission.stream(generation, gen), request_body.session_id)
+                return StreamingResponse(events, media_type="text/event-stream",
+                                         headers={"Cache-Control": "no-cache"})
+            # The ticket is released when the stream ends, the background task covers a response that never started
+            return StreamingResponse(ai.admission.stream(generation, gen), media_type="text/event-stream",
+                                     background=BackgroundTask(generation.release))
+        except BaseException:
+            # Nothing will stream the generation, its slot is given back
+            generation.release()
+            raise
+    except AdmissionRejected as e:
+        return admission_rejected(e)
     except HTTPException as http_err:
         return JSONResponse(content={"error": str(http_err)}, status_code=http_err.status_code)
     except Exception as e:
@@ -104,9 +226,37 @@ async def health():
     return {"Smiling Face": "☺"}
 
 
+@router.get("/health/live")
+async def liveness():
+    """
+    Endpoint for liveness probes: the process is up and serving, even while it is still warming up.
+    Once a warmup component failed for good (its retries included) it answers 503, so that the worker is restarted.
+    """
+    if warmup.failed():
+        return JSONResponse(content={"status": "failed", **warmup.status()}, status_code=503)
+    return {"status": "alive"}
+
+
+@router.get("/health/ready")
+async def readiness():
+    """
+    Endpoint for readiness probes: 200 once every warmup component is loaded, 503 with their progress until then.
+    """
+    status = warmup.status()
+    return JSONResponse(content=status, status_code=200 if status["ready"] else 503)
+
+
 ############################################################################
 
-@router.get("/get_heading_image")
+@router.get("/metrics")
+async def metrics():
+    """Counters of this worker's generations: coalescing, cancellations, admission control and resumed streams."""
+    return JSONResponse(content={"generations": {**ai.in_flight.stats, "in_flight": len(ai.in_flight.flights)},
+                                 "admission": ai.admission.status(), "streams": streams.status(),
+                                 "websocket": socket_stats})
+
+
+@router.get("/get_heading_image", dependencies=[Depends(require_ready)])
 async def find_heading_url(heading_text: str):
     url = await ai.get_heading_url(heading_text)
     return JSONResponse(content={"url": url})
@@ -118,29 +268,25 @@ def find_heading_url(heading_text: str):
     return JSONResponse(content={"url": url})
 
 
-@router.post("/get_valid_data_id")
+@router.post("/get_valid_data_id", dependencies=[Depends(require_ready)])
 def find_best_match_id(query: FetchDataId):
     best_match_id = get_best_metadata_id(artists_ids, query.chunk)
     return JSONResponse(content={"best_match_id": best_match_id})
 
 
-@router.post("/generate_response")
-async def generate_response(request_body: QueryRequest, db: Session = Depends(db_connection)):
+@router.post("/generate_response", dependencies=[Depends(require_ready)])
+async def generate_response(request_body: QueryRequest, db: Session = Depends(db_connection), enrich: bool = False):
+    """
+    Streams the answer as JSON frames holding the text so far.
+    With ``enrich`` the lookups of the answer are done while it streams and sent in one more, final frame,
+    see enriched_frames.
+    """
     try:
         if not request_body.query or not request_body.session_id:
             error_message = "Both 'query' and 'session_id' must be provided"
             return JSONResponse(content={"error": error_message}, status_code=400)
 
-        # Regex pattern to match the sections
-        pattern = r'%info%(.*?)%\s*%query%(.*?)%\s*%instructions%(.*?)%'
-        # Extracting the parts using regex̀``
-        matches = re.search(pattern, request_body.query)
-
-        prompt = question = resLen_string = ""
-        if matches:
-            prompt = matches.group(1).strip()
-            question = matches.group(2).strip()
-            resLen_string = matches.group(3).strip()
+        prompt, question, resLen_string = parse_query(request_body.query)
         # Collecting the message objects from db
         chat_history = get_recent_messages(db, session_id=request_body.session_id)
 
@@ -148,15 +294,161 @@ async def generate_response(request_body: QueryRequest, db: Session = Depends(db
         logger.info(f"Question: {question}")
         logger.info(f"Response Length Chosen: {resLen_string}")
 
-        return StreamingResponse(ai.response_generator(prompt, question, resLen_string,
-                                                       request_body.responseLength, chat_history),
-                                 media_type="application/json")
+        generation = await ai.admit_response(prompt, question, resLen_string, request_body.responseLength,
+                                             chat_history, request_body.session_id)
+        try:
+            gen = ai.response_generator(generation, db, request_body.session_id, request_body.history_id, question)
+            if enrich:
+                gen = enriched_frames(gen)
+            return StreamingResponse(ai.admission.stream(generation, gen), media_type="application/json",
+                                     background=BackgroundTask(generation.release))
+        except BaseException:
+            generation.release()
+            raise
+    except AdmissionRejected as e:
+        return admission_rejected(e)
     except HTTPException as http_err:
         return JSONResponse(content={"error": str(http_err)}, status_code=http_err.status_code)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=400)
 
 
+async def socket_turn(kind: str, message: dict):
+    """
+    The tokens of a chat turn asked over the websocket, a ``chat`` turn is /get_response_from_ai and a ``generate``
+    one /generate_response, whose frames are sent as objects.
+    """
+    require_ready()
+    request_body = QueryRequest(query=message.get("query", ""), responseLength=message.get("responseLength", ""),
+                                session_id=message.get("session_id", ""), history_id=message.get("history_id"))
+    if not request_body.query or not request_body.session_id:
+        raise ValueError("Both 'query' and 'session_id' must be provided")
+    prompt, question, resLen_string = parse_query(request_body.query)
+    db = Session()
+    try:
+        chat_history = get_recent_messages(db, session_id=request_body.session_id)
+        if kind == "chat":
+            history_id = str(uuid.uuid4())
+            stream_it = AsyncCallbackHandler(db, request_body.session_id, history_id)
+            generation = await ai.admit_agent(prompt, question, resLen_string, request_body.responseLength,
+                                              stream_it, chat_history, request_body.session_id)
+        else:
+            generation = await ai.admit_response(prompt, question, resLen_string, request_body.responseLength,
+                                                 chat_history, request_body.session_id)
+        try:
+            if kind == "chat":
+                insert_message(db, request_body.session_id, history_id, 'human', question)
+                gen = ai.create_gen(generation, stream_it)
+            else:
+                gen = ai.response_generator(generation, db, request_body.session_id, request_body.history_id,
+                                            question)
+                if message.get("enrich"):
+                    gen = enriched_frames(gen)
+            async for item in ai.admission.stream(generation, gen):
+                yield item if kind == "chat" else json.loads(item)
+        finally:
+            # Also when the turn failed or was cancelled before its stream started
+            generation.release()
+    finally:
+        db.close()
+
+
+async def socket_lookup(kind: str, message: dict):
+    """The lookups of /get_iframe, /get_source, /get_artist_img, /get_heading_image and /get_urls."""
+    if kind == "iframe":
+        return {'iframe': list(await asyncio.to_thread(iframe_link_generator, message["query"]))}
+    if kind == "source":
+        return {'sources': await asyncio.to_thread(source_link_generator, message["query"])}
+    if kind == "artist_img":
+        return {'sources': await asyncio.to_thread(artist_img_generator, message["query"])}
+    if kind == "heading_image":
+        require_ready()
+        return {"url": await ai.get_heading_url(message["heading_text"])}
+    return {'urls': await asyncio.to_thread(lookup_urls, message["data_id"], message["chunk"])}
+
+
+SOCKET_TURNS = {"chat", "generate"}
+SOCKET_LOOKUPS = {"iframe", "source", "artist_img", "heading_image", "urls"}
+
+
+@router.websocket("/ws")
+async def chat_socket(websocket: WebSocket):
+    """
+    One connection per client for its chat turns and lookups, of any of its sessions, running side by side.
+    Every message is a JSON object with a ``type`` and an ``id`` chosen by the client, the answers carry the id.
+    - chat / generate: {query, responseLength, session_id} as /get_response_from_ai and /generate_response
+      (generate also takes ``enrich``), answered with ``token`` messages then ``end``.
+    - iframe, source, artist_img ({query}), heading_image ({heading_text}) and urls ({data_id, chunk}): the lookups
+      of the endpoints of the same name, answered with one ``result``.
+    - cancel ({target}): stops the turn with that id, answered with ``cancelled``. ping is answered with pong.
+    Failures are answered with ``error``, with the HTTP ``status`` and ``retry_after`` of rejected turns.
+    """
+    await websocket.accept()
+    socket_stats["connections"] += 1
+    socket_stats["open"] += 1
+    send_lock = asyncio.Lock()
+    tasks = {}
+
+    async def send(message: dict):
+        async with send_lock:
+            # Turns still finishing when the client went away have nobody to answer to
+            if websocket.client_state == WebSocketState.CONNECTED:
+                await websocket.send_json(message)
+
+    async def handle(kind: str, message: dict):
+        message_id = message["id"]
+        try:
+            if kind in SOCKET_TURNS:
+                # Closed right away when the turn is cancelled, which releases its admission ticket
+                async with aclosing(socket_turn(kind, message)) as turn:
+                    async for item in turn:
+                        await send({"id": message_id, "type": "token", "data": item})
+                await send({"id": message_id, "type": "end"})
+            else:
+                await send({"id": message_id, "type": "result", "data": await socket_lookup(kind, message)})
+        except AdmissionRejected as e:
+            await send({"id": message_id, "type": "error", "error": str(e), "status": e.status_code,
+                        "retry_after": e.retry_after})
+        except HTTPException as e:
+            await send({"id": message_id, "type": "error", "error": e.detail, "status": e.status_code,
+                        "retry_after": int(e.headers["Retry-After"]) if e.headers else None})
+        except Exception as e:
+            await send({"id": message_id, "type": "error", "error": f"{type(e).__name__}: {e}"})
+        finally:
+            tasks.pop(message_id, None)
+
+    try:
+        while True:
+            text = await websocket.receive_text()
+            socket_stats["messages"] += 1
+            try:
+                message = json.loads(text)
+                kind, message_id = message["type"], message.get("id")
+            except (ValueError, KeyError, TypeError):
+                await send({"id": None, "type": "error", "error": "Messages are JSON objects with a type"})
+                continue
+            if kind == "ping":
+                await send({"id": message_id, "type": "pong"})
+            elif kind == "cancel":
+                task = tasks.pop(message.get("target"), None)
+                if task is not None:
+                    task.cancel()
+                    await send({"id": message.get("target"), "type": "cancelled"})
+            elif kind not in SOCKET_TURNS | SOCKET_LOOKUPS:
+                await send({"id": message_id, "type": "error", "error": f"Unknown message type '{kind}'"})
+            elif message_id is None or message_id in tasks:
+                await send({"id": message_id, "type": "error", "error": "Every message needs an id of its own"})
+            else:
+                tasks[message_id] = asyncio.create_task(handle(kind, message))
+    except WebSocketDisconnect:
+        pass
+    finally:
+        socket_stats["open"] -= 1
+        # Cancelled turns stop their generation and keep their partial answer, as a disconnected HTTP stream
+        for task in tasks.values():
+            task.cancel()
+
+
 @router.post('/update_chat_history')
 async def update_chat_history(query: ChatHistoryRequest, db: Session = Depends(db_connection)):
     try:
@@ -170,17 +462,29 @@ async def update_chat_history(query: ChatHistoryRequest, db: Session = Depends(d
         return JSONResponse(content={"error": str(e)}, status_code=400)
 
 
+@router.get("/export/{table}")
+def export_table(table: str, file_format: str = "csv", start: str = None, end: str = None):
+    """
+    Stream a bulk export of chat data as a file download.
+    - table: 'messages' or 'session_history'.
+    - file_format: 'csv' or 'parquet' (zstd compressed, columnar).
+    - start / end: optional timestamp range, start inclusive and end exclusive (e.g. '2024-06-01').
+    """
+    if table not in EXPORT_TABLES:
+        return JSONResponse(content={"error": f"Unknown table '{table}'"}, status_code=400)
+    if file_format not in EXPORT_FORMATS:
+        return JSONResponse(content={"error": f"Unknown format '{file_format}'"}, status_code=400)
+
+    media_type, extension = EXPORT_FORMATS[file_format]
+    headers = {"Content-Disposition": f'attachment; filename="{table}.{extension}"'}
+    return StreamingResponse(export_stream(table, file_format, start, end), media_type=media_type, headers=headers)
+
+
 @router.post('/get_urls')
 async def get_metadata(query: QueryUrls):
     try:
-        file = f"{query.data_id}.json"
-        file_name = os.path.join(JSON_STORE_PATH, file).replace("\\", "/")
-        with open(file_name, 'r') as f:
-            extracted_dict = json.load(f)[query.data_id]
-        dict_output = extract_highest_ratio_dict(extracted_dict, query.chunk)
-        logger.info(dict_output)
         return JSONResponse(content={
-            'urls': dict_output.get('url', None)
+            'urls': lookup_urls(query.data_id, query.chunk)
         }, status_code=200)
     except Exception as e:
         return JSONResponse(content={"error": str(e)}, status_code=400)
@@ -200,7 +504,7 @@ async def get_metadata(query: QueryUrls):
 #         return JSONResponse(content={"error": str(e)}, status_code=400)
 
 
-@router.post('/get_iframe_link')
+@router.post('/get_iframe_link', dependencies=[Depends(require_ready)])
 async def get_metadata(query: FetchDataId):
     try:
         extracted_dict = await ai.get_iframe_link(query.chunk)
@@ -252,16 +556,15 @@ async def get_metadata(query: MetadataQuery):
         return JSONResponse(content={"error": str(e)}, status_code=400)
 
 
-# Define individual operations for each vector update status
+# Define individual operations for each vector update status, each one runs as a background job
 @router.post("/initial_cloud_refresh/")
 def initial_cloud_refresh():
     """
     Endpoint to perform initial cloud refresh:
     - Create local vector store.
-    - Upload vector store to cloud.
-    - Delete old cloud vector store.
+    - Upload vector store to cloud, the previous cloud version is replaced once the upload is complete.
     """
-    return execute_vector_update(lambda: (create_local_vector_store(), delete_merged_vector(), upload_merged_vector()))
+    return start_refresh_job("initial_cloud_refresh")
 
 
 @router.post("/local_refresh/")
@@ -269,7 +572,7 @@ def local_refresh():
     """
     Endpoint to perform local vector store refresh without cloud upload.
     """
-    return execute_vector_update(create_local_vector_store)
+    return start_refresh_job("local_refresh")
 
 
 @router.post("/partial_cloud_refresh/")
@@ -277,12 +580,9 @@ def partial_cloud_refresh():
     """
     Endpoint to refresh the vector store partially, syncing changes to cloud.
     """
-    embeddings = OpenAIEmbeddings()
-    if not os.path.exists(VECTOR_STORE_PATH):
+    if not VersionedStore(VECTOR_STORE_PATH).exists():
         raise HTTPException(status_code=400, detail="Vector store path does not exist.")
-
-    vectorstore = FAISS.load_local(VECTOR_STORE_PATH, embeddings, allow_dangerous_deserialization=True)
-    return execute_vector_update(lambda: create_partial_local_database(vectorstore))
+    return start_refresh_job("partial_cloud_refresh")
 
 
 @router.post("/iframe_vector_refresh/")
@@ -290,7 +590,7 @@ def iframe_vector_refresh():
     """
     Endpoint to refresh iframe vector store.
     """
-    return execute_vector_update(lambda: (get_iframe_images(), create_iframe_vector_store()))
+    return start_refresh_job("iframe_vector_refresh")
 
 
 @router.post("/image_vector_refresh/")
@@ -298,4 +598,58 @@ def image_vector_refresh():
     """
     Endpoint to refresh image vector store.
     """
-    return execute_vector_update(lambda: (get_all_images(), create_image_vector_store()))
+    return start_refresh_job("image_vector_refresh")
+
+
+@router.post("/reload_vector_stores/", dependencies=[Depends(require_ready)])
+def reload_vector_stores():
+    """
+    Endpoint to swap in the vector store versions published since the last reload without waiting for the poll.
+    """
+    ai.pull_vector_store()
+    return {"swapped": ai.reload_vector_stores(), "versions": ai.loaded_versions}
+
+
+@router.get("/jobs/")
+def list_jobs(limit: int = JOB_HISTORY_LIMIT):
+    """
+    Endpoint to list the most recent refresh jobs with their status and stage timings.
+    """
+    return job_runner.history(limit)
+
+
+@router.get("/jobs/{job_id}")
+def get_job(job_id: str):
+    """
+    Endpoint to follow a refresh job: status, current stage, progress and the duration of every stage.
+    """
+    job = job_runner.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str):
+    """
+    Endpoint to cancel a queued or running refresh job.
+    """
+    job = job_runner.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+
+@router.post("/message_retention/")
+def message_retention(max_age_days: int = RETENTION_DAYS, dry_run: bool = False):
+    """
+    Endpoint to archive messages older than max_age_days into the archive database and reclaim the freed space.
+    It runs as a job, follow it with /jobs/{job_id}: its archive_messages stage reports the metrics when done.
+    With dry_run only the number of messages that would be archived is reported, right away.
+    """
+    if not dry_run:
+        return start_refresh_job("message_retention", max_age_days=max_age_days)
+    try:
+        return archive_old_messages(max_age_days=max_age_days, dry_run=True)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"An unexpected error occurred: {str(e)}")
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 from pydantic import BaseModel
 
 
@@ -6,6 +6,8 @@ class QueryRequest(BaseModel):
     query: str
     responseLength: str
     session_id: str
+    # The turn the answer belongs to, a partial answer saved by the server is added to it
+    history_id: Optional[str] = None
 
 
 class ChangeHistoryNameRequest(BaseModel):
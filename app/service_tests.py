@@ -0,0 +1,610 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import pyarrow.parquet as pq
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from ai import AsyncCallbackHandler, ConversationalRAG
+from ai.admission import AdmissionController, AdmissionRejected, parse_reset
+from ai.coalescing import SingleFlight, coalescing_key
+from ai.streams import ResumableStreams, parse_event_id
+from ats import AnswerEnrichment, artist_img_generator, iframe_link_generator
+from crud import ARCHIVE_TABLE_DDL, RetentionError, archive_old_messages, export_stream, iter_table_batches
+from lib import Warmup
+from models import Messages, SessionHistory
+
+OLD_TIMESTAMP = "2020-01-01 10:00:00"
+# Third party packages the API process can't do without, their import time is what ``import main`` is measured against
+IMPORT_BASELINE = ["fastapi", "sqlalchemy", "openai", "langchain_openai", "langchain_community.vectorstores", "faiss"]
+# What ``import main`` may take once the baseline is imported, as a share of the baseline's own import time. About
+# twice what it measures now, so that only a real regression fails, e.g. a heavy dependency imported at module level
+IMPORT_TIME_RATIO = 0.5
+# Only refresh jobs and bucket syncs need these, the API process must not import them
+REFRESH_ONLY_MODULES = ["refresh", "ats_refresh", "google.cloud.storage", "bs4", "langchain.agents",
+                        "langchain.memory"]
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Runs against its own sqlite database (and archive) in a temporary directory."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.database_path = os.path.join(self.temp_dir.name, "chatbot.db")
+        self.archive_path = os.path.join(self.temp_dir.name, "chatbot_archive.db")
+        self.engine = create_engine(f"sqlite:///{self.database_path}")
+        Messages.__table__.create(self.engine)
+        SessionHistory.__table__.create(self.engine)
+        patches = [mock.patch("crud.retention.db_engine", self.engine),
+                   mock.patch("crud.retention.RETENTION_BATCH_PAUSE", 0),
+                   mock.patch("crud.export.Session", sessionmaker(bind=self.engine))]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.temp_dir.cleanup()
+
+    def insert_messages(self, texts, timestamp=OLD_TIMESTAMP):
+        with self.engine.begin() as connection:
+            for text in texts:
+                connection.exec_driver_sql(
+                    "INSERT INTO Messages (session_id, history_id, sender, message_text, timestamp) "
+                    "VALUES ('session', 'history', 'human', ?, ?)", (text, timestamp))
+
+    def rows(self, path, query):
+        with sqlite3.connect(path) as connection:
+            return connection.execute(query).fetchall()
+
+
+class TestExport(DatabaseTestCase):
+
+    def setUp(self):
+        super().setUp()
+        # Two messages a day from June 1st, with a quote and a line break to escape in CSV
+        with self.engine.begin() as connection:
+            for i in range(7):
+                connection.exec_driver_sql(
+                    "INSERT INTO Messages (session_id, history_id, sender, message_text, timestamp) "
+                    "VALUES (?, 'history', ?, ?, ?)", (f"session {i % 2}", "human" if i % 2 else "ai",
+                                                       f'Message {i}, "quoted"\nsecond line',
+                                                       f"2024-06-0{i // 2 + 1} 10:00:0{i}"))
+            connection.exec_driver_sql("UPDATE Messages SET partial = 1 WHERE message_id = 7")
+            connection.exec_driver_sql("INSERT INTO SessionHistory (session_id, history_id, history_name, "
+                                       "session_creation_timestamp, history_creation_timestamp) "
+                                       "VALUES ('session 0', 'history', 'Monet', '2024-06-01', '2024-06-01')")
+
+    def export(self, table, file_format, **kwargs):
+        return list(export_stream(table, file_format, **kwargs))
+
+    def test_batches_walk_the_table_by_key(self):
+        with sessionmaker(bind=self.engine)() as db:
+            batches = list(iter_table_batches(db, "messages", batch_size=3))
+            self.assertEqual([[row[0] for row in rows] for rows in batches], [[1, 2, 3], [4, 5, 6], [7]])
+            # A last full page ends with an empty one
+            batches = list(iter_table_batches(db, "messages", end="2024-06-03", batch_size=2))
+            self.assertEqual([[row[0] for row in rows] for rows in batches], [[1, 2], [3, 4]])
+            batches = list(iter_table_batches(db, "messages", start="2024-06-05", batch_size=2))
+            self.assertEqual(batches, [])
+
+    def test_csv_export(self):
+        chunks = self.export("messages", "csv", batch_size=3)
+        # A header and one chunk per batch
+        self.assertEqual(len(chunks), 3)
+        rows = list(csv.reader(io.StringIO("".join(chunks))))
+        self.assertEqual(rows[0], ["message_id", "session_id", "history_id", "sender", "message_text", "timestamp",
+                                   "partial"])
+        self.assertEqual(len(rows), 8)
+        self.assertEqual(rows[3], ["3", "session 0", "history", "ai", 'Message 2, "quoted"\nsecond line',
+                                   "2024-06-02 10:00:02", "False"])
+        self.assertEqual(rows[7][-1], "True")
+
+        rows = list(csv.reader(io.StringIO("".join(self.export("messages", "csv", start="2024-06-02",
+                                                               end="2024-06-04", batch_size=3)))))
+        self.assertEqual([row[0] for row in rows[1:]], ["3", "4", "5", "6"])
+        rows = list(csv.reader(io.StringIO("".join(self.export("session_history", "csv")))))
+        self.assertEqual(rows[1][:4], ["1", "session 0", "history", "Monet"])
+
+    def test_parquet_export(self):
+        path = os.path.join(self.temp_dir.name, "messages.parquet")
+        with open(path, "wb") as f:
+            f.writelines(self.export("messages", "parquet", start="2024-06-02", batch_size=2))
+        parquet_file = pq.ParquetFile(path)
+        # One row group per batch
+        self.assertEqual(parquet_file.metadata.num_row_groups, 3)
+        self.assertEqual(parquet_file.metadata.row_group(0).column(0).compression, "ZSTD")
+        table = parquet_file.read()
+        self.assertEqual(table.column("message_id").to_pylist(), [3, 4, 5, 6, 7])
+        self.assertEqual(table.column("message_text").to_pylist()[0], 'Message 2, "quoted"\nsecond line')
+        self.assertEqual(table.column("partial").to_pylist(), [False] * 4 + [True])
+
+    def test_unknown_table_or_format(self):
+        with self.assertRaises(ValueError):
+            self.export("users", "csv")
+        with self.assertRaises(ValueError):
+            self.export("messages", "xlsx")
+
+
+class TestMessageRetention(DatabaseTestCase):
+
+    def archive(self, **kwargs):
+        return archive_old_messages(max_age_days=30, archive_path=self.archive_path, batch_size=2, **kwargs)
+
+    def test_old_messages_move_in_batches(self):
+        self.insert_messages(["first", "second", "third"])
+        self.insert_messages(["recent"], timestamp="2999-01-01 10:00:00")
+
+        metrics = self.archive(dry_run=True)
+        self.assertEqual((metrics["candidate_messages"], metrics["archived_messages"]), (3, 0))
+        self.assertFalse(os.path.exists(self.archive_path))
+
+        metrics = self.archive()
+        self.assertEqual((metrics["archived_messages"], metrics["batches"]), (3, 2))
+        self.assertEqual(self.rows(self.database_path, "SELECT message_text FROM Messages"), [("recent",)])
+        self.assertEqual(self.rows(self.archive_path, "SELECT message_id, message_text FROM Messages"),
+                         [(1, "first"), (2, "second"), (3, "third")])
+
+    def test_reused_message_ids_are_archived(self):
+        self.insert_messages(["first", "second", "third"])
+        self.archive()
+        # The table is empty, sqlite hands out ids 1 to 3 again
+        self.insert_messages(["fourth", "fifth", "sixth"])
+        self.assertEqual(self.rows(self.database_path, "SELECT message_id FROM Messages"), [(1,), (2,), (3,)])
+
+        self.assertEqual(self.archive()["archived_messages"], 3)
+        self.assertEqual(self.rows(self.database_path, "SELECT COUNT(*) FROM Messages"), [(0,)])
+        self.assertEqual(self.rows(self.archive_path, "SELECT message_id, message_text FROM Messages"),
+                         [(1, "first"), (2, "second"), (3, "third"), (1, "fourth"), (2, "fifth"), (3, "sixth")])
+
+    def test_batch_is_rolled_back_when_counts_differ(self):
+        self.insert_messages(["first", "second"])
+        with sqlite3.connect(self.archive_path) as connection:
+            connection.execute(ARCHIVE_TABLE_DDL.replace("archive.Messages", "Messages"))
+            # Drops one of the copies
+            connection.execute("CREATE TRIGGER drop_copy BEFORE INSERT ON Messages "
+                               "WHEN NEW.message_text = 'second' BEGIN SELECT RAISE(IGNORE); END")
+
+        with self.assertRaises(RetentionError):
+            self.archive()
+        self.assertEqual(self.rows(self.database_path, "SELECT COUNT(*) FROM Messages"), [(2,)])
+        self.assertEqual(self.rows(self.archive_path, "SELECT COUNT(*) FROM Messages"), [(0,)])
+
+
+class TestWarmup(unittest.TestCase):
+
+    def test_components_wait_for_their_dependencies(self):
+        order = []
+        warmup = Warmup()
+        warmup.record("imports", 0.5)
+        warmup.add("slow", lambda: (time.sleep(0.2), order.append("slow")))
+        warmup.add("fast", lambda: order.append("fast"))
+        warmup.add("after_slow", lambda: order.append("after_slow"), after=["slow"])
+        self.assertFalse(warmup.ready())
+        warmup.start()
+        self.assertTrue(warmup.wait(5))
+        self.assertEqual(order, ["fast", "slow", "after_slow"])
+        components = warmup.status()["components"]
+        self.assertGreaterEqual(components["slow"]["seconds"], 0.2)
+        self.assertGreaterEqual(components["after_slow"]["started"], 0.2)
+
+    def test_failures_keep_the_service_unready(self):
+        warmup = Warmup(retries=2, retry_delay=0.01)
+        warmup.add("index", lambda: 1 / 0)
+        warmup.add("watcher", lambda: None, after=["index"])
+        warmup.start()
+        self.assertFalse(warmup.failed())
+        self.assertFalse(warmup.wait(5))
+        self.assertTrue(warmup.failed())
+        components = warmup.status()["components"]
+        self.assertEqual(components["index"]["error"], "ZeroDivisionError: division by zero")
+        self.assertEqual(components["index"]["attempts"], 3)
+        self.assertEqual((components["watcher"]["status"], components["watcher"]["started"]), ("failed", None))
+
+    def test_failed_components_are_retried(self):
+        calls = []
+
+        def flaky():
+            calls.append(time.perf_counter())
+            if len(calls) < 3:
+                raise ConnectionError("bucket unreachable")
+
+        warmup = Warmup(retries=3, retry_delay=0.05)
+        warmup.add("pull", flaky)
+        warmup.add("index", lambda: None, after=["pull"])
+        warmup.start()
+        self.assertTrue(warmup.wait(5))
+        self.assertFalse(warmup.failed())
+        pull = warmup.status()["components"]["pull"]
+        self.assertEqual((pull["status"], pull["attempts"], pull["error"]), ("ready", 3, None))
+        # 0.05s then 0.1s between the attempts
+        self.assertGreaterEqual(calls[2] - calls[0], 0.15)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def test_identical_requests_share_one_generation(self):
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            for token in ["Monet ", "was ", "a ", "painter"]:
+                await asyncio.sleep(0.01)
+                yield token
+
+        async def collect(flight):
+            return "".join([token async for token in flight.subscribe()])
+
+        async def scenario():
+            single_flight = SingleFlight()
+            key = coalescing_key("Who was  Monet?", "short")
+            self.assertEqual(key, coalescing_key("who was monet?", "Short"))
+            flights = [single_flight.join(key, generate) for _ in range(3)]
+            self.assertEqual([leader for _, leader in flights], [True, False, False])
+            readers = [asyncio.create_task(collect(flight)) for flight, _ in flights]
+            await asyncio.sleep(0.03)
+            # A late joiner gets the tokens produced before it arrived replayed
+            late, leader = single_flight.join(key, generate)
+            self.assertFalse(leader)
+            self.assertGreater(len(late.items), 0)
+            answers = await asyncio.gather(*readers, collect(late))
+            self.assertEqual(answers, ["Monet was a painter"] * 4)
+            self.assertEqual(len(calls), 1)
+            # Finished flights are forgotten, unkeyed requests are never shared
+            self.assertTrue(single_flight.join(key, generate)[1])
+            self.assertTrue(single_flight.join(None, generate)[1])
+            self.assertTrue(single_flight.join(None, generate)[1])
+            await asyncio.sleep(0.2)
+            self.assertEqual({key: single_flight.stats[key] for key in ("leaders", "followers", "completed")},
+                             {"leaders": 4, "followers": 3, "completed": 4})
+            self.assertEqual(single_flight.flights, {})
+
+        asyncio.run(scenario())
+
+    def test_generation_is_cancelled_when_every_client_disconnects(self):
+        stopped = []
+
+        async def generate():
+            try:
+                for i in range(100):
+                    await asyncio.sleep(0.01)
+                    yield f"token{i} "
+            finally:
+                stopped.append(True)
+
+        async def read(flight):
+            async for _ in flight.subscribe():
+                pass
+
+        async def scenario():
+            single_flight = SingleFlight()
+            flights = [single_flight.join(("q",), generate)[0] for _ in range(2)]
+            readers = [asyncio.create_task(read(flight)) for flight in flights]
+            await asyncio.sleep(0.05)
+            readers[0].cancel()
+            await asyncio.sleep(0.05)
+            # One client is still reading, the generation goes on
+            self.assertEqual((stopped, flights[0].closed), ([], False))
+            readers[1].cancel()
+            await asyncio.sleep(0.05)
+            self.assertEqual((stopped, flights[0].closed), ([True], True))
+            stats = single_flight.stats
+            self.assertEqual((stats["cancelled"], stats["disconnects"]), (1, 2))
+            self.assertGreater(stats["cancelled_tokens"], 5)
+            self.assertLess(stats["cancelled_tokens"], 100)
+            self.assertGreater(stats["cancelled_seconds"], 0.05)
+
+        asyncio.run(scenario())
+
+    def test_followers_get_the_error_of_the_leader(self):
+        async def generate():
+            yield "partial"
+            raise RuntimeError("upstream closed")
+
+        async def scenario():
+            single_flight = SingleFlight()
+            flights = [single_flight.join(("q",), generate)[0] for _ in range(2)]
+            for flight in flights:
+                received = []
+                with self.assertRaises(RuntimeError):
+                    async for token in flight.subscribe():
+                        received.append(token)
+                self.assertEqual(received, ["partial"])
+
+        asyncio.run(scenario())
+
+
+class TestAdmissionController(unittest.TestCase):
+
+    def test_limits_queue_and_rejections(self):
+        async def scenario():
+            admission = AdmissionController(limit=1, session_limit=2, queue_size=1, queue_timeout=0.2)
+            first = await admission.admit("a")
+            queued = asyncio.create_task(admission.admit("b"))
+            await asyncio.sleep(0.01)
+            self.assertEqual(admission.status()["queue_depth"], 1)
+            with self.assertRaises(AdmissionRejected) as rejected:
+                await admission.admit("c")
+            self.assertEqual((rejected.exception.status_code, rejected.exception.reason), (503, "queue_full"))
+            # The released slot goes to the queued request
+            first.release()
+            first.release()
+            second = await queued
+            self.assertEqual(admission.active, 1)
+            # Joining a generation in flight needs no slot but counts for the session
+            await admission.admit("b", shared=True)
+            with self.assertRaises(AdmissionRejected) as rejected:
+                await admission.admit("b", shared=True)
+            self.assertEqual((rejected.exception.status_code, rejected.exception.reason), (429, "session"))
+            with self.assertRaises(AdmissionRejected) as rejected:
+                await admission.admit("d")
+            self.assertEqual(rejected.exception.reason, "timeout")
+            self.assertGreaterEqual(rejected.exception.retry_after, 1)
+            second.release()
+            self.assertEqual((admission.active, admission.status()["queue_depth"]), (0, 0))
+            self.assertGreaterEqual(admission.stats["max_wait_seconds"], 0.2)
+
+            admission.observe_rate_limits({"x-ratelimit-remaining-requests": "0", "x-ratelimit-reset-requests": "2s",
+                                           "x-ratelimit-remaining-tokens": "90000"})
+            with self.assertRaises(AdmissionRejected) as rejected:
+                await admission.admit("e")
+            self.assertEqual((rejected.exception.reason, rejected.exception.retry_after), ("rate_limited", 2))
+
+        asyncio.run(scenario())
+        self.assertEqual((parse_reset("6m0s"), parse_reset("120ms"), parse_reset("1.5s")), (360, 0.12, 1.5))
+
+
+class TestAdmittedGeneration(unittest.TestCase):
+
+    def test_only_leaders_hold_a_slot(self):
+        async def generate():
+            for token in ["Monet", " painted", " water", " lilies"]:
+                await asyncio.sleep(0.05)
+                yield token
+
+        async def scenario():
+            admission = AdmissionController(limit=2, queue_timeout=5)
+            ai = SimpleNamespace(in_flight=SingleFlight(), admission=admission)
+            others = [await admission.admit("x"), await admission.admit("y")]
+            # Two identical questions wait for a slot, the first one to get it starts the generation
+            waiting = [asyncio.create_task(ConversationalRAG.admit(ai, ("q",), generate, f"session {i}"))
+                       for i in range(2)]
+            await asyncio.sleep(0.01)
+            others[0].release()
+            leader = await waiting[0]
+            self.assertTrue(leader.leader)
+            # The second one finds it running when it gets its slot, it follows and gives the slot back
+            others[1].release()
+            follower = await waiting[1]
+            self.assertEqual((follower.leader, follower.ticket.shared, follower.flight), (False, True, leader.flight))
+            self.assertEqual(admission.active, 1)
+            joined = await ConversationalRAG.admit(ai, ("q",), generate, "session 2")
+            self.assertEqual((joined.leader, admission.active), (False, 1))
+
+            # Released before it was streamed, a leader stops its generation
+            failed = await ConversationalRAG.admit(ai, ("other",), generate, "session 3")
+            failed.release()
+            await asyncio.sleep(0.01)
+            self.assertTrue(failed.flight.abandoned)
+            self.assertEqual(admission.active, 1)
+            for generation in (leader, follower, joined):
+                generation.release()
+            self.assertEqual((admission.active, admission.stats["shared"]), (0, 2))
+
+        asyncio.run(scenario())
+
+
+class TestSavedAnswers(unittest.TestCase):
+    tokens = ["Final Answer", '"action_input": "', "Monet", " painted", " water", " lilies"]
+
+    async def run_call(self, prompt, query, resLen_string, responseLength, stream_it, chat_history):
+        for token in self.tokens:
+            await asyncio.sleep(0.02)
+            await stream_it.on_llm_new_token(token)
+        await stream_it.on_llm_end(None)
+
+    def saved(self, scenario):
+        """The (session, text, partial) of the answers ``scenario`` saves, with the agent and the database faked."""
+        rag = ConversationalRAG.__new__(ConversationalRAG)
+        rag.in_flight, rag.admission, rag.run_call = SingleFlight(), AdmissionController(), self.run_call
+
+        async def turn(session_id):
+            stream_it = AsyncCallbackHandler(None, session_id, f"history of {session_id}")
+            generation = await rag.admit_agent("prompt", "Who was Monet?", "short", "short", stream_it, [], session_id)
+            return rag.create_gen(generation, stream_it)
+
+        with mock.patch("ai.openai_service.insert_message") as insert_message:
+            asyncio.run(scenario(turn))
+        return [(call.args[1], call.args[4], call.kwargs["partial"]) for call in insert_message.call_args_list]
+
+    def test_leader_leaving_keeps_the_complete_answer(self):
+        async def scenario(turn):
+            leader, follower = await turn("leader"), await turn("follower")
+            await leader.__anext__()
+            await leader.aclose()
+            [token async for token in follower]
+
+        self.assertEqual(self.saved(scenario), [("leader", "".join(self.tokens), False),
+                                                ("follower", "".join(self.tokens), False)])
+
+    def test_clients_leaving_before_the_end_keep_a_partial_answer(self):
+        async def scenario(turn):
+            leader, follower = await turn("leader"), await turn("follower")
+            await leader.__anext__()
+            await follower.__anext__()
+            await follower.aclose()
+            [token async for token in leader]
+            # Nobody follows this one to its end, it is stopped
+            alone = await turn("alone")
+            await alone.__anext__()
+            await alone.aclose()
+            await asyncio.sleep(0.05)
+
+        saved = self.saved(scenario)
+        self.assertEqual(saved[0][0::2], ("follower", True))
+        self.assertTrue("".join(self.tokens).startswith(saved[0][1]))
+        self.assertEqual(saved[1], ("leader", "".join(self.tokens), False))
+        self.assertEqual(saved[2], ("alone", "".join(self.tokens[:2]), True))
+
+
+class TestPartialResponses(DatabaseTestCase):
+
+    async def stream_completion(self, prompt, query, resLen_String, responseLength, chat_history):
+        for text in ["Monet", "Monet painted"]:
+            yield json.dumps({"text_message": text})
+        await asyncio.sleep(60)
+
+    def leave_after_first_frame(self, history_id=None):
+        rag = ConversationalRAG.__new__(ConversationalRAG)
+        rag.in_flight, rag.admission = SingleFlight(), AdmissionController()
+        rag.stream_completion = self.stream_completion
+
+        async def scenario():
+            generation = await rag.admit_response("prompt", "Who was Monet?", "short", "short", [], "session")
+            frames = rag.response_generator(generation, db, "session", history_id, "Who was Monet?")
+            await frames.__anext__()
+            await frames.aclose()
+            generation.release()
+
+        db = sessionmaker(bind=self.engine)()
+        try:
+            asyncio.run(scenario())
+        finally:
+            db.close()
+        return self.rows(self.database_path,
+                         "SELECT history_id, message_text, partial FROM Messages WHERE sender = 'ai'")
+
+    def test_partial_answer_is_saved_to_its_turn(self):
+        self.assertEqual(self.leave_after_first_frame("turn"), [("turn", "Monet", 1)])
+
+    def test_partial_answer_goes_to_the_turn_of_its_question(self):
+        self.insert_messages(["Who was Monet?"])
+        self.assertEqual(self.leave_after_first_frame(), [("history", "Monet", 1)])
+
+    def test_partial_answer_of_an_unknown_turn_is_not_saved(self):
+        self.assertEqual(self.leave_after_first_frame(), [])
+
+
+class TestResumableStreams(unittest.TestCase):
+
+    def test_reconnecting_client_resumes_without_a_new_generation(self):
+        calls, stopped = [], []
+
+        async def generate():
+            calls.append(1)
+            try:
+                for token in ["Monet", " painted", "\nwater", " lilies"]:
+                    await asyncio.sleep(0.05)
+                    yield token
+            finally:
+                stopped.append(True)
+
+        def parse(event):
+            fields = [line.split(": ", 1) for line in event.rstrip("\n").split("\n")]
+            return ({key: value for key, value in fields if key != "data"},
+                    "\n".join(value for key, value in fields if key == "data"))
+
+        async def scenario():
+            streams = ResumableStreams(grace=0.1, ttl=5)
+            events = streams.open(generate(), "session")
+            received = [parse(await events.__anext__()) for _ in range(2)]
+            # The connection drops, the generation goes on into the replay buffer
+            await events.aclose()
+            await asyncio.sleep(0.05)
+            last_event_id = received[-1][0]["id"]
+            self.assertEqual(parse_event_id(last_event_id)[1], 1)
+            self.assertIsNone(streams.resume(last_event_id, "other session"))
+            self.assertIsNone(streams.resume("unknown:1", "session"))
+            received += [parse(event) async for event in streams.resume(last_event_id, "session")]
+            self.assertEqual("".join(data for _, data in received), "Monet painted\nwater lilies")
+            self.assertEqual([fields.get("event") for fields, _ in received], [None] * 4 + ["end"])
+            self.assertEqual(len({fields["id"] for fields, _ in received}), 5)
+            self.assertEqual((len(calls), streams.resumed), (1, 1))
+
+            # A stream nobody reads is cancelled after the grace period
+            streams.open(generate(), "session")
+            await asyncio.sleep(0.15)
+            self.assertEqual(stopped, [True, True])
+            self.assertEqual(streams.pumps.stats["cancelled"], 1)
+
+        asyncio.run(scenario())
+
+
+class TestAnswerEnrichment(unittest.TestCase):
+
+    def test_lines_are_scanned_while_the_answer_streams(self):
+        lines = ["**Impressionism**:", "- Claude Monet painted Water Lilies with Pierre-Auguste Renoir nearby.",
+                 "- Picasso and Braque developed Cubism after Cezanne."]
+        answer = "\n".join(lines)
+
+        async def scenario():
+            enrichment = AnswerEnrichment(os.path.join(os.path.dirname(__file__), "database.csv"))
+            text = ""
+            for token in answer.split(" "):
+                text += token + " "
+                enrichment.feed(text)
+                await asyncio.sleep(0.01)
+            # Lines were scanned before the answer ended
+            self.assertGreaterEqual(len(enrichment.scans), 1)
+            enrichment.finish(text)
+            return await enrichment.result()
+
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        try:
+            result = asyncio.run(scenario())
+            self.assertEqual(result["headings"], ["Impressionism"])
+            self.assertEqual(set(result["artist_images"]),
+                             set().union(*[artist_img_generator(line) for line in lines]))
+            self.assertEqual(set(result["iframe"]), set().union(*[iframe_link_generator(line) for line in lines]))
+            self.assertIn(["artist", "monet_claude", "claude monet"], result["entities"])
+            self.assertIn("Monet", result["sources"])
+        finally:
+            os.chdir(cwd)
+
+
+class TestImportTime(unittest.TestCase):
+
+    def import_main(self):
+        """
+        ``import main`` in a new process after the baseline packages, both timed in that same process so that the
+        machine's speed cancels out. Returns the refresh-only modules it loaded and the lowest ratio of two runs.
+        """
+        script = (f"import json, sys, time\n"
+                  f"start = time.perf_counter()\n"
+                  f"import {', '.join(IMPORT_BASELINE)}\n"
+                  f"baseline = time.perf_counter() - start\n"
+                  f"start = time.perf_counter()\n"
+                  f"import main\n"
+                  f"print(json.dumps({{'ratio': (time.perf_counter() - start) / baseline, "
+                  f"'modules': [module for module in {REFRESH_ONLY_MODULES!r} if module in sys.modules]}}))")
+        results = []
+        with tempfile.TemporaryDirectory() as temp_dir:
+            env = dict(os.environ, OPENAI_API_KEY=os.environ.get("OPENAI_API_KEY", "sk-test"),
+                       PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+            for _ in range(2):
+                result = subprocess.run([sys.executable, "-c", script], cwd=temp_dir, env=env, capture_output=True,
+                                        text=True, timeout=300)
+                self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+                results.append(json.loads(result.stdout.splitlines()[-1]))
+        return results[0]["modules"], min(result["ratio"] for result in results)
+
+    def test_api_imports_stay_light(self):
+        modules, ratio = self.import_main()
+        self.assertEqual(modules, [])
+        self.assertLessEqual(ratio, IMPORT_TIME_RATIO, f"import main took {ratio:.2f}x the baseline imports")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,4 @@
+from stores.docstore import *
+from stores.mapped_index import *
+from stores.versions import *
+from stores.artifact_sync import *
\ No newline at end of file
@@ -0,0 +1,247 @@
+import base64
+import fcntl
+import hashlib
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+from lib import logger
+from stores.versions import VersionedStore, VECTOR_STORE_VERSIONS_KEEP, CURRENT_FILE, VERSIONS_DIR
+
+ARTIFACT_SYNC_WORKERS = int(os.environ.get("ARTIFACT_SYNC_WORKERS", 8))
+# Every API worker pulls the bucket's version, they share the store directory and its staging directories
+PULL_LOCK_FILE = ".pull.lock"
+
+
+def file_checksum(path: str) -> str:
+    """Base64 MD5 of a file, the format GCS reports for its objects."""
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return base64.b64encode(digest.digest()).decode()
+
+
+class LocalBackend:
+    """Object storage in a local directory, object names are relative paths. Used by tests and offline runs."""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, *name.split("/"))
+
+    def list(self, prefix: str) -> Dict[str, str]:
+        objects = {}
+        base = self.path(prefix)
+        for directory, _, files in os.walk(base):
+            for file in files:
+                path = os.path.join(directory, file)
+                objects[os.path.relpath(path, base).replace(os.sep, "/")] = file_checksum(path)
+        return objects
+
+    def upload(self, local_path: str, name: str) -> None:
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        shutil.copyfile(local_path, self.path(name))
+
+    def download(self, name: str, local_path: str) -> None:
+        shutil.copyfile(self.path(name), local_path)
+
+    def copy(self, source: str, destination: str) -> None:
+        self.upload(self.path(source), destination)
+
+    def read_text(self, name: str) -> Optional[str]:
+        try:
+            with open(self.path(name), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write_text(self, name: str, text: str) -> None:
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        with open(f"{self.path(name)}.tmp", 'w') as f:
+            f.write(text)
+        os.replace(f"{self.path(name)}.tmp", self.path(name))
+
+    def delete(self, name: str) -> None:
+        if os.path.exists(self.path(name)):
+            os.remove(self.path(name))
+
+
+class GcsBackend:
+    """
+    Objects of a Google Cloud Storage bucket.
+    The client honours STORAGE_EMULATOR_HOST, so the same code runs against a local emulator.
+    """
+
+    def __init__(self, bucket_name: str, client=None):
+        # Imported here, only processes that sync with a bucket pay for the google client libraries
+        from google.api_core.exceptions import NotFound
+        from google.cloud import storage
+
+        self.not_found = NotFound
+        self.bucket = (client or storage.Client()).bucket(bucket_name)
+
+    def list(self, prefix: str) -> Dict[str, str]:
+        return {blob.name[len(prefix):]: blob.md5_hash for blob in self.bucket.list_blobs(prefix=prefix)}
+
+    def upload(self, local_path: str, name: str) -> None:
+        self.bucket.blob(name).upload_from_filename(local_path, checksum="md5")
+
+    def download(self, name: str, local_path: str) -> None:
+        self.bucket.blob(name).download_to_filename(local_path, checksum="md5")
+
+    def copy(self, source: str, destination: str) -> None:
+        self.bucket.copy_blob(self.bucket.blob(source), self.bucket, destination)
+
+    def read_text(self, name: str) -> Optional[str]:
+        try:
+            return self.bucket.blob(name).download_as_text()
+        except self.not_found:
+            return None
+
+    def write_text(self, name: str, text: str) -> None:
+        self.bucket.blob(name).upload_from_string(text)
+
+    def delete(self, name: str) -> None:
+        try:
+            self.bucket.blob(name).delete()
+        except self.not_found:
+            pass
+
+
+@contextmanager
+def pull_lock(store: VersionedStore) -> Iterator[bool]:
+    """Lock the pulls into ``store`` across processes, yields False when another process holds the lock."""
+    os.makedirs(store.root, exist_ok=True)
+    with open(os.path.join(store.root, PULL_LOCK_FILE), 'w') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ArtifactSync:
+    """
+    Mirrors the versions of a local VersionedStore to object storage and back.
+    - Remote layout follows the local one: ``<prefix>/versions/<version>/<file>`` and a ``<prefix>/CURRENT``
+      pointer object, written last, so readers never see a half uploaded version.
+    - Files are transferred in parallel, files whose checksum already matches are skipped. Files unchanged
+      since the current remote version are copied inside the bucket instead of uploaded.
+    - An interrupted push or pull resumes where it stopped when run again.
+    - A pull never goes back to an older version than the local one, see pull.
+    - Only the newest ``keep`` remote versions are kept, the current one is never removed.
+    """
+
+    def __init__(self, backend, prefix: str, workers: int = ARTIFACT_SYNC_WORKERS,
+                 keep: int = VECTOR_STORE_VERSIONS_KEEP):
+        self.backend = backend
+        self.prefix = prefix.strip("/")
+        self.workers = max(1, workers)
+        self.keep = max(1, keep)
+        self.pointer_name = f"{self.prefix}/{CURRENT_FILE}"
+        self.stats = {}
+
+    def version_prefix(self, version: str) -> str:
+        return f"{self.prefix}/{VERSIONS_DIR}/{version}/"
+
+    def remote_version(self) -> Optional[str]:
+        version = self.backend.read_text(self.pointer_name)
+        return version.strip() if version else None
+
+    def remote_versions(self) -> List[str]:
+        names = self.backend.list(f"{self.prefix}/{VERSIONS_DIR}/")
+        return sorted({name.split("/")[0] for name in names if "/" in name})
+
+    def run(self, function, items) -> None:
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # list() re-raises the first transfer error
+            list(pool.map(function, items))
+
+    def push(self, store: VersionedStore) -> Optional[str]:
+        """Upload the current version of ``store`` and point the remote pointer at it."""
+        version = store.current_version()
+        if version is None:
+            raise FileNotFoundError(f"No published version in {store.root}")
+        start_time = time.time()
+        local_path = store.version_path(version)
+        checksums = {file: file_checksum(os.path.join(local_path, file)) for file in os.listdir(local_path)}
+
+        uploaded = self.backend.list(self.version_prefix(version))
+        previous = self.remote_version()
+        previous_files = self.backend.list(self.version_prefix(previous)) if previous and previous != version else {}
+        to_copy = [file for file, checksum in checksums.items()
+                   if uploaded.get(file) != checksum and previous_files.get(file) == checksum]
+        to_upload = [file for file, checksum in checksums.items()
+                     if uploaded.get(file) != checksum and file not in to_copy]
+
+        self.run(lambda file: self.backend.copy(self.version_prefix(previous) + file,
+                                                self.version_prefix(version) + file), to_copy)
+        self.run(lambda file: self.backend.upload(os.path.join(local_path, file),
+                                                  self.version_prefix(version) + file), to_upload)
+        if self.backend.list(self.version_prefix(version)) != checksums:
+            raise IOError(f"Upload of version {version} to {self.prefix} doesn't match the local files")
+        if previous != version:
+            self.backend.write_text(self.pointer_name, version)
+
+        removed = self.gc()
+        self.stats = {"version": version, "uploaded": len(to_upload), "copied": len(to_copy),
+                      "skipped": len(checksums) - len(to_upload) - len(to_copy),
+                      "bytes_uploaded": sum(os.path.getsize(os.path.join(local_path, file)) for file in to_upload),
+                      "removed_versions": removed, "seconds": round(time.time() - start_time, 3)}
+        logger.info(f"Pushed {store.root} to {self.prefix}: {self.stats}")
+        return version
+
+    def pull(self, store: VersionedStore) -> Optional[str]:
+        """
+        Download the current remote version into ``store`` and activate it when it is newer than the local one.
+        - A local version newer than the remote one (published here and not pushed yet) is kept, so is the
+          remote one while a newer local build is being staged: the next push uploads them.
+        - One process pulls into a store at a time, the others skip it until their next pull.
+        Returns the version ``store`` is at.
+        """
+        version = self.remote_version()
+        if version is None:
+            return None
+        start_time = time.time()
+        checksums = self.backend.list(self.version_prefix(version))
+        with pull_lock(store) as locked:
+            # Version names sort by creation time
+            current = store.current_version()
+            if not locked or (current is not None and current >= version) or \
+                    any(staged > version for staged in store.staged_versions()):
+                self.stats = {"version": current, "remote_version": version, "downloaded": 0,
+                              "skipped": len(checksums), "seconds": 0.0}
+                return current
+
+            local_path = store.version_path(version)
+            if not os.path.isdir(local_path):
+                # Files are downloaded into the staging directory, a previous interrupted pull left some there
+                local_path = store.staging_path(version)
+                os.makedirs(local_path, exist_ok=True)
+            to_download = [file for file, checksum in checksums.items()
+                           if not os.path.exists(os.path.join(local_path, file)) or
+                           file_checksum(os.path.join(local_path, file)) != checksum]
+            self.run(lambda file: self.backend.download(self.version_prefix(version) + file,
+                                                        os.path.join(local_path, file)), to_download)
+            store.activate(version)
+        self.stats = {"version": version, "remote_version": version, "downloaded": len(to_download),
+                      "skipped": len(checksums) - len(to_download), "seconds": round(time.time() - start_time, 3)}
+        logger.info(f"Pulled {self.prefix} into {store.root}: {self.stats}")
+        return version
+
+    def gc(self) -> List[str]:
+        current = self.remote_version()
+        removed = [version for version in self.remote_versions()[:-self.keep] if version != current]
+        names = [self.version_prefix(version) + file for version in removed
+                 for file in self.backend.list(self.version_prefix(version))]
+        self.run(self.backend.delete, names)
+        return removed
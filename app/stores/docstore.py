@@ -0,0 +1,142 @@
+import json
+import mmap
+import os
+import pickle
+from collections.abc import Mapping
+from typing import Dict, Iterator, Tuple, Union
+
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_core.documents import Document
+
+from lib import logger
+
+DOCSTORE_FILE = "index.docstore"
+DOCSTORE_MAGIC = b"TASDOCS1"
+# Columns of the docstore file, row i is the document at position i of the FAISS index
+DOCSTORE_COLUMNS = ("id", "page_content", "metadata")
+
+
+def write_columnar_docstore(docstore: Docstore, index_to_docstore_id: Dict[int, str], path: str) -> None:
+    """
+    Write the documents of a FAISS store as one file of offset-indexed columns:
+    ``magic | rows (u64) | offsets (u64, columns x rows + 1) | id column | page_content column | metadata column``.
+    Offsets are relative to the start of the data, metadata is stored as JSON.
+    """
+    ids = [index_to_docstore_id[i] for i in range(len(index_to_docstore_id))]
+    columns = [[], [], []]
+    for doc_id in ids:
+        document = docstore.search(doc_id)
+        columns[0].append(doc_id.encode())
+        columns[1].append(document.page_content.encode())
+        columns[2].append(json.dumps(document.metadata).encode())
+
+    offsets = np.zeros((len(DOCSTORE_COLUMNS), len(ids) + 1), dtype='<u8')
+    position = 0
+    for column, values in enumerate(columns):
+        offsets[column, 0] = position
+        offsets[column, 1:] = position + np.cumsum([len(value) for value in values], dtype='<u8')
+        position = int(offsets[column, -1])
+
+    tmp_path = os.path.join(path, f"{DOCSTORE_FILE}.tmp")
+    with open(tmp_path, 'wb') as f:
+        f.write(DOCSTORE_MAGIC)
+        f.write(np.array([len(ids)], dtype='<u8').tobytes())
+        f.write(offsets.tobytes())
+        for values in columns:
+            f.writelines(values)
+    os.replace(tmp_path, os.path.join(path, DOCSTORE_FILE))
+
+
+def has_columnar_docstore(path: str) -> bool:
+    return os.path.exists(os.path.join(path, DOCSTORE_FILE))
+
+
+class ColumnarDocstore(Docstore):
+    """
+    Read only docstore over a memory-mapped columnar file, see ``write_columnar_docstore``.
+    - Nothing is unpickled: opening the file only decodes the id column, documents are decoded on lookup.
+    - The file's pages are shared by every process that maps it.
+    """
+
+    def __init__(self, file_path: str):
+        with open(file_path, 'rb') as f:
+            self.buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.buffer[:len(DOCSTORE_MAGIC)] != DOCSTORE_MAGIC:
+            raise ValueError(f"{file_path} is not a columnar docstore")
+        header = len(DOCSTORE_MAGIC)
+        self.rows = int(np.frombuffer(self.buffer, dtype='<u8', count=1, offset=header)[0])
+        self.offsets = np.frombuffer(self.buffer, dtype='<u8', count=len(DOCSTORE_COLUMNS) * (self.rows + 1),
+                                     offset=header + 8).reshape(len(DOCSTORE_COLUMNS), self.rows + 1)
+        self.data_start = header + 8 + self.offsets.nbytes
+        ids = self.buffer[self.data_start:self.data_start + int(self.offsets[0, -1])]
+        bounds = self.offsets[0].tolist()
+        self.row_of_id = {ids[bounds[row]:bounds[row + 1]].decode(): row for row in range(self.rows)}
+
+    def value(self, column: int, row: int) -> str:
+        start = self.data_start + int(self.offsets[column, row])
+        return self.buffer[start:self.data_start + int(self.offsets[column, row + 1])].decode()
+
+    def document(self, row: int) -> Document:
+        return Document(page_content=self.value(1, row), metadata=json.loads(self.value(2, row)))
+
+    def search(self, search: str) -> Union[str, Document]:
+        row = self.row_of_id.get(search)
+        if row is None:
+            return f"ID {search} not found."
+        return self.document(row)
+
+    def __len__(self) -> int:
+        return self.rows
+
+
+class RowIds(Mapping):
+    """``index_to_docstore_id`` of a columnar docstore, reads the id column instead of holding a dict."""
+
+    def __init__(self, docstore: ColumnarDocstore):
+        self.docstore = docstore
+
+    def __getitem__(self, row: int) -> str:
+        if not 0 <= row < self.docstore.rows:
+            raise KeyError(row)
+        return self.docstore.value(0, int(row))
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self.docstore.rows))
+
+    def __len__(self) -> int:
+        return self.docstore.rows
+
+
+def open_columnar_docstore(path: str) -> Tuple[ColumnarDocstore, RowIds]:
+    docstore = ColumnarDocstore(os.path.join(path, DOCSTORE_FILE))
+    return docstore, RowIds(docstore)
+
+
+def convert_docstore(path: str) -> bool:
+    """Write the columnar docstore of a saved store from its index.pkl, returns False if it already has one."""
+    if has_columnar_docstore(path):
+        return False
+    with open(os.path.join(path, "index.pkl"), 'rb') as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    write_columnar_docstore(docstore, index_to_docstore_id, path)
+    logger.info(f"Wrote the columnar docstore of {path}")
+    return True
+
+
+if __name__ == '__main__':
+    # Convert every version of the given stores to the mapped formats:
+    # python -m stores.docstore data/vector_store data/iframe_store data/image_vector
+    import sys
+    import faiss
+    from stores.mapped_index import has_mapped_vectors, save_mapped_vectors
+    from stores.versions import VersionedStore
+
+    for root in sys.argv[1:]:
+        store = VersionedStore(root)
+        paths = [store.version_path(version) for version in store.versions()] or \
+                [path for path in [store.current_path()] if path]
+        for version_path in paths:
+            if not has_mapped_vectors(version_path):
+                save_mapped_vectors(faiss.read_index(os.path.join(version_path, "index.faiss")), version_path)
+            print(f"{version_path}: docstore {'converted' if convert_docstore(version_path) else 'already columnar'}")
@@ -0,0 +1,88 @@
+import json
+import os
+import pickle
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+
+from stores.docstore import has_columnar_docstore, open_columnar_docstore
+
+VECTOR_STORE_MMAP = os.environ.get("VECTOR_STORE_MMAP", "1") != "0"
+MAPPED_VECTORS_FILE = "index.vectors.npy"
+MAPPED_META_FILE = "index.vectors.json"
+
+
+class MappedFlatIndex:
+    """
+    Read only stand-in for a faiss flat index, searching vectors memory-mapped from a .npy file.
+    - The pages of the file live in the OS page cache and are shared by every worker process that maps it,
+      faiss.read_index would give each worker its own copy.
+    - Implements what the FAISS similarity searches use: ``search``, ``reconstruct``, ``ntotal``, ``d`` and
+      ``metric_type``. Stores are modified by loading them without mmap.
+    """
+
+    def __init__(self, vectors: np.ndarray, metric_type: int):
+        self.vectors = vectors
+        self.metric_type = metric_type
+        self.ntotal, self.d = vectors.shape
+
+    def search(self, x: np.ndarray, k: int):
+        x = np.ascontiguousarray(x, dtype='float32')
+        if self.ntotal == 0:
+            return np.empty((len(x), 0), dtype='float32'), np.empty((len(x), 0), dtype='int64')
+        return faiss.knn(x, self.vectors, min(k, self.ntotal), metric=self.metric_type)
+
+    def reconstruct(self, i: int) -> np.ndarray:
+        return np.array(self.vectors[i])
+
+
+def save_mapped_vectors(index, path: str) -> bool:
+    """Write the vectors of a flat index next to it in a mappable format, other index types are skipped."""
+    if not isinstance(index, faiss.IndexFlat):
+        return False
+    np.save(os.path.join(path, MAPPED_VECTORS_FILE), index.reconstruct_n(0, index.ntotal).reshape(-1, index.d))
+    with open(os.path.join(path, MAPPED_META_FILE), 'w') as f:
+        json.dump({"metric_type": int(index.metric_type), "ntotal": index.ntotal, "d": index.d}, f)
+    return True
+
+
+def has_mapped_vectors(path: str) -> bool:
+    return os.path.exists(os.path.join(path, MAPPED_META_FILE))
+
+
+def load_saved(path: str, embeddings, mmap: bool = True) -> FAISS:
+    """
+    Load a saved store from its mapped vectors and columnar docstore.
+    - With ``mmap`` both are memory-mapped read only, otherwise they are copied into a faiss flat index and an
+      in-memory docstore that can be modified.
+    - Stores saved before either format existed fall back to index.faiss and the pickled docstore.
+    """
+    if has_mapped_vectors(path):
+        with open(os.path.join(path, MAPPED_META_FILE), 'r') as f:
+            metric_type = json.load(f)["metric_type"]
+        vectors = np.load(os.path.join(path, MAPPED_VECTORS_FILE), mmap_mode='r')
+        if mmap:
+            index = MappedFlatIndex(vectors, metric_type)
+        else:
+            # The class FAISS.from_documents builds, merge_from only merges indexes of the same class
+            flat_indexes = {faiss.METRIC_L2: faiss.IndexFlatL2, faiss.METRIC_INNER_PRODUCT: faiss.IndexFlatIP}
+            index = flat_indexes[metric_type](vectors.shape[1]) if metric_type in flat_indexes \
+                else faiss.IndexFlat(vectors.shape[1], metric_type)
+            index.add(np.ascontiguousarray(vectors, dtype='float32'))
+    else:
+        index = faiss.read_index(os.path.join(path, "index.faiss"))
+    if has_columnar_docstore(path):
+        docstore, index_to_docstore_id = open_columnar_docstore(path)
+        if not mmap:
+            index_to_docstore_id = dict(index_to_docstore_id)
+            docstore = InMemoryDocstore({doc_id: docstore.document(row)
+                                         for row, doc_id in index_to_docstore_id.items()})
+    else:
+        with open(os.path.join(path, "index.pkl"), 'rb') as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+    distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT if index.metric_type == faiss.METRIC_INNER_PRODUCT \
+        else DistanceStrategy.EUCLIDEAN_DISTANCE
+    return FAISS(embeddings, index, docstore, index_to_docstore_id, distance_strategy=distance_strategy)
@@ -0,0 +1,131 @@
+import os
+import shutil
+import uuid
+from datetime import datetime
+from typing import List, Optional
+
+import faiss
+from langchain_community.vectorstores import FAISS
+
+from lib import logger
+from stores.docstore import write_columnar_docstore
+from stores.mapped_index import VECTOR_STORE_MMAP, load_saved, save_mapped_vectors
+
+VECTOR_STORE_VERSIONS_KEEP = int(os.environ.get("VECTOR_STORE_VERSIONS_KEEP", 3))
+# Also write index.faiss and the pickled docstore (index.pkl) of every version, for readers older than the mapped
+# formats. Nothing in this tree reads them.
+VECTOR_STORE_LEGACY_FILES = os.environ.get("VECTOR_STORE_LEGACY_FILES", "0") == "1"
+CURRENT_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+INDEX_FILES = ("index.faiss", "index.pkl")
+
+
+class VersionedStore:
+    """
+    Keeps every build of a vector store in its own directory and points readers at one of them.
+    - ``<root>/versions/<version>/`` holds the files of one build, a build is never modified after publishing.
+    - ``<root>/CURRENT`` names the version readers should load, it is replaced atomically.
+    - A build is its vectors (``index.vectors.npy``) and its columnar docstore (``index.docstore``), see
+      ``VECTOR_STORE_LEGACY_FILES`` for the index.faiss and index.pkl of older readers.
+    - Stores written before versioning (index files directly in ``root``) are read as they are until the
+      first publish.
+    - Only the newest ``keep`` versions are kept, the current one is never removed.
+    """
+
+    def __init__(self, root: str, keep: int = VECTOR_STORE_VERSIONS_KEEP):
+        self.root = root
+        self.keep = max(1, keep)
+        self.versions_path = os.path.join(root, VERSIONS_DIR)
+        self.pointer_path = os.path.join(root, CURRENT_FILE)
+
+    def current_version(self) -> Optional[str]:
+        try:
+            with open(self.pointer_path, 'r') as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def current_path(self) -> Optional[str]:
+        version = self.current_version()
+        if version:
+            return self.version_path(version)
+        if os.path.exists(os.path.join(self.root, INDEX_FILES[0])):
+            return self.root
+        return None
+
+    def exists(self) -> bool:
+        return self.current_path() is not None
+
+    def versions(self) -> List[str]:
+        """Published versions, oldest first (version names sort by creation time)."""
+        if not os.path.isdir(self.versions_path):
+            return []
+        return sorted(name for name in os.listdir(self.versions_path) if not name.endswith(".tmp"))
+
+    def load(self, embeddings, mmap: bool = False) -> FAISS:
+        """
+        Load the current version. With ``mmap`` the index and docstore are memory-mapped read only and shared
+        with the other processes mapping them, only stores that are searched (not modified) should be loaded
+        that way. Without it they are copied into memory, to be modified and published again.
+        """
+        path = self.current_path()
+        if path is None:
+            raise FileNotFoundError(f"No vector store in {self.root}")
+        return load_saved(path, embeddings, mmap=mmap and VECTOR_STORE_MMAP)
+
+    def staged_versions(self) -> List[str]:
+        """Versions written to their staging directory but not activated yet, oldest first."""
+        if not os.path.isdir(self.versions_path):
+            return []
+        return sorted(name[:-len(".tmp")] for name in os.listdir(self.versions_path) if name.endswith(".tmp"))
+
+    def version_path(self, version: str) -> str:
+        return os.path.join(self.versions_path, version)
+
+    def staging_path(self, version: str) -> str:
+        """Where a version is written before it is activated, readers never look there."""
+        return os.path.join(self.versions_path, f"{version}.tmp")
+
+    def publish(self, vector_store: FAISS) -> str:
+        """Save ``vector_store`` as a new version, point readers at it and remove old versions."""
+        version = f"{datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex[:8]}"
+        path = self.staging_path(version)
+        if VECTOR_STORE_LEGACY_FILES:
+            vector_store.save_local(path)
+        else:
+            os.makedirs(path)
+        # Only flat indexes have a mapped format, any other one is saved as it is
+        if not save_mapped_vectors(vector_store.index, path) and not VECTOR_STORE_LEGACY_FILES:
+            faiss.write_index(vector_store.index, os.path.join(path, INDEX_FILES[0]))
+        write_columnar_docstore(vector_store.docstore, vector_store.index_to_docstore_id, path)
+        self.activate(version)
+        return version
+
+    def activate(self, version: str) -> None:
+        """Move a staged version in place, point readers at it and remove old versions."""
+        if os.path.isdir(self.staging_path(version)):
+            os.replace(self.staging_path(version), self.version_path(version))
+
+        pointer_tmp_path = f"{self.pointer_path}.{version}.tmp"
+        with open(pointer_tmp_path, 'w') as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer_tmp_path, self.pointer_path)
+        logger.info(f"Published vector store version {version} in {self.root}")
+        self.gc()
+
+    def gc(self) -> List[str]:
+        """Delete versions older than the newest ``keep`` ones and the files of a pre-versioning store."""
+        current = self.current_version()
+        if current is None:
+            return []
+        removed = [version for version in self.versions()[:-self.keep] if version != current]
+        for version in removed:
+            shutil.rmtree(self.version_path(version), ignore_errors=True)
+        for file in INDEX_FILES:
+            if os.path.exists(os.path.join(self.root, file)):
+                os.remove(os.path.join(self.root, file))
+        if removed:
+            logger.info(f"Removed vector store versions {removed} from {self.root}")
+        return removed
@@ -1,8 +1,11 @@
+import asyncio
 import time
 import unittest
+from unittest import mock
 from fastapi.testclient import TestClient
 from main import app
 from db import logger
+from routers import chat
 
 client = TestClient(app)
 
@@ -73,6 +76,84 @@ class TestAPIs(unittest.TestCase):
         self.assertIn("source", response.json())
         logger.info(f"Response: {response.json()}")
 
+    def test_websocket_multiplexes_lookups(self):
+        chunk = "Claude Monet founded Impressionism with Pierre-Auguste Renoir."
+        with client.websocket_connect("/ws") as websocket:
+            websocket.send_json({"type": "source", "id": "source", "query": chunk})
+            websocket.send_json({"type": "artist_img", "id": "artist_img", "query": chunk})
+            websocket.send_json({"type": "ping", "id": "ping"})
+            websocket.send_json({"type": "painting", "id": "unknown"})
+            answers = {answer["id"]: answer for answer in [websocket.receive_json() for _ in range(4)]}
+        logger.info(f"Response: {answers}")
+        self.assertEqual(answers["ping"]["type"], "pong")
+        self.assertEqual(answers["unknown"]["type"], "error")
+        self.assertIn("sources", answers["source"]["data"])
+        self.assertEqual(answers["artist_img"]["type"], "result")
+
+    def test_failed_and_cancelled_turns_give_their_slot_back(self):
+        admission = chat.ai.admission
+        active = admission.active
+        body = {"query": "%info% You are an expert in Arts. % %query% Who was Frida Kahlo? % %instructions% short %",
+                "responseLength": "short", "session_id": f"session_id_{time.time()}"}
+
+        async def slow_generation(*args):
+            yield "Frida"
+            await asyncio.sleep(60)
+
+        async def slow_call(*args):
+            await asyncio.sleep(60)
+
+        # The generation the turns lead starts when they are admitted, it is stopped with their ticket
+        with mock.patch.object(chat.warmup, "ready", lambda: True), mock.patch.object(chat.ai, "run_call", slow_call), \
+                mock.patch("routers.chat.get_recent_messages", return_value=[]):
+            with mock.patch("routers.chat.insert_message", side_effect=RuntimeError("database is locked")):
+                # More failures than the session may have streams open at once
+                for _ in range(admission.session_limit + 1):
+                    response = client.post("/get_response_from_ai", json=body)
+                    self.assertEqual(response.json(), {"error": "database is locked"})
+                with client.websocket_connect("/ws") as websocket:
+                    websocket.send_json({"type": "chat", "id": "failing", **body})
+                    self.assertEqual(websocket.receive_json()["type"], "error")
+
+            with mock.patch("routers.chat.insert_message"), mock.patch.object(chat.ai, "create_gen", slow_generation):
+                with client.websocket_connect("/ws") as websocket:
+                    websocket.send_json({"type": "chat", "id": "slow", **body})
+                    self.assertEqual(websocket.receive_json()["data"], "Frida")
+                    websocket.send_json({"type": "cancel", "target": "slow"})
+                    self.assertEqual(websocket.receive_json()["type"], "cancelled")
+                    websocket.send_json({"type": "ping", "id": "ping"})
+                    websocket.receive_json()
+        self.assertEqual(admission.active, active)
+        self.assertNotIn(body["session_id"], admission.sessions)
+        self.assertEqual(chat.ai.in_flight.flights, {})
+
+    def test_liveness_fails_once_the_warmup_failed_for_good(self):
+        self.assertEqual(client.get("/health/live").status_code, 200)
+        with mock.patch.object(chat.warmup, "failed", lambda: True):
+            response = client.get("/health/live")
+        self.assertEqual((response.status_code, response.json()["status"]), (503, "failed"))
+
+    def test_message_retention_runs_as_a_job(self):
+        job = {"job_id": "retention", "kind": "message_retention", "status": "queued"}
+        with mock.patch.object(chat.job_runner, "start", return_value=job) as start:
+            response = client.post("/message_retention/", params={"max_age_days": 30})
+        self.assertEqual((response.status_code, response.json()), (202, job))
+        start.assert_called_once_with("message_retention", max_age_days=30)
+        response = client.post("/message_retention/", params={"max_age_days": 30, "dry_run": True})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()["dry_run"])
+
+    def test_export_rejects_unknown_tables_and_formats(self):
+        response = client.get("/export/users")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Unknown table 'users'"})
+        response = client.get("/export/messages", params={"file_format": "xlsx"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {"error": "Unknown format 'xlsx'"})
+        response = client.get("/export/messages", params={"start": "2024-06-01"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-disposition"], 'attachment; filename="messages.csv"')
+
 
 if __name__ == '__main__':
     unittest.main()